@@ -3,7 +3,10 @@ import datetime
 import os
 import json
 import math
+import re
+from concurrent.futures import ProcessPoolExecutor
 from PyQt6.QtWidgets import (
+    QAbstractItemView,
     QApplication,
     QMainWindow,
     QTabWidget,
@@ -19,6 +22,7 @@ from PyQt6.QtWidgets import (
     QSlider,
     QComboBox,
     QLineEdit,
+    QPlainTextEdit,
     QColorDialog,
     QGroupBox,
     QFormLayout,
@@ -31,6 +35,7 @@ from PyQt6.QtWidgets import (
     QSplitter,
     QInputDialog,
     QSizePolicy,  # 新增导入
+    QProgressDialog,
 )
 from PyQt6.QtGui import (
     QPixmap,
@@ -42,12 +47,50 @@ from PyQt6.QtGui import (
     QDragEnterEvent,
     QDropEvent,
 )
-from PyQt6.QtCore import Qt, QPoint, QRect, QSize, QUrl
-from PIL import Image, ImageDraw, ImageFont, ImageEnhance, ImageQt
-import numpy as np
+from PyQt6.QtCore import Qt, QRect, QSize, QUrl
+from PIL import Image, ImageFont, ImageQt
+
+# 直接运行 main.py 时，让 src/ 下的 watermark_app 包可以被导入
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "src"))
+from watermark_app.image_io import (
+    IMAGE_EXTENSIONS,
+    close_image,
+    display_size,
+    make_thumbnail,
+    open_image,
+    srcset_targets,
+    working_copy,
+)
+from watermark_app.export_job import (
+    READ_AHEAD,
+    ExportJob,
+    ExportSpec,
+    ReadAhead,
+    WriteBehind,
+    render_export,
+    srcset_pattern_error,
+    when_all,
+)
+from watermark_app.output_plan import OutputPlan
+from watermark_app.preview import WatermarkPreview
+from watermark_app.shared_frames import FramePool, render_frame
+from watermark_app.storage import (
+    PLAN_DIR,
+    SETTINGS_FILE,
+    DebouncedWriter,
+    TemplateStore,
+    load_json,
+)
+from watermark_app.text_template import TEMPLATE_FIELDS
+from watermark_app.watermark_core import MAX_INVISIBLE_ID, RenderPlanCache
 
 
 class WatermarkApp(QMainWindow):
+    # 导出颜色模式 -> 传给 save_image 的模式，None 表示保持原图模式
+    COLOR_MODES = {"source": None, "RGB": "RGB", "L": "L"}
+    # 多行文本对齐方式 (显示名称, 设置值)
+    TEXT_ALIGNMENTS = (("左对齐", "left"), ("居中", "center"), ("右对齐", "right"))
+
     def __init__(self):
         super().__init__()
         self.init_data(load_templates=False)  # 先初始化数据，暂不加载模板
@@ -111,9 +154,8 @@ class WatermarkApp(QMainWindow):
         preview_label.setStyleSheet("font-weight: bold; padding: 5px 0;")
         center_layout.addWidget(preview_label)
 
-        # 水印预览区域（核心优化）
-        self.watermark_preview = QLabel()
-        self.watermark_preview.setAlignment(Qt.AlignmentFlag.AlignCenter)
+        # 水印预览区域：底图缓存为一个图形项，水印是可拖动、旋转的叠加项
+        self.watermark_preview = WatermarkPreview(plans=self.render_plans)
         self.watermark_preview.setStyleSheet("border: 1px solid #cccccc;")
         # 设置大小策略为可扩展，使其能随窗口大小变化
         self.watermark_preview.setSizePolicy(
@@ -121,10 +163,7 @@ class WatermarkApp(QMainWindow):
             QSizePolicy.Policy.Expanding
         )
         self.watermark_preview.setMinimumSize(400, 400)  # 保持最小尺寸
-        self.watermark_preview.setMouseTracking(True)
-        self.watermark_preview.mousePressEvent = self.start_drag_watermark
-        self.watermark_preview.mouseMoveEvent = self.drag_watermark
-        self.watermark_preview.mouseReleaseEvent = self.stop_drag_watermark
+        self.watermark_preview.positionChanged.connect(self.on_preview_dragged)
 
         # 添加预览区域并设置为可扩展
         center_layout.addWidget(self.watermark_preview, 1)  # 1表示权重，会占据所有可用空间
@@ -208,6 +247,13 @@ class WatermarkApp(QMainWindow):
             "image_scale": 100,  # 百分比
             "position": (0.5, 0.5),  # 相对位置 (x, y) 0-1范围
             "rotation": 0,  # 角度
+            "text_align": "left",  # 多行文本对齐方式 "left"/"center"/"right"
+            "line_spacing": 1.0,  # 行距，自然行高的倍数
+            "max_width": 0,  # 文本最大行宽（像素），0 表示不自动折行
+            "auto_position": False,  # 每张图片自动选择细节最少的位置
+            "adaptive_color": False,  # 每张图片按水印下方的亮度自动选择黑/白字和描边
+            "invisible_id": 0,  # 隐形水印编号，0 表示不嵌入
+            "invisible_key": "",  # 隐形水印密钥，空表示默认密钥
         }
 
         # 导出设置（保持不变）
@@ -220,138 +266,271 @@ class WatermarkApp(QMainWindow):
             "quality": 90,
             "resize_method": "none",  # "none", "width", "height", "percentage"
             "resize_value": 100,
+            "srcset": False,  # 是否导出多个宽度（响应式 srcset）
+            "srcset_widths": "320,640,1280,2560",
+            "srcset_pattern": "{name}-{width}w",  # 多尺寸文件名，{name} 为按命名规则生成的文件名
+            "color_mode": "source",  # "source"（保持原图模式）, "RGB", "L"
+            "processes": 1,  # 导出进程数，1 表示在界面进程中逐张导出
+            "collisions": "number",  # 重名处理："number"（依次编号）, "mirror"（保留子文件夹结构）
         }
 
+        # 当前预览图片的细节分布 (路径, DetailMap)，自动位置预览用
+        self.detail_map = None
+
+        # 已提示过无法加载的字体，避免每次刷新都弹窗
+        self.warned_font = None
+
+        # 设置变化后防抖、原子地写入 last_settings.json
+        self.settings_writer = DebouncedWriter(SETTINGS_FILE)
+
+        # 每组水印设置（模板）编译一次的渲染计划，同时保存在磁盘上
+        self.render_plans = RenderPlanCache(PLAN_DIR)
+
         # 水印模板
         self.templates = []
         if load_templates:  # 根据参数决定是否加载模板
             self.load_templates()
 
-        # 拖拽状态
-        self.dragging = False
-        self.drag_start_pos = QPoint()
-
     def export_images(self):
         """导出所有处理好的图片"""
         if not self.images:
             QMessageBox.warning(self, "警告", "没有可导出的图片")
             return
 
-        # 确保导出目录存在
-        export_dir = self.export_settings["folder"]
-        os.makedirs(export_dir, exist_ok=True)
+        self.run_export([self.export_target()])
 
-        # 处理每张图片
-        success_count = 0
-        error_count = 0
-        error_files = []
+    def export_target(self):
+        """当前水印设置和缩放设置，导出到导出文件夹"""
+        return (
+            self.watermark_settings,
+            self.export_settings["resize_method"],
+            self.export_settings["resize_value"],
+            self.export_settings["folder"],
+        )
 
-        for img_data in self.images:
-            try:
-                # 获取原图并应用水印
-                original_image = img_data["image"].copy()
-                watermarked_image = self.apply_watermark(original_image)
+    def preview_export_plan(self):
+        """试运行：只计算全部输出路径并显示重名和覆盖情况，不渲染任何图片"""
+        if not self.images:
+            QMessageBox.warning(self, "警告", "没有可导出的图片")
+            return
+        srcset_widths = self.srcset_widths()
+        if srcset_widths is False:
+            return
+        plan = self.plan_export(
+            [self.export_target()], [(img_data, 0) for img_data in self.images], srcset_widths
+        )
+        box = QMessageBox(self)
+        box.setWindowTitle("导出预览")
+        box.setText(plan.report())
+        box.setDetailedText(
+            "\n".join(f"{output.source} -> {path}" for output in plan.outputs for path in output.paths)
+        )
+        box.exec()
+
+    def srcset_widths(self):
+        """开启多尺寸导出时的宽度列表，未开启时为 None；宽度或文件名模式无效时提示并返回 False"""
+        if not self.export_settings["srcset"]:
+            return None
+        widths = self.parse_srcset_widths(self.export_settings["srcset_widths"])
+        if not widths:
+            QMessageBox.warning(self, "警告", "请填写有效的多尺寸宽度，例如 320,640,1280")
+            return False
+        error = srcset_pattern_error(self.export_settings["srcset_pattern"])
+        if error:
+            QMessageBox.warning(self, "警告", error)
+            return False
+        return widths
+
+    def plan_export(self, targets, tasks, srcset_widths=None):
+        """
+        导出前的规划：一次算好全部输出路径，在内存中检测重名并按导出设置改名。
+        :param targets: [(水印设置, 缩放方式, 缩放值, 导出目录), ...]
+        :param tasks: [(图片数据, 目标序号), ...]
+        :param srcset_widths: 多尺寸导出的宽度列表，None 表示只导出一张
+        :return: OutputPlan
+        """
+        entries = []
+        for task in tasks:
+            img_data, index = task
+            widths = None
+            if srcset_widths:
+                # 多尺寸由转正后的母版缩小，比母版宽的尺寸不生成
+                widths = srcset_targets(display_size(img_data["image"])[0], srcset_widths)
+            entries.append((task, img_data["path"], targets[index][3], widths))
+        return OutputPlan(entries, self.export_settings, self.export_settings["collisions"])
+
+    def export_with_templates(self):
+        """用选中的多个模板导出：每张原图只解码一次，依次套用每个模板，输出到各模板的子文件夹"""
+        if not self.images:
+            QMessageBox.warning(self, "警告", "没有可导出的图片")
+            return
+
+        names = {item.text() for item in self.template_list.selectedItems()}
+        templates = [t for t in self.templates if t["name"] in names]
+        if not templates:
+            QMessageBox.warning(self, "警告", "请先在模板列表中选择要导出的模板")
+            return
 
-                # 处理缩放
-                resized_image = self.resize_image(watermarked_image)
+        targets = []
+        for template in templates:
+            # 模板自带缩放设置时使用模板的，否则使用当前导出设置
+            resize = dict(self.export_settings, **template.get("export_settings", {}))
+            folder = os.path.join(
+                self.export_settings["folder"], re.sub(r'[\\/:*?"<>|]', "_", template["name"])
+            )
+            targets.append(
+                (template["watermark_settings"], resize["resize_method"], resize["resize_value"], folder)
+            )
+        self.run_export(targets)
+
+    def run_export(self, targets, tasks=None, plan=None):
+        """
+        导出所有图片。每张原图只取一次，再依次生成每个导出目标的结果。
+        开启多尺寸导出时，每个目标只渲染一张带水印的母版，再由它逐级缩小出各个宽度，
+        此时目标自身的缩放设置不起作用。
+        导出过程中显示进度、速度和剩余时间，可以取消；结束后可以只重试失败的项。
+        :param targets: [(水印设置, 缩放方式, 缩放值, 导出目录), ...]
+        :param tasks: [(图片数据, 目标序号), ...]，None 表示全部图片的全部目标
+        :param plan: 上一次导出的 OutputPlan（重试时沿用原来的输出路径），None 表示重新规划
+        """
+        srcset_widths = self.srcset_widths()
+        if srcset_widths is False:
+            return
 
-                # 获取输出文件名
-                output_path = self.get_output_file_path(img_data["path"], export_dir)
+        if tasks is None:
+            tasks = [(img_data, i) for img_data in self.images for i in range(len(targets))]
 
-                # 保存图片
-                self.save_image(resized_image, output_path)
+        # 渲染任何像素之前先规划全部输出路径；有重名或会覆盖已有文件时先确认
+        if plan is None:
+            plan = self.plan_export(targets, tasks, srcset_widths)
+            if plan.renamed or plan.existing:
+                reply = QMessageBox.question(
+                    self,
+                    "导出文件名",
+                    f"{plan.report()}\n\n是否继续导出？",
+                    QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No,
+                )
+                if reply != QMessageBox.StandardButton.Yes:
+                    return
+        outputs = {id(output.task): output for output in plan.outputs}
+
+        # 每个目标的渲染计划只编译一次，并确保输出文件夹存在
+        for settings, _, _, _ in targets:
+            render_plan = self.render_plans.get(settings)
+            self.check_font_fallback(render_plan, settings["font_family"])
+        for folder in {os.path.dirname(output.output_path) for output in plan.outputs}:
+            os.makedirs(folder, exist_ok=True)
+        # 图片在列表中的序号，用于水印文本中的 {seq} 占位符
+        sequence = {id(img_data): i for i, img_data in enumerate(self.images, 1)}
+
+        def spec_for(task):
+            img_data, index = task
+            settings, method, value, _ = targets[index]
+            return ExportSpec(
+                settings,
+                img_data["path"],
+                sequence.get(id(img_data), 1),
+                method,
+                value,
+                outputs[id(task)].output_path,
+                self.export_settings["format"],
+                self.export_settings["quality"],
+                self.COLOR_MODES[self.export_settings["color_mode"]],
+                srcset_widths,
+                self.export_settings["srcset_pattern"],
+            )
 
-                success_count += 1
-            except Exception as e:
-                error_count += 1
-                error_files.append(f"{img_data['path']}: {str(e)}")
-                print(f"导出失败: {img_data['path']} - {str(e)}")
+        def export_one(task, writer=None):
+            img_data = task[0]
+            # 每个目标只分配一份工作图像，之后的水印和缩放都在它上面进行
+            # （内存映射的图片只复制被水印覆盖的页）
+            working_image = working_copy(img_data["image"], img_data["path"])
+            try:
+                return render_export(working_image, spec_for(task), self.render_plans, writer)
+            finally:
+                # 结果已经编码，关闭写时复制映射，不再占用原图文件
+                close_image(working_image)
+
+        def describe(task):
+            img_data, index = task
+            if len(targets) == 1:
+                return img_data["path"]
+            return f"{img_data['path']} -> {targets[index][3]}"
+
+        def source_size(task):
+            path = task[0]["path"]
+            return os.path.getsize(path) if os.path.exists(path) else 0
+
+        job = ExportJob(tasks, label=describe, size_of=source_size)
+
+        # 进度对话框：在文件之间刷新界面，取消按钮在当前文件完成后生效
+        dialog = QProgressDialog("正在导出...", "取消", 0, len(tasks), self)
+        dialog.setWindowTitle("导出")
+        dialog.setWindowModality(Qt.WindowModality.WindowModal)
+        dialog.setMinimumDuration(500)
+        dialog.canceled.connect(job.cancel)
+
+        def on_progress(progress):
+            eta = "--" if progress.eta is None else f"{progress.eta:.0f} 秒"
+            dialog.setLabelText(
+                f"已处理 {progress.done}/{progress.total}，失败 {progress.failed}\n"
+                f"{progress.images_per_second:.1f} 张/秒，{progress.mb_per_second:.1f} MB/秒，"
+                f"剩余约 {eta}\n{os.path.basename(progress.current)}"
+            )
+            dialog.setValue(progress.done)
+            QApplication.processEvents()
+
+        processes = self.export_settings.get("processes", 1)
+        if processes > 1 and len(tasks) > 1:
+            # 多进程导出：原图的像素复制进共享内存帧池，子进程直接在帧上添加水印并保存，
+            # 进程之间只传递帧的名称和导出参数
+            # 帧池先进入、后退出：进程池关闭（子进程都已结束）之后才释放共享内存
+            with FramePool() as frames, ProcessPoolExecutor(max_workers=processes) as pool:
+
+                def submit(task):
+                    ref = frames.put(task[0]["image"])
+                    future = pool.submit(render_frame, ref, spec_for(task))
+                    future.add_done_callback(lambda _: frames.release(ref))
+                    return future
+
+                job.run_parallel(submit, processes * 2, on_progress)
+        else:
+            # 流水线导出：渲染在界面线程中进行，编码好的结果交给写盘线程；
+            # 导入时已解码的图片不再读盘，内存映射的图片由预读线程提前读入系统缓存
+            mapped = [task[0]["path"] for task in tasks if task[0]["image"].readonly]
+            with ReadAhead(mapped) as read_ahead, WriteBehind() as writer:
+
+                def submit(task):
+                    read_ahead.wait(task[0]["path"])
+                    return when_all(export_one(task, writer))
+
+                job.run_parallel(submit, READ_AHEAD, on_progress)
+        dialog.close()
 
         # 显示导出结果
-        result_msg = f"成功导出 {success_count} 张图片\n"
-        if error_count > 0:
-            result_msg += f"导出失败 {error_count} 张图片\n"
+        elapsed = job.progress().elapsed
+        result_msg = f"成功导出 {job.succeeded} 张图片（用时 {elapsed:.1f} 秒）\n"
+        if job.cancelled:
+            result_msg += f"已取消，{len(job.remaining_tasks())} 张未处理\n"
+        if job.errors:
+            result_msg += f"导出失败 {len(job.errors)} 张图片\n"
             # 详细错误信息
-            details = "\n".join(error_files)
-            QMessageBox.warning(self, "导出完成", f"{result_msg}\n详细错误:\n{details}")
+            details = "\n".join(f"{error.label}: {error.message}" for error in job.errors)
+            reply = QMessageBox.question(
+                self,
+                "导出完成",
+                f"{result_msg}\n详细错误:\n{details}\n\n是否重试失败的图片？",
+                QMessageBox.StandardButton.Retry | QMessageBox.StandardButton.Close,
+            )
+            if reply == QMessageBox.StandardButton.Retry:
+                self.run_export(targets, job.failed_tasks(), plan)
         else:
             QMessageBox.information(self, "导出完成", result_msg)
 
-    def resize_image(self, image):
-        """根据导出设置调整图片大小"""
-        method = self.export_settings["resize_method"]
-        value = self.export_settings["resize_value"]
-
-        if method == "none" or value <= 0:
-            return image.copy()
-
-        width, height = image.size
-
-        if method == "percentage":
-            # 按百分比缩放
-            new_width = int(width * value / 100)
-            new_height = int(height * value / 100)
-        elif method == "width":
-            # 按指定宽度缩放（保持比例）
-            ratio = value / width
-            new_width = value
-            new_height = int(height * ratio)
-        elif method == "height":
-            # 按指定高度缩放（保持比例）
-            ratio = value / height
-            new_width = int(width * ratio)
-            new_height = value
-        else:
-            return image.copy()
-
-        # 确保尺寸有效
-        new_width = max(10, new_width)
-        new_height = max(10, new_height)
-
-        # 高质量缩放
-        return image.resize((new_width, new_height), Image.Resampling.LANCZOS)
-
-    def get_output_file_path(self, original_path, export_dir):
-        """生成输出文件路径"""
-        original_name = os.path.basename(original_path)
-        name, ext = os.path.splitext(original_name)
-
-        # 根据命名规则处理文件名
-        naming = self.export_settings["naming"]
-        if naming == "prefix":
-            new_name = f"{self.export_settings['prefix']}{name}{ext}"
-        elif naming == "suffix":
-            new_name = f"{name}{self.export_settings['suffix']}{ext}"
-        else:  # original
-            new_name = original_name
-
-        # 处理文件格式
-        output_format = self.export_settings["format"].lower()
-        if output_format == "jpg" and ext.lower() != ".jpg" and ext.lower() != ".jpeg":
-            new_name = os.path.splitext(new_name)[0] + ".jpg"
-        elif output_format == "png" and ext.lower() != ".png":
-            new_name = os.path.splitext(new_name)[0] + ".png"
-
-        return os.path.join(export_dir, new_name)
-
-    def save_image(self, image, output_path):
-        """保存图片到指定路径"""
-        # 处理不同格式的保存参数
-        format = self.export_settings["format"].upper()
-
-        # 如果是JPG，需要转换为RGB模式（去除Alpha通道）
-        if format == "JPG" and image.mode in ("RGBA", "LA"):
-            background = Image.new(image.mode[:-1], image.size, (255, 255, 255))
-            background.paste(image, image.split()[-1])
-            image = background
-
-        # 保存图片
-        image.save(
-            output_path,
-            format=format,
-            quality=self.export_settings["quality"],
-            optimize=True,
-        )
+    @staticmethod
+    def parse_srcset_widths(text):
+        """把 "320, 640 1280" 形式的宽度列表解析为整数列表，忽略无效项"""
+        return [int(w) for w in re.split(r"[,\s，]+", text) if w.isdigit() and int(w) > 0]
 
     def init_watermark_type_tab(self):
         # 修复：将self.tab_position改为self.tab_watermark_type
@@ -375,8 +554,18 @@ class WatermarkApp(QMainWindow):
         self.text_settings_group = QGroupBox("文本设置")
         text_layout = QFormLayout()
 
-        self.txt_watermark_text = QLineEdit("水印")
-        self.txt_watermark_text.textChanged.connect(self.on_text_changed)
+        # 多行文本：每行一段，超过最大行宽时自动折行
+        self.txt_watermark_text = QPlainTextEdit("水印")
+        self.txt_watermark_text.setFixedHeight(60)
+        # 占位符在导出时按每张图片展开，如 "© {artist} {date:%Y}"
+        self.txt_watermark_text.setToolTip(
+            "可用占位符：\n"
+            + "\n".join(f"{{{name}}}  {desc}" for name, desc in TEMPLATE_FIELDS.items())
+            + "\n日期可指定格式，如 {date:%Y-%m-%d}；序号可补零，如 {seq:03d}"
+        )
+        self.txt_watermark_text.textChanged.connect(
+            lambda: self.on_text_changed(self.txt_watermark_text.toPlainText())
+        )
 
         # 字体选择 - 修复：使用过滤后的可用字体列表
         self.font_families = self.get_available_fonts()  # 调用新增函数获取可用字体
@@ -412,11 +601,33 @@ class WatermarkApp(QMainWindow):
         self.btn_color.setStyleSheet("background-color: white;")
         self.btn_color.clicked.connect(self.choose_color)
 
+        # 多行排版：对齐方式、行距和最大行宽
+        self.cmb_text_align = QComboBox()
+        for label, align in self.TEXT_ALIGNMENTS:
+            self.cmb_text_align.addItem(label, align)
+        self.cmb_text_align.currentIndexChanged.connect(self.on_text_layout_changed)
+
+        self.spin_line_spacing = QDoubleSpinBox()
+        self.spin_line_spacing.setRange(0.5, 3.0)
+        self.spin_line_spacing.setSingleStep(0.1)
+        self.spin_line_spacing.setValue(1.0)
+        self.spin_line_spacing.valueChanged.connect(self.on_text_layout_changed)
+
+        self.spin_max_width = QSpinBox()
+        self.spin_max_width.setRange(0, 10000)
+        self.spin_max_width.setSingleStep(50)
+        self.spin_max_width.setSuffix(" px")
+        self.spin_max_width.setSpecialValueText("不折行")
+        self.spin_max_width.valueChanged.connect(self.on_text_layout_changed)
+
         text_layout.addRow("水印文本:", self.txt_watermark_text)
         text_layout.addRow("字体:", self.cmb_font)
         text_layout.addRow("字号:", self.spin_font_size)
         text_layout.addRow(self.chk_bold, self.chk_italic)
         text_layout.addRow("颜色:", self.btn_color)
+        text_layout.addRow("对齐:", self.cmb_text_align)
+        text_layout.addRow("行距:", self.spin_line_spacing)
+        text_layout.addRow("最大行宽:", self.spin_max_width)
 
         self.text_settings_group.setLayout(text_layout)
 
@@ -477,8 +688,13 @@ class WatermarkApp(QMainWindow):
         self.chk_stroke = QCheckBox("添加描边")
         self.chk_stroke.stateChanged.connect(self.on_effects_changed)
 
+        # 自适应颜色：导出时每张图片按水印下方的亮度选择黑字或白字，背景杂乱时加描边
+        self.chk_adaptive_color = QCheckBox("自动对比色（逐图选择黑/白字）")
+        self.chk_adaptive_color.stateChanged.connect(self.on_effects_changed)
+
         effects_layout.addWidget(self.chk_shadow)
         effects_layout.addWidget(self.chk_stroke)
+        effects_layout.addWidget(self.chk_adaptive_color)
         self.effects_group.setLayout(effects_layout)
 
         # 图片水印缩放
@@ -500,9 +716,28 @@ class WatermarkApp(QMainWindow):
         self.image_scale_group.setLayout(scale_layout)
         self.image_scale_group.setEnabled(False)
 
+        # 隐形水印：把编号嵌入亮度，用于追查外泄的图片
+        # （python -m watermark_app detect 图片... 检测）
+        invisible_group = QGroupBox("隐形水印")
+        invisible_layout = QFormLayout()
+
+        self.spin_invisible_id = QSpinBox()
+        self.spin_invisible_id.setRange(0, MAX_INVISIBLE_ID)
+        self.spin_invisible_id.setSpecialValueText("不嵌入")
+        self.spin_invisible_id.valueChanged.connect(self.on_invisible_changed)
+
+        self.txt_invisible_key = QLineEdit()
+        self.txt_invisible_key.setPlaceholderText("默认密钥")
+        self.txt_invisible_key.textChanged.connect(self.on_invisible_changed)
+
+        invisible_layout.addRow("编号:", self.spin_invisible_id)
+        invisible_layout.addRow("密钥:", self.txt_invisible_key)
+        invisible_group.setLayout(invisible_layout)
+
         layout.addWidget(trans_group)
         layout.addWidget(self.effects_group)
         layout.addWidget(self.image_scale_group)
+        layout.addWidget(invisible_group)
         layout.addStretch()
 
         self.tab_watermark_settings.setLayout(layout)
@@ -536,6 +771,11 @@ class WatermarkApp(QMainWindow):
             position_layout.addWidget(btn, row, col)
             self.position_buttons.append(btn)
 
+        # 自动位置：导出时每张图片在四角、四边中点和中心中选择细节最少的位置
+        self.chk_auto_position = QCheckBox("自动避开细节（逐图选择位置）")
+        self.chk_auto_position.toggled.connect(self.on_auto_position_changed)
+        position_layout.addWidget(self.chk_auto_position, 3, 0, 1, 3)
+
         position_group.setLayout(position_layout)
 
         # 旋转设置
@@ -586,6 +826,15 @@ class WatermarkApp(QMainWindow):
 
         format_layout.addWidget(self.radio_png)
         format_layout.addWidget(self.radio_jpg)
+
+        # 颜色模式：默认保持原图模式（灰度、调色板、16 位等），格式不支持时才转换
+        self.combo_color_mode = QComboBox()
+        for key, label in (("source", "保持原图模式"), ("RGB", "彩色 (RGB)"), ("L", "灰度")):
+            self.combo_color_mode.addItem(label, key)
+        self.combo_color_mode.currentIndexChanged.connect(self.on_color_mode_changed)
+        format_layout.addWidget(QLabel("颜色模式:"))
+        format_layout.addWidget(self.combo_color_mode)
+
         format_group.setLayout(format_layout)
 
         # JPEG质量
@@ -628,6 +877,18 @@ class WatermarkApp(QMainWindow):
         naming_layout.addWidget(self.radio_suffix)
         naming_layout.addWidget(self.txt_suffix)
 
+        # 重名处理：不同子文件夹中的同名图片不会互相覆盖
+        self.combo_collisions = QComboBox()
+        for key, label in (("number", "重名时依次编号"), ("mirror", "保留子文件夹结构")):
+            self.combo_collisions.addItem(label, key)
+        self.combo_collisions.currentIndexChanged.connect(self.on_collisions_changed)
+        naming_layout.addWidget(QLabel("重名处理:"))
+        naming_layout.addWidget(self.combo_collisions)
+
+        self.btn_preview_export = QPushButton("预览输出文件名")
+        self.btn_preview_export.clicked.connect(self.preview_export_plan)
+        naming_layout.addWidget(self.btn_preview_export)
+
         naming_group.setLayout(naming_layout)
 
         # 缩放设置
@@ -653,6 +914,38 @@ class WatermarkApp(QMainWindow):
 
         resize_group.setLayout(resize_layout)
 
+        # 多尺寸导出
+        srcset_group = QGroupBox("多尺寸导出（srcset）")
+        srcset_layout = QVBoxLayout()
+
+        self.chk_srcset = QCheckBox("由同一张带水印的图片导出多个宽度")
+        self.chk_srcset.toggled.connect(self.on_srcset_changed)
+
+        self.txt_srcset_widths = QLineEdit(self.export_settings["srcset_widths"])
+        self.txt_srcset_widths.setPlaceholderText("宽度，用逗号分隔")
+        self.txt_srcset_widths.textChanged.connect(self.on_srcset_widths_changed)
+
+        self.txt_srcset_pattern = QLineEdit(self.export_settings["srcset_pattern"])
+        self.txt_srcset_pattern.textChanged.connect(self.on_srcset_pattern_changed)
+
+        srcset_layout.addWidget(self.chk_srcset)
+        srcset_layout.addWidget(QLabel("宽度:"))
+        srcset_layout.addWidget(self.txt_srcset_widths)
+        srcset_layout.addWidget(QLabel("文件名:"))
+        srcset_layout.addWidget(self.txt_srcset_pattern)
+
+        srcset_group.setLayout(srcset_layout)
+
+        # 并行导出
+        processes_layout = QHBoxLayout()
+        self.spin_processes = QSpinBox()
+        self.spin_processes.setRange(1, os.cpu_count() or 1)
+        self.spin_processes.setValue(self.export_settings["processes"])
+        self.spin_processes.setToolTip("大于 1 时用多个进程同时导出，图片通过共享内存传给各进程")
+        self.spin_processes.valueChanged.connect(self.on_processes_changed)
+        processes_layout.addWidget(QLabel("导出进程数:"))
+        processes_layout.addWidget(self.spin_processes)
+
         # 连接信号
         self.radio_original.toggled.connect(self.on_naming_changed)
         self.radio_prefix.toggled.connect(self.on_naming_changed)
@@ -668,6 +961,8 @@ class WatermarkApp(QMainWindow):
         layout.addWidget(self.quality_group)
         layout.addWidget(naming_group)
         layout.addWidget(resize_group)
+        layout.addWidget(srcset_group)
+        layout.addLayout(processes_layout)
         layout.addStretch()
 
         self.tab_export.setLayout(layout)
@@ -702,15 +997,27 @@ class WatermarkApp(QMainWindow):
         new_template = {
             "name": name,
             "watermark_settings": settings_copy,
+            # 模板同时记住当前的缩放设置，多模板导出时按模板各自缩放
+            "export_settings": {
+                "resize_method": self.export_settings["resize_method"],
+                "resize_value": self.export_settings["resize_value"],
+            },
             "created_at": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         }
 
+        # 只写入这一个模板
+        try:
+            self.template_store.save(new_template)
+        except Exception as e:
+            QMessageBox.warning(self, "错误", f"保存模板失败: {str(e)}")
+            return
+
+        # 预先编译模板的渲染计划，之后选择模板或用它导出时不再做准备工作
+        self.render_plans.get(settings_copy, persist=True)
+
         # 添加到模板列表并刷新UI
         self.templates.append(new_template)
         self.template_list.addItem(name)
-        
-        # 保存模板到文件
-        self.save_templates_to_file()
         QMessageBox.information(self, "成功", f"模板 '{name}' 已保存")
 
     def delete_template(self):
@@ -731,26 +1038,25 @@ class WatermarkApp(QMainWindow):
         )
 
         if reply == QMessageBox.StandardButton.Yes:
+            # 只删除模板库中的这一行
+            try:
+                self.template_store.delete(name)
+            except Exception as e:
+                QMessageBox.warning(self, "错误", f"删除模板失败: {str(e)}")
+                return
+
             # 从数据和列表中移除
             self.templates = [t for t in self.templates if t["name"] != name]
             self.template_list.takeItem(self.template_list.row(current_item))
-
-            # 保存修改到文件
-            self.save_templates_to_file()
             QMessageBox.information(self, "成功", f"模板 '{name}' 已删除")
 
     def load_templates(self):
-        """从文件加载模板并验证格式"""
+        """从模板库加载模板并验证格式"""
         try:
-            # 确保模板目录存在
-            template_dir = os.path.expanduser("~/.watermark_app")
-            os.makedirs(template_dir, exist_ok=True)
-            template_file = os.path.join(template_dir, "templates.json")
-            
-            if os.path.exists(template_file):
-                with open(template_file, "r", encoding="utf-8") as f:
-                    loaded_templates = json.load(f)
-                
+            # 模板库（SQLite）首次创建时会导入旧的 templates.json
+            self.template_store = TemplateStore()
+            loaded_templates = self.template_store.list()
+            if loaded_templates:
                 # 验证并修复加载的模板数据
                 self.templates = []
                 for temp in loaded_templates:
@@ -783,23 +1089,13 @@ class WatermarkApp(QMainWindow):
             # 初始化空模板列表
             self.templates = []
 
-    def save_templates_to_file(self):
-        """将模板保存到文件"""
-        try:
-            template_dir = os.path.expanduser("~/.watermark_app")
-            os.makedirs(template_dir, exist_ok=True)
-            template_file = os.path.join(template_dir, "templates.json")
-
-            with open(template_file, "w", encoding="utf-8") as f:
-                json.dump(self.templates, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            QMessageBox.warning(self, "错误", f"保存模板失败: {str(e)}")
-
     def init_templates_tab(self):
         layout = QVBoxLayout()
 
         # 模板列表
         self.template_list = QListWidget()
+        # 按 Ctrl/Shift 可多选模板，用于多模板导出
+        self.template_list.setSelectionMode(QAbstractItemView.SelectionMode.ExtendedSelection)
         self.template_list.itemClicked.connect(self.on_template_selected)
 
         # 按钮
@@ -814,9 +1110,13 @@ class WatermarkApp(QMainWindow):
         btn_layout.addWidget(self.btn_save_template)
         btn_layout.addWidget(self.btn_delete_template)
 
+        self.btn_export_templates = QPushButton("用选中模板分别导出")
+        self.btn_export_templates.clicked.connect(self.export_with_templates)
+
         layout.addWidget(QLabel("水印模板:"))
         layout.addWidget(self.template_list)
         layout.addLayout(btn_layout)
+        layout.addWidget(self.btn_export_templates)
         layout.addStretch()
 
         self.tab_templates.setLayout(layout)
@@ -853,10 +1153,9 @@ class WatermarkApp(QMainWindow):
     def import_folder(self):
         folder = QFileDialog.getExistingDirectory(self, "选择文件夹")
         if folder:
-            image_extensions = [".png", ".jpg", ".jpeg", ".bmp", ".tiff", ".gif"]
             files = []
             for file in os.listdir(folder):
-                if os.path.splitext(file)[1].lower() in image_extensions:
+                if os.path.splitext(file)[1].lower() in IMAGE_EXTENSIONS:
                     files.append(os.path.join(folder, file))
             self.import_files(files)
 
@@ -871,25 +1170,15 @@ class WatermarkApp(QMainWindow):
                 continue
 
             try:
-                with Image.open(file) as img:
-                    # 转换为RGBA以支持透明
-                    if img.mode not in ("RGBA", "LA"):
-                        img = img.convert("RGBA")
-                    self.images.append({"path": file, "image": img.copy()})
+                # 未压缩的 TIFF/BMP 通过内存映射打开，其余图片按原模式解码，
+                # 不再整幅转换为 RGBA 并额外复制一份
+                image = open_image(file)
+                self.images.append({"path": file, "image": image})
 
-                # 添加到列表
+                # 添加到列表（缩略图由已打开的图像生成，不再让 Qt 重新解码原图）
                 item = QListWidgetItem(os.path.basename(file))
-                pixmap = QPixmap(file)
-                item.setIcon(
-                    QIcon(
-                        pixmap.scaled(
-                            128,
-                            128,
-                            Qt.AspectRatioMode.KeepAspectRatio,
-                            Qt.TransformationMode.SmoothTransformation,
-                        )
-                    )
-                )
+                thumbnail = make_thumbnail(image, 128)
+                item.setIcon(QIcon(QPixmap.fromImage(ImageQt.ImageQt(thumbnail))))
                 self.image_list.addItem(item)
 
             except Exception as e:
@@ -912,19 +1201,21 @@ class WatermarkApp(QMainWindow):
             return
 
         # 从数据和列表中移除
-        del self.images[self.current_image_index]
+        removed = self.images.pop(self.current_image_index)
         self.image_list.takeItem(self.current_image_index)
 
         # 更新当前索引
         if len(self.images) == 0:
             self.current_image_index = -1
-            self.watermark_preview.setText("预览区域")
+            self.watermark_preview.clear_image()
         else:
             self.current_image_index = min(
                 self.current_image_index, len(self.images) - 1
             )
             self.image_list.setCurrentRow(self.current_image_index)
             self.update_preview()
+        # 预览已换成其他图片，释放原图（内存映射的图片同时解除对文件的占用）
+        close_image(removed["image"])
 
     def on_watermark_type_changed(self):
         is_text = self.radio_text.isChecked()
@@ -942,6 +1233,12 @@ class WatermarkApp(QMainWindow):
         self.watermark_settings["text"] = text
         self.update_preview()
 
+    def on_text_layout_changed(self):
+        self.watermark_settings["text_align"] = self.cmb_text_align.currentData()
+        self.watermark_settings["line_spacing"] = self.spin_line_spacing.value()
+        self.watermark_settings["max_width"] = self.spin_max_width.value()
+        self.update_preview()
+
     def on_font_changed(self, font_family):
         self.watermark_settings["font_family"] = font_family
         self.update_preview()
@@ -1007,8 +1304,15 @@ class WatermarkApp(QMainWindow):
     def on_effects_changed(self):
         self.watermark_settings["shadow"] = self.chk_shadow.isChecked()
         self.watermark_settings["stroke"] = self.chk_stroke.isChecked()
+        self.watermark_settings["adaptive_color"] = self.chk_adaptive_color.isChecked()
         self.update_preview()
 
+    def on_invisible_changed(self):
+        self.watermark_settings["invisible_id"] = self.spin_invisible_id.value()
+        self.watermark_settings["invisible_key"] = self.txt_invisible_key.text()
+        # 隐形水印不影响预览，只需要保存设置
+        self.schedule_settings_save()
+
     def on_image_scale_changed(self, value):
         self.watermark_settings["image_scale"] = value
         self.lbl_image_scale.setText(f"{value}%")
@@ -1016,6 +1320,12 @@ class WatermarkApp(QMainWindow):
 
     def set_watermark_position(self, position):
         self.watermark_settings["position"] = position
+        # 手动选择位置时关闭自动位置
+        self.chk_auto_position.setChecked(False)
+        self.update_preview()
+
+    def on_auto_position_changed(self, checked):
+        self.watermark_settings["auto_position"] = checked
         self.update_preview()
 
     def on_rotation_changed(self, value):
@@ -1030,6 +1340,7 @@ class WatermarkApp(QMainWindow):
         if folder:
             self.txt_export_folder.setText(folder)
             self.export_settings["folder"] = folder
+        self.schedule_settings_save()
 
     def on_format_changed(self):
         is_png = self.radio_png.isChecked()
@@ -1037,9 +1348,14 @@ class WatermarkApp(QMainWindow):
         self.quality_group.setEnabled(not is_png)
         self.update_preview()
 
+    def on_color_mode_changed(self, index):
+        self.export_settings["color_mode"] = self.combo_color_mode.itemData(index)
+        self.schedule_settings_save()
+
     def on_quality_changed(self, value):
         self.export_settings["quality"] = value
         self.lbl_quality.setText(f"{value}%")
+        self.schedule_settings_save()
 
     def on_naming_changed(self):
         if self.radio_original.isChecked():
@@ -1048,12 +1364,19 @@ class WatermarkApp(QMainWindow):
             self.export_settings["naming"] = "prefix"
         elif self.radio_suffix.isChecked():
             self.export_settings["naming"] = "suffix"
+        self.schedule_settings_save()
+
+    def on_collisions_changed(self, index):
+        self.export_settings["collisions"] = self.combo_collisions.itemData(index)
+        self.schedule_settings_save()
 
     def on_prefix_changed(self, text):
         self.export_settings["prefix"] = text
+        self.schedule_settings_save()
 
     def on_suffix_changed(self, text):
         self.export_settings["suffix"] = text
+        self.schedule_settings_save()
 
     def on_resize_method_changed(self):
         if self.radio_no_resize.isChecked():
@@ -1064,36 +1387,42 @@ class WatermarkApp(QMainWindow):
             self.export_settings["resize_method"] = "height"
         elif self.radio_percent.isChecked():
             self.export_settings["resize_method"] = "percentage"
+        self.schedule_settings_save()
 
     def on_resize_changed(self, value):
         self.export_settings["resize_value"] = value
-
-    def start_drag_watermark(self, event):
-        if self.current_image_index == -1:
-            return
-
-        if event.button() == Qt.MouseButton.LeftButton:
-            self.dragging = True
-            self.drag_start_pos = event.pos()
-
-    def drag_watermark(self, event):
-        if not self.dragging:
-            return
-
-        # 计算相对位置
-        preview_rect = self.watermark_preview.rect()
-        x = event.pos().x() / preview_rect.width()
-        y = event.pos().y() / preview_rect.height()
-
-        # 限制在0-1范围内
-        x = max(0, min(1, x))
-        y = max(0, min(1, y))
-
+        self.schedule_settings_save()
+
+    def on_srcset_changed(self, checked):
+        self.export_settings["srcset"] = checked
+        self.schedule_settings_save()
+
+    def on_srcset_widths_changed(self, text):
+        self.export_settings["srcset_widths"] = text
+        self.schedule_settings_save()
+
+    def on_srcset_pattern_changed(self, text):
+        # 输入过程中不弹窗：无效的模式标红并在提示中说明，导出和预览时拒绝并提示
+        error = srcset_pattern_error(text)
+        self.txt_srcset_pattern.setStyleSheet("color: red;" if error else "")
+        self.txt_srcset_pattern.setToolTip(error or "")
+        self.export_settings["srcset_pattern"] = text
+        self.schedule_settings_save()
+
+    def on_processes_changed(self, value):
+        self.export_settings["processes"] = value
+        self.schedule_settings_save()
+
+    def on_preview_dragged(self, x, y):
+        # 拖动只移动预览中的水印项，不需要重新合成
         self.watermark_settings["position"] = (x, y)
-        self.update_preview()
-
-    def stop_drag_watermark(self, event):
-        self.dragging = False
+        if self.watermark_settings.get("auto_position"):
+            # 信号会刷新整个预览，拖动中只关闭设置、同步勾选框
+            self.watermark_settings["auto_position"] = False
+            self.chk_auto_position.blockSignals(True)
+            self.chk_auto_position.setChecked(False)
+            self.chk_auto_position.blockSignals(False)
+        self.watermark_preview.update_transform(self.watermark_settings)
 
     def on_template_selected(self, item):
             """模板选中时，应用模板的水印设置"""
@@ -1123,7 +1452,10 @@ class WatermarkApp(QMainWindow):
                     except:
                         # 颜色格式错误时使用默认值
                         self.watermark_settings["color"] = (255, 255, 255, 128)
-                    
+
+                    # 取出（或编译）模板的渲染计划，导出时直接使用
+                    self.render_plans.get(self.watermark_settings, persist=True)
+
                     # 更新UI显示
                     self.update_ui_from_settings()
                     # 刷新预览
@@ -1139,7 +1471,8 @@ class WatermarkApp(QMainWindow):
             self.radio_image.setChecked(True)
 
         # 2. 更新文本水印设置
-        self.txt_watermark_text.setText(self.watermark_settings["text"])
+        if self.txt_watermark_text.toPlainText() != self.watermark_settings["text"]:
+            self.txt_watermark_text.setPlainText(self.watermark_settings["text"])
         # 确保字体下拉框显示正确的字体（若字体不存在，显示默认值）
         if self.watermark_settings["font_family"] in self.font_families:
             self.cmb_font.setCurrentText(self.watermark_settings["font_family"])
@@ -1148,6 +1481,14 @@ class WatermarkApp(QMainWindow):
         self.spin_font_size.setValue(self.watermark_settings["font_size"])
         self.chk_bold.setChecked(self.watermark_settings["font_bold"])
         self.chk_italic.setChecked(self.watermark_settings["font_italic"])
+        # 旧模板没有排版设置，使用默认值；先取出再设置控件，控件的信号会回写设置
+        text_align = self.watermark_settings.get("text_align", "left")
+        line_spacing = self.watermark_settings.get("line_spacing", 1.0)
+        max_width = self.watermark_settings.get("max_width", 0)
+        self.cmb_text_align.setCurrentIndex(max(0, self.cmb_text_align.findData(text_align)))
+        self.spin_line_spacing.setValue(line_spacing)
+        self.spin_max_width.setValue(max_width)
+        self.chk_auto_position.setChecked(self.watermark_settings.get("auto_position", False))
 
         # 3. 更新颜色选择按钮的显示
         color = self.watermark_settings["color"]  # (r, g, b, a)
@@ -1160,8 +1501,13 @@ class WatermarkApp(QMainWindow):
         self.lbl_transparency.setText(f"{self.watermark_settings['transparency']}%")
 
         # 5. 更新文本特效（阴影/描边）
-        self.chk_shadow.setChecked(self.watermark_settings["shadow"])
-        self.chk_stroke.setChecked(self.watermark_settings["stroke"])
+        # 先取出再设置勾选框，每个勾选框的信号都会用全部勾选框回写设置
+        shadow = self.watermark_settings["shadow"]
+        stroke = self.watermark_settings["stroke"]
+        adaptive_color = self.watermark_settings.get("adaptive_color", False)
+        self.chk_shadow.setChecked(shadow)
+        self.chk_stroke.setChecked(stroke)
+        self.chk_adaptive_color.setChecked(adaptive_color)
 
         # 6. 更新图片水印设置
         img_path = self.watermark_settings.get("image_path", "")
@@ -1184,6 +1530,12 @@ class WatermarkApp(QMainWindow):
         self.slider_image_scale.setValue(self.watermark_settings["image_scale"])
         self.lbl_image_scale.setText(f"{self.watermark_settings['image_scale']}%")
 
+        # 隐形水印（旧模板没有这两项）；先取出再设置控件，控件的信号会回写设置
+        invisible_id = self.watermark_settings.get("invisible_id", 0)
+        invisible_key = self.watermark_settings.get("invisible_key", "")
+        self.spin_invisible_id.setValue(invisible_id)
+        self.txt_invisible_key.setText(invisible_key)
+
         # 7. 更新旋转角度
         self.slider_rotation.setValue(self.watermark_settings["rotation"])
         self.lbl_rotation.setText(f"{self.watermark_settings['rotation']}°")
@@ -1198,57 +1550,58 @@ class WatermarkApp(QMainWindow):
     def load_last_settings(self):
         """加载用户上次使用的设置"""
         try:
-            # 设置文件存储位置
-            settings_dir = os.path.expanduser("~/.watermark_app")
-            os.makedirs(settings_dir, exist_ok=True)
-            settings_file = os.path.join(settings_dir, "last_settings.json")
-
-            if os.path.exists(settings_file):
-                with open(settings_file, "r", encoding="utf-8") as f:
-                    saved_settings = json.load(f)
-
-                    # 恢复水印设置
-                    if "watermark_settings" in saved_settings:
-                        self.watermark_settings.update(
-                            saved_settings["watermark_settings"]
-                        )
-
-                    # 恢复导出设置
-                    if "export_settings" in saved_settings:
-                        self.export_settings.update(saved_settings["export_settings"])
-                        # 更新导出设置UI
-                        self.txt_export_folder.setText(self.export_settings["folder"])
-                        self.txt_prefix.setText(self.export_settings["prefix"])
-                        self.txt_suffix.setText(self.export_settings["suffix"])
-                        self.slider_quality.setValue(self.export_settings["quality"])
-                        self.lbl_quality.setText(f"{self.export_settings['quality']}%")
-                        self.spin_resize.setValue(self.export_settings["resize_value"])
-
-                        # 恢复格式选择
-                        if self.export_settings["format"] == "jpg":
-                            self.radio_jpg.setChecked(True)
-                            self.quality_group.setEnabled(True)
-                        else:
-                            self.radio_png.setChecked(True)
-                            self.quality_group.setEnabled(False)
-
-                        # 恢复命名规则
-                        if self.export_settings["naming"] == "original":
-                            self.radio_original.setChecked(True)
-                        elif self.export_settings["naming"] == "prefix":
-                            self.radio_prefix.setChecked(True)
-                        else:
-                            self.radio_suffix.setChecked(True)
-
-                        # 恢复缩放方式
-                        if self.export_settings["resize_method"] == "width":
-                            self.radio_width.setChecked(True)
-                        elif self.export_settings["resize_method"] == "height":
-                            self.radio_height.setChecked(True)
-                        elif self.export_settings["resize_method"] == "percentage":
-                            self.radio_percent.setChecked(True)
-                        else:
-                            self.radio_no_resize.setChecked(True)
+            saved_settings = load_json(SETTINGS_FILE)
+            if saved_settings is not None:
+                # 恢复水印设置
+                if "watermark_settings" in saved_settings:
+                    self.watermark_settings.update(
+                        saved_settings["watermark_settings"]
+                    )
+
+                # 恢复导出设置
+                if "export_settings" in saved_settings:
+                    self.export_settings.update(saved_settings["export_settings"])
+                    # 更新导出设置UI
+                    self.txt_export_folder.setText(self.export_settings["folder"])
+                    self.txt_prefix.setText(self.export_settings["prefix"])
+                    self.txt_suffix.setText(self.export_settings["suffix"])
+                    self.slider_quality.setValue(self.export_settings["quality"])
+                    self.lbl_quality.setText(f"{self.export_settings['quality']}%")
+                    self.spin_resize.setValue(self.export_settings["resize_value"])
+                    self.chk_srcset.setChecked(self.export_settings["srcset"])
+                    index = self.combo_color_mode.findData(self.export_settings["color_mode"])
+                    self.combo_color_mode.setCurrentIndex(max(0, index))
+                    self.txt_srcset_widths.setText(self.export_settings["srcset_widths"])
+                    self.txt_srcset_pattern.setText(self.export_settings["srcset_pattern"])
+                    self.spin_processes.setValue(self.export_settings["processes"])
+                    index = self.combo_collisions.findData(self.export_settings["collisions"])
+                    self.combo_collisions.setCurrentIndex(max(0, index))
+
+                    # 恢复格式选择
+                    if self.export_settings["format"] == "jpg":
+                        self.radio_jpg.setChecked(True)
+                        self.quality_group.setEnabled(True)
+                    else:
+                        self.radio_png.setChecked(True)
+                        self.quality_group.setEnabled(False)
+
+                    # 恢复命名规则
+                    if self.export_settings["naming"] == "original":
+                        self.radio_original.setChecked(True)
+                    elif self.export_settings["naming"] == "prefix":
+                        self.radio_prefix.setChecked(True)
+                    else:
+                        self.radio_suffix.setChecked(True)
+
+                    # 恢复缩放方式
+                    if self.export_settings["resize_method"] == "width":
+                        self.radio_width.setChecked(True)
+                    elif self.export_settings["resize_method"] == "height":
+                        self.radio_height.setChecked(True)
+                    elif self.export_settings["resize_method"] == "percentage":
+                        self.radio_percent.setChecked(True)
+                    else:
+                        self.radio_no_resize.setChecked(True)
 
                 # 同步UI与恢复的设置
                 self.update_ui_from_settings()
@@ -1257,22 +1610,24 @@ class WatermarkApp(QMainWindow):
             print(f"加载上次设置失败: {str(e)}")
             # 失败时不影响程序运行，使用默认设置
 
-    def save_last_settings(self):
-        """退出时保存当前设置，供下次使用"""
-        try:
-            settings_dir = os.path.expanduser("~/.watermark_app")
-            os.makedirs(settings_dir, exist_ok=True)
-            settings_file = os.path.join(settings_dir, "last_settings.json")
-
-            # 需要保存的设置
-            settings_to_save = {
-                "watermark_settings": self.watermark_settings,
-                "export_settings": self.export_settings,
-            }
+    def schedule_settings_save(self):
+        """设置变化后延迟保存：频繁修改只在停止修改后写盘一次，崩溃也不会丢失设置"""
+        import copy
 
-            with open(settings_file, "w", encoding="utf-8") as f:
-                json.dump(settings_to_save, f, ensure_ascii=False, indent=2)
+        self.settings_writer.submit(
+            copy.deepcopy(
+                {
+                    "watermark_settings": self.watermark_settings,
+                    "export_settings": self.export_settings,
+                }
+            )
+        )
 
+    def save_last_settings(self):
+        """立即保存当前设置（原子写入），供下次使用"""
+        try:
+            self.schedule_settings_save()
+            self.settings_writer.flush()
         except Exception as e:
             print(f"保存设置失败: {str(e)}")
 
@@ -1282,39 +1637,48 @@ class WatermarkApp(QMainWindow):
         event.accept()
 
     def update_preview(self):
+        # 水印设置的每次修改都会刷新预览，顺便安排一次延迟保存
+        self.schedule_settings_save()
+
         if self.current_image_index == -1:
             return
 
-        # 获取当前图片
-        current_image = self.images[self.current_image_index]["image"].copy()
-
-        # 应用水印
-        watermarked_image = self.apply_watermark(current_image)
-
-        # 转换为QPixmap并显示
-        q_image = ImageQt.ImageQt(watermarked_image)
-        pixmap = QPixmap.fromImage(q_image)
-
-        # 关键修改：使用当前预览窗口的大小进行缩放
-        # 移除固定大小设置，改为使用当前窗口尺寸
-        scaled_pixmap = pixmap.scaled(
-            self.watermark_preview.width(),  # 使用当前宽度
-            self.watermark_preview.height(), # 使用当前高度
-            Qt.AspectRatioMode.KeepAspectRatio,
-            Qt.TransformationMode.SmoothTransformation,
+        # 底图按路径缓存，只在切换图片时生成一次；
+        # 水印精灵只在外观设置变化时重新生成，位置、旋转和透明度只是图形项变换
+        img_data = self.images[self.current_image_index]
+        self.watermark_preview.set_base_image(img_data["image"], img_data["path"])
+        settings = self.watermark_settings
+        if settings.get("auto_position"):
+            # 预览显示导出时自动选择的位置；细节分布按图片只计算一次
+            from watermark_app.placement import DetailMap
+
+            if self.detail_map is None or self.detail_map[0] != img_data["path"]:
+                self.detail_map = (img_data["path"], DetailMap(img_data["image"]))
+            plan = self.render_plans.for_image(
+                settings, img_data["path"], self.current_image_index + 1
+            )
+            position = plan.auto_position(img_data["image"], self.detail_map[1])
+            settings = dict(settings, position=position)
+        if settings.get("adaptive_color") and settings["type"] == "text":
+            # 预览显示这张图片自动选择的颜色和描边（只统计水印下方的区域）
+            plan = self.render_plans.for_image(
+                settings, img_data["path"], self.current_image_index + 1
+            )
+            settings = dict(settings, **plan.adaptive_style(img_data["image"]))
+        self.watermark_preview.set_watermark(
+            settings, img_data["path"], self.current_image_index + 1
         )
 
-        self.watermark_preview.setPixmap(scaled_pixmap)
-        
-    def apply_watermark(self, image):
-        # 创建一个副本以避免修改原图
-        img = image.copy()
+        # 字体无法加载时提示一次
+        watermarker = self.watermark_preview.watermarker
+        if watermarker is not None:
+            self.check_font_fallback(watermarker, self.watermark_settings["font_family"])
 
-        # 根据水印类型应用不同的处理
-        if self.watermark_settings["type"] == "text":
-            return self.apply_text_watermark(img)
-        else:
-            return self.apply_image_watermark(img)
+    def check_font_fallback(self, plan, font_family):
+        """渲染计划退回到默认字体时提示一次"""
+        if plan.font_fallback and self.warned_font != font_family:
+            self.warned_font = font_family
+            self.show_font_fallback_warning(font_family)
 
     def get_available_fonts(self):
         """获取系统中Pillow可实际加载的字体列表（过滤无效字体）"""
@@ -1349,288 +1713,12 @@ class WatermarkApp(QMainWindow):
 
         return available_fonts
 
-    def apply_text_watermark(self, image):
-        # 导入必要模块
-        from PIL import ImageDraw, ImageFont
-        import glob
-
-        # 1. 创建水印绘制图层
-        watermark_layer = Image.new("RGBA", image.size, (0, 0, 0, 0))
-        draw = ImageDraw.Draw(watermark_layer)
-
-        # 2. 获取当前水印配置参数
-        text = self.watermark_settings["text"]
-        font_family = self.watermark_settings["font_family"]
-        font_size = self.watermark_settings["font_size"]
-        is_bold = self.watermark_settings["font_bold"]
-        is_italic = self.watermark_settings["font_italic"]
-        color = self.watermark_settings["color"]
-        rotation = self.watermark_settings["rotation"]
-        shadow_enabled = self.watermark_settings["shadow"]
-        stroke_enabled = self.watermark_settings["stroke"]
-
-        # 修复：确保文本是Unicode字符串
-        if isinstance(text, str):
-            # 对于包含非ASCII字符（如中文）的文本，确保正确处理
-            pass
-        else:
-            # 转换为Unicode字符串
-            text = str(text, encoding="utf-8")
-
-        # 3. 核心逻辑：加载字体
-        font = None
-        font_path = None
-        windows_font_dir = "C:/Windows/Fonts/"  # Windows系统默认字体目录
-
-        # 3.1 中文常见字体映射表
-        chinese_font_map = {
-            "SimHei": "simhei.ttf",  # 黑体（常规）
-            "Microsoft YaHei": "msyh.ttc",  # 微软雅黑
-            "SimSun": "simsun.ttc",  # 宋体
-            "KaiTi": "simkai.ttf",  # 楷体
-            "Arial": "arial.ttf",  # Arial
-            "Arial Bold": "arialbd.ttf",  # Arial粗体
-            "Times New Roman": "times.ttf",  # Times New Roman
-        }
-
-        # 3.2 优先使用映射表加载字体
-        if font_family in chinese_font_map:
-            target_font_file = chinese_font_map[font_family]
-            font_path = os.path.join(windows_font_dir, target_font_file)
-
-            if os.path.exists(font_path):
-                try:
-                    # 处理TTF集合文件（.ttc）的样式索引
-                    if font_path.endswith(".ttc"):
-                        if is_bold and is_italic:
-                            font = ImageFont.truetype(
-                                font_path, font_size, index=3, encoding="utf-8"
-                            )
-                        elif is_bold:
-                            font = ImageFont.truetype(
-                                font_path, font_size, index=1, encoding="utf-8"
-                            )
-                        elif is_italic:
-                            font = ImageFont.truetype(
-                                font_path, font_size, index=2, encoding="utf-8"
-                            )
-                        else:
-                            font = ImageFont.truetype(
-                                font_path, font_size, index=0, encoding="utf-8"
-                            )
-                    else:
-                        if is_bold and f"{font_family} Bold" in chinese_font_map:
-                            bold_font_file = chinese_font_map[f"{font_family} Bold"]
-                            bold_font_path = os.path.join(
-                                windows_font_dir, bold_font_file
-                            )
-                            if os.path.exists(bold_font_path):
-                                font = ImageFont.truetype(
-                                    bold_font_path, font_size, encoding="utf-8"
-                                )
-                            else:
-                                font = ImageFont.truetype(
-                                    font_path, font_size, encoding="utf-8"
-                                )
-                        else:
-                            font = ImageFont.truetype(
-                                font_path, font_size, encoding="utf-8"
-                            )
-
-                    print(f"✅ 成功加载字体：{font_family}，路径：{font_path}")
-
-                except Exception as e:
-                    print(f"❌ 加载映射字体失败：{str(e)}，尝试搜索方式加载")
-
-        # 3.3 若映射表未命中，搜索字体目录
-        if not font:
-            search_keyword = font_family
-            if is_bold and is_italic:
-                search_keyword += " Bold Italic"
-            elif is_bold:
-                search_keyword += " Bold"
-            elif is_italic:
-                search_keyword += " Italic"
-
-            matched_files = []
-            for ext in [".ttf", ".ttc", ".otf"]:
-                search_pattern = os.path.join(
-                    windows_font_dir, f"*{search_keyword}*{ext}"
-                )
-                matched_files = glob.glob(search_pattern, recursive=False)
-
-                if not matched_files:
-                    search_pattern_lower = os.path.join(
-                        windows_font_dir, f"*{search_keyword.lower()}*{ext}"
-                    )
-                    matched_files = glob.glob(search_pattern_lower, recursive=False)
-
-                if matched_files:
-                    font_path = matched_files[0]
-                    break
-
-            if matched_files:
-                try:
-                    # 关键修复：明确指定编码为utf-8
-                    font = ImageFont.truetype(font_path, font_size, encoding="utf-8")
-                    print(f"✅ 成功搜索并加载字体：{font_path}")
-                except Exception as e:
-                    print(f"❌ 加载搜索到的字体失败：{str(e)}")
-
-        # 3.4 兜底方案
-        if not font:
-            # 尝试加载默认中文字体
-            try:
-                font = ImageFont.truetype("simhei.ttf", font_size, encoding="utf-8")
-                print(f"⚠️ 使用系统默认中文字体")
-            except:
-                font = ImageFont.load_default()
-                QMessageBox.warning(
-                    self,
-                    "字体加载失败",
-                    f"当前选择的字体「{font_family}」无法加载，已自动切换为默认字体。\n建议选择以下系统自带字体：\n• SimHei（黑体）\n• Microsoft YaHei（微软雅黑）\n• SimSun（宋体）",
-                )
-                print(f"⚠️ 所有字体加载方式失败，使用Pillow默认字体")
-
-        # 4. 计算文本尺寸（修复中文尺寸计算问题）
-        try:
-            # 尝试使用textbbox计算（Pillow 8.0+）
-            bbox = draw.textbbox((0, 0), text, font=font)
-            text_width = bbox[2] - bbox[0]
-            text_height = bbox[3] - bbox[1]
-        except Exception as e:
-            # 兼容旧版本Pillow
-            print(f"使用textbbox失败，尝试textsize: {e}")
-            text_width, text_height = draw.textsize(text, font=font)
-
-        # 5. 计算水印位置
-        img_width, img_height = image.size
-        x = (img_width - text_width) * self.watermark_settings["position"][0]
-        y = (img_height - text_height) * self.watermark_settings["position"][1]
-
-        # 6. 绘制水印
-        if rotation != 0:
-            text_layer = Image.new("RGBA", (text_width, text_height), (0, 0, 0, 0))
-            text_draw = ImageDraw.Draw(text_layer)
-
-            if shadow_enabled:
-                shadow_color = (0, 0, 0, int(color[3] * 0.5))
-                text_draw.text((2, 2), text, font=font, fill=shadow_color)
-
-            if stroke_enabled:
-                stroke_width = 2
-                for dx in [-stroke_width, 0, stroke_width]:
-                    for dy in [-stroke_width, 0, stroke_width]:
-                        if dx != 0 or dy != 0:
-                            text_draw.text(
-                                (dx, dy), text, font=font, fill=(0, 0, 0, color[3])
-                            )
-
-            text_draw.text((0, 0), text, font=font, fill=color)
-
-            rotated_text = text_layer.rotate(
-                rotation, expand=True, resample=Image.Resampling.BICUBIC
-            )
-
-            rotated_width, rotated_height = rotated_text.size
-            x = x - (rotated_width - text_width) / 2
-            y = y - (rotated_height - text_height) / 2
-
-            watermark_layer.paste(rotated_text, (int(x), int(y)), rotated_text)
-
-        else:
-            if shadow_enabled:
-                draw.text(
-                    (x + 2, y + 2), text, font=font, fill=(0, 0, 0, int(color[3] * 0.5))
-                )
-
-            if stroke_enabled:
-                stroke_width = 2
-                for dx in [-stroke_width, 0, stroke_width]:
-                    for dy in [-stroke_width, 0, stroke_width]:
-                        if dx != 0 or dy != 0:
-                            draw.text(
-                                (x + dx, y + dy),
-                                text,
-                                font=font,
-                                fill=(0, 0, 0, color[3]),
-                            )
-
-            draw.text((x, y), text, font=font, fill=color)
-
-        # 7. 合并水印图层到原图
-        return Image.alpha_composite(image, watermark_layer)
-
-    def apply_image_watermark(self, image):
-        """应用图片水印到原图"""
-        # 创建原图副本
-        img = image.copy()
-
-        # 获取水印图片路径
-        watermark_path = self.watermark_settings.get("image_path", "")
-        if not watermark_path or not os.path.exists(watermark_path):
-            return img  # 没有有效水印图片时返回原图
-
-        try:
-            # 打开水印图片
-            with Image.open(watermark_path) as watermark_img:
-                # 转换为RGBA以支持透明
-                if watermark_img.mode not in ("RGBA", "LA"):
-                    watermark_img = watermark_img.convert("RGBA")
-
-                # 根据设置调整水印大小
-                scale = self.watermark_settings["image_scale"] / 100.0
-                new_width = int(watermark_img.width * scale)
-                new_height = int(watermark_img.height * scale)
-
-                # 确保水印尺寸有效
-                new_width = max(10, new_width)
-                new_height = max(10, new_height)
-
-                # 调整水印大小（高质量缩放）
-                watermark_resized = watermark_img.resize(
-                    (new_width, new_height), Image.Resampling.LANCZOS
-                )
-
-                # 调整水印透明度
-                transparency = self.watermark_settings["transparency"]
-                alpha = watermark_resized.split()[3]  # 获取Alpha通道
-                alpha = ImageEnhance.Brightness(alpha).enhance(transparency / 100.0)
-                watermark_resized.putalpha(alpha)
-
-                # 处理旋转
-                rotation = self.watermark_settings["rotation"]
-                if rotation != 0:
-                    watermark_rotated = watermark_resized.rotate(
-                        rotation, expand=True, resample=Image.Resampling.BICUBIC
-                    )
-                else:
-                    watermark_rotated = watermark_resized
-
-                # 计算水印位置
-                img_width, img_height = img.size
-                wm_width, wm_height = watermark_rotated.size
-
-                # 根据相对位置计算绝对坐标
-                x = int((img_width - wm_width) * self.watermark_settings["position"][0])
-                y = int(
-                    (img_height - wm_height) * self.watermark_settings["position"][1]
-                )
-
-                # 确保水印位置在图片范围内
-                x = max(0, min(x, img_width - wm_width))
-                y = max(0, min(y, img_height - wm_height))
-
-                # 创建水印图层并合并
-                watermark_layer = Image.new("RGBA", img.size, (0, 0, 0, 0))
-                watermark_layer.paste(watermark_rotated, (x, y), watermark_rotated)
-
-                return Image.alpha_composite(img, watermark_layer)
-
-        except Exception as e:
-            print(f"应用图片水印失败: {str(e)}")
-            QMessageBox.warning(self, "错误", f"无法应用图片水印: {str(e)}")
-            return img
+    def show_font_fallback_warning(self, font_family):
+        QMessageBox.warning(
+            self,
+            "字体加载失败",
+            f"当前选择的字体「{font_family}」无法加载，已自动切换为默认字体。\n建议选择以下系统自带字体：\n• SimHei（黑体）\n• Microsoft YaHei（微软雅黑）\n• SimSun（宋体）",
+        )
 
 
 if __name__ == "__main__":
@@ -1,4 +1,95 @@
-from .gui import run_app
+import os
+import subprocess
+import sys
+
+# 无界面路径（HTTP 服务、监视文件夹）用到的模块
+HEADLESS_MODULES = ("watermark_app.server", "watermark_app.watch")
+
+# 无界面路径的导入时间预算（毫秒），由 `python -m watermark_app importtime` 检查
+IMPORT_BUDGET_MS = 150
+
+# 无界面路径启动时不应导入的重量级模块（NumPy 只在处理高位深图片时按需导入）
+HEAVY_MODULES = ("PyQt6", "PySide6", "PIL.ImageQt", "numpy")
+
+
+def measure_import_time(modules=HEADLESS_MODULES):
+    """
+    在新的解释器中用 -X importtime 测量导入时间。
+    :param modules: 要导入的模块
+    :return: (总毫秒数, {模块名: 累计毫秒数})，后者包含所有被间接导入的模块
+    """
+    env = dict(os.environ)
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [package_root, env.get("PYTHONPATH")]))
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import " + ", ".join(modules)],
+        capture_output=True,
+        text=True,
+        env=env,
+        check=True,
+    )
+
+    total_us = 0
+    cumulative = {}
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or line.count("|") != 2:
+            continue
+        _, cumulative_us, name = line.split("|")
+        if not cumulative_us.strip().isdigit():
+            continue  # 表头
+        cumulative[name.strip()] = int(cumulative_us) / 1000
+        # 只累加 -c 中直接导入的顶层模块，间接导入的已包含在其中
+        if name.startswith(" watermark_app"):
+            total_us += int(cumulative_us)
+    return total_us / 1000, cumulative
+
+
+def check_import_time(argv):
+    """
+    检查无界面路径的导入时间预算。
+    :param argv: [预算毫秒数]，缺省为 IMPORT_BUDGET_MS
+    :return: 退出码，超出预算或导入了重量级模块时为 1
+    """
+    budget = float(argv[0]) if argv else IMPORT_BUDGET_MS
+    total, cumulative = measure_import_time()
+    slowest = sorted(cumulative.items(), key=lambda item: item[1], reverse=True)[:10]
+    for name, ms in slowest:
+        print(f"{ms:8.1f} ms  {name}")
+    print(f"无界面路径导入用时 {total:.1f} ms（预算 {budget:.0f} ms）")
+
+    heavy = sorted(
+        name for name in cumulative
+        if any(name == m or name.startswith(m + ".") for m in HEAVY_MODULES)
+    )
+    if heavy:
+        print(f"无界面路径导入了不应导入的模块: {', '.join(heavy)}")
+        return 1
+    return 1 if total > budget else 0
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] == "serve":
+        from .server import main as serve_main
+
+        return serve_main(argv[1:])
+    if argv and argv[0] == "watch":
+        from .watch import main as watch_main
+
+        return watch_main(argv[1:])
+    if argv and argv[0] == "detect":
+        from .invisible import main as detect_main
+
+        return detect_main(argv[1:])
+    if argv and argv[0] == "importtime":
+        return check_import_time(argv[1:])
+
+    # Qt 只在真正打开窗口时导入
+    from .gui import run_app
 
-if __name__ == "__main__":
     run_app()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
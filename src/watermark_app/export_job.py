@@ -0,0 +1,366 @@
+import io
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+
+from .image_io import make_srcset, resize_image, save_image, to_display
+
+# 流水线导出时预读的源文件数，也是渲染领先写盘的任务数
+READ_AHEAD = 4
+
+# 预读和写盘各自的 I/O 线程数
+IO_THREADS = 2
+
+# 写后队列中等待写盘的编码结果总字节数上限，超过时渲染等待写盘
+WRITE_BEHIND_BYTES = 256 * 1024 * 1024
+
+# 一条导出失败记录：task 为原始任务，可直接用于重试
+ExportError = namedtuple("ExportError", ["task", "label", "message"])
+
+# 进度快照
+ExportProgress = namedtuple(
+    "ExportProgress",
+    [
+        "done",  # 已处理的任务数（含失败）
+        "total",  # 任务总数
+        "failed",  # 失败的任务数
+        "elapsed",  # 已用秒数
+        "images_per_second",
+        "mb_per_second",  # 按原图字节数计算
+        "eta",  # 预计剩余秒数，还无法估计时为 None
+        "current",  # 刚处理完的任务描述
+    ],
+)
+
+
+# 一个导出目标的全部参数，只含可序列化的值，可以交给其他进程执行
+ExportSpec = namedtuple(
+    "ExportSpec",
+    [
+        "settings",  # 水印设置
+        "path",  # 原图路径，用于展开占位符
+        "sequence",  # 图片序号
+        "method",  # 缩放方式
+        "value",  # 缩放值
+        "output_path",  # 输出文件路径
+        "format",  # 输出格式 "png"/"jpg"
+        "quality",  # JPEG 质量
+        "mode",  # 输出模式，None 表示保持原图模式
+        "srcset_widths",  # 多尺寸导出的宽度列表，None 表示只导出一张
+        "srcset_pattern",  # 多尺寸文件名，{name} 为按命名规则生成的文件名
+    ],
+)
+
+
+def srcset_path(output_path, pattern, width):
+    """多尺寸导出时某个宽度的输出路径"""
+    directory, name = os.path.split(output_path)
+    base, ext = os.path.splitext(name)
+    return os.path.join(directory, pattern.format(name=base, width=width) + ext)
+
+
+def srcset_pattern_error(pattern):
+    """
+    检查多尺寸文件名模式：只能使用 {name} 和 {width}，并且不同宽度必须得到不同的文件名。
+    :return: 错误信息，模式有效时为 None
+    """
+    try:
+        names = {pattern.format(name="a", width=width) for width in (320, 640)}
+    except (ValueError, KeyError, IndexError, AttributeError, TypeError) as e:
+        return f"多尺寸文件名模式无效: {pattern}（{e}）"
+    if len(names) != 2:
+        return f"多尺寸文件名模式必须包含 {{width}}: {pattern}"
+    return None
+
+
+def render_export(image, spec, plans, writer=None):
+    """
+    导出一张图片：水印 -> 转正 -> 缩放（或多尺寸） -> 隐形水印 -> 保存。
+    :param image: 可写的工作图像（working_copy 或共享内存中的帧），会被原地修改
+    :param spec: ExportSpec
+    :param plans: 渲染计划缓存
+    :param writer: WriteBehind，给出时只在内存中编码，写盘交给写后队列
+    :return: 写后队列返回的 Future 列表，没有 writer 时为空
+    """
+    writes = []
+
+    def save(image, output_path):
+        if writer is None:
+            save_image(image, output_path, spec.format, quality=spec.quality, mode=spec.mode)
+            return
+        buffer = io.BytesIO()
+        save_image(image, buffer, spec.format, quality=spec.quality, mode=spec.mode)
+        writes.append(writer.write(output_path, buffer.getbuffer()))
+
+    # 水印文本含占位符时按这张图片展开；展开结果相同的图片共享同一个水印图层
+    plan = plans.for_image(spec.settings, spec.path, spec.sequence)
+    # 隐形水印在缩放之后、保存之前按最终尺寸嵌入
+    image = plan.apply(image, invisible=False)
+
+    # 带 EXIF 方向的图片直接输出 JPEG 时保留原方向和方向标签，不做整幅变换；
+    # 之后还要缩放或输出 PNG 时才把像素转正
+    if spec.srcset_widths or spec.method != "none" or spec.format != "jpg":
+        image = to_display(image)
+
+    if spec.srcset_widths:
+        # 多尺寸：每个宽度由上一个较大的尺寸缩小得到
+        for width, variant in make_srcset(image, spec.srcset_widths):
+            if plan.settings["invisible_id"]:
+                # 下一个宽度由这一级缩小得到，嵌入在副本上进行
+                variant = plan.embed_invisible(variant.copy())
+            save(variant, srcset_path(spec.output_path, spec.srcset_pattern, width))
+        return writes
+
+    image = resize_image(image, spec.method, spec.value)
+    save(plan.embed_invisible(image), spec.output_path)
+    return writes
+
+
+def when_all(futures):
+    """
+    等待一组 Future 的 Future：全部完成时完成，其中一个失败时以它的异常失败。
+    :param futures: Future 列表，可以为空
+    """
+    result = Future()
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def on_done(future):
+        with lock:
+            remaining[0] -= 1
+            if result.done():
+                return
+            if future.exception() is not None:
+                result.set_exception(future.exception())
+            elif remaining[0] == 0:
+                result.set_result(None)
+
+    if not futures:
+        result.set_result(None)
+    for future in futures:
+        future.add_done_callback(on_done)
+    return result
+
+
+class ReadAhead:
+    """
+    预读：在 I/O 线程中提前顺序读取接下来的几个源文件，读入系统文件缓存。
+    处理到某个文件时它的字节通常已在内存中，网络共享上也不必在渲染时等待读盘。
+    读取的内容不在进程中保留，内存占用与预读的文件数无关。
+    """
+
+    def __init__(self, paths, depth=READ_AHEAD, chunk_size=1024 * 1024):
+        """
+        :param paths: 按处理顺序排列的文件路径，重复的路径只读一次
+        :param depth: 预读的文件数
+        :param chunk_size: 每次读取的字节数
+        """
+        self.paths = list(dict.fromkeys(paths))
+        self.depth = depth
+        self.chunk_size = chunk_size
+        self._index = {path: i for i, path in enumerate(self.paths)}
+        self._futures = {}  # 路径 -> 预读的 Future
+        self._next = 0  # 下一个要提交预读的序号
+        self._pool = ThreadPoolExecutor(max_workers=IO_THREADS, thread_name_prefix="read-ahead")
+
+    def wait(self, path):
+        """
+        等待文件读入缓存，并把预读窗口推进到它之后的 depth 个文件。
+        读取失败时直接返回，由真正的读取报告错误。
+        """
+        index = self._index.get(path)
+        if index is None:
+            return
+        self._fill(index + 1 + self.depth)
+        future = self._futures.pop(path, None)
+        if future is not None:
+            future.exception()
+
+    def _fill(self, end):
+        end = min(end, len(self.paths))
+        while self._next < end:
+            path = self.paths[self._next]
+            self._futures[path] = self._pool.submit(self._read, path)
+            self._next += 1
+
+    def _read(self, path):
+        buffer = bytearray(self.chunk_size)
+        with open(path, "rb", buffering=0) as f:
+            while f.readinto(buffer):
+                pass
+
+    def close(self):
+        """取消尚未开始的预读"""
+        self._pool.shutdown(wait=True, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class WriteBehind:
+    """
+    写后队列：渲染线程只负责在内存中编码，写盘在 I/O 线程中进行，
+    下一张图片的渲染与上一张的写盘同时进行。
+    每个文件先写入 .part 临时文件再替换，中途退出不会留下半个文件。
+    等待写盘的字节数超过上限时 write() 阻塞，内存占用有上限。
+    """
+
+    def __init__(self, workers=IO_THREADS, max_bytes=WRITE_BEHIND_BYTES):
+        """
+        :param workers: 写盘线程数
+        :param max_bytes: 等待写盘的编码结果总字节数上限
+        """
+        self.max_bytes = max_bytes
+        self._pending = 0
+        self._cond = threading.Condition()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="write-behind")
+
+    def write(self, path, data):
+        """
+        把编码好的字节排入写盘队列。
+        :param path: 输出文件路径
+        :param data: bytes 或 memoryview，写完之前不能修改
+        :return: Future，结果为输出路径，写盘失败时带有异常
+        """
+        size = len(data)
+        with self._cond:
+            # 单个结果超过上限时也可以写入，只是要等前面的都写完
+            self._cond.wait_for(lambda: not self._pending or self._pending + size <= self.max_bytes)
+            self._pending += size
+        return self._pool.submit(self._write, path, data, size)
+
+    def _write(self, path, data, size):
+        tmp_path = path + ".part"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        finally:
+            with self._cond:
+                self._pending -= size
+                self._cond.notify_all()
+        return path
+
+    def close(self):
+        """等待队列中的文件全部写完"""
+        self._pool.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ExportJob:
+    """
+    长时间导出任务。
+    由 run_parallel 按顺序提交任务（交给进程池或导出流水线），每个任务完成后报告进度、吞吐量和预计剩余时间；
+    cancel() 之后不再提交新任务（协作式取消）；
+    失败的任务记录为 ExportError，可以只重试这些任务。
+    不依赖 Qt，界面在进度回调中刷新。
+    """
+
+    def __init__(self, tasks, label=str, size_of=None):
+        """
+        :param tasks: 任务列表
+        :param label: 任务的显示名称
+        :param size_of: 任务的输入字节数，用于计算 MB/s，None 表示不统计
+        """
+        self.tasks = list(tasks)
+        self.label = label
+        self.size_of = size_of
+        self.errors = []
+        self.done = 0
+        self.succeeded = 0
+        self.bytes_done = 0
+        self.cancelled = False
+        self._start = None
+
+    def cancel(self):
+        """请求取消，当前任务完成后停止"""
+        self.cancelled = True
+
+    def run_parallel(self, submit, max_pending, on_progress=None, poll=0.1):
+        """
+        并行执行全部任务：按顺序提交，同时进行的任务不超过 max_pending 个。
+        进度按完成顺序报告；取消后不再提交新任务，已提交的任务照常完成并计入结果。
+        :param submit: 提交单个任务的函数，返回 concurrent.futures.Future；直接抛出异常时记为失败
+        :param max_pending: 同时进行的任务数上限
+        :param on_progress: 每个任务完成后以 ExportProgress 调用
+        :param poll: 等待任务完成的超时秒数
+        :return: self
+        """
+        self._start = time.perf_counter()
+        tasks = iter(self.tasks)
+        pending = {}  # future -> 任务
+        while True:
+            while not self.cancelled and len(pending) < max_pending:
+                task = next(tasks, None)
+                if task is None:
+                    break
+                try:
+                    pending[submit(task)] = task
+                except Exception as e:
+                    self._finish(task, e, on_progress)
+            if not pending:
+                break
+            done, _ = wait(pending, timeout=poll, return_when=FIRST_COMPLETED)
+            for future in done:
+                self._finish(pending.pop(future), future.exception(), on_progress)
+        return self
+
+    def _finish(self, task, error, on_progress):
+        """记录一个任务的结果并报告进度"""
+        label = self.label(task)
+        if error is None:
+            self.succeeded += 1
+        else:
+            self.errors.append(ExportError(task, label, str(error)))
+        self.done += 1
+        if self.size_of is not None:
+            try:
+                self.bytes_done += self.size_of(task)
+            except OSError:
+                pass
+        if on_progress is not None:
+            on_progress(self.progress(label))
+
+    def progress(self, current=None):
+        """当前的进度快照"""
+        total = len(self.tasks)
+        elapsed = time.perf_counter() - self._start if self._start is not None else 0.0
+        if elapsed > 0 and self.done:
+            images_per_second = self.done / elapsed
+            mb_per_second = self.bytes_done / elapsed / (1024 * 1024)
+            eta = (total - self.done) / images_per_second
+        else:
+            images_per_second = mb_per_second = 0.0
+            eta = None
+        return ExportProgress(
+            self.done,
+            total,
+            len(self.errors),
+            elapsed,
+            images_per_second,
+            mb_per_second,
+            eta,
+            current,
+        )
+
+    def remaining_tasks(self):
+        """因取消而没有执行的任务"""
+        return self.tasks[self.done:]
+
+    def failed_tasks(self):
+        """失败的任务，用于重试"""
+        return [error.task for error in self.errors]
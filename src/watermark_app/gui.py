@@ -2,20 +2,27 @@ from __future__ import annotations
 import os
 from pathlib import Path
 from typing import List, Optional
-from PyQt6.QtCore import Qt, QSize, QRectF, pyqtSignal
-from PyQt6.QtGui import QIcon, QPixmap, QColor, QImage
+from PyQt6.QtCore import Qt, QSize, pyqtSignal
+from PyQt6.QtGui import QIcon, QColor
 from PyQt6.QtWidgets import (
     QApplication, QFileDialog, QListWidget, QListWidgetItem,
     QMainWindow, QToolBar, QMessageBox, QWidget, QVBoxLayout, QLabel,
     QPushButton, QColorDialog, QSlider, QLineEdit, QHBoxLayout, QStatusBar,
-    QGraphicsScene, QGraphicsView, QGraphicsPixmapItem,
     QSpinBox, QComboBox
 )
-from PIL import Image, ImageQt, ImageDraw, ImageFont
+from PIL import Image
+
+from .image_io import close_image, display_size, open_image, save_image, to_display, working_copy
+from .output_plan import OutputPlan
+from .preview import WatermarkPreview
+from .watermark_core import DEFAULT_SETTINGS, render_plans
 
 
 SUPPORTED_EXTS = {".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff"}
 
+# 命名规则下拉框 -> 导出设置中的命名规则
+NAMING_MODES = {"保留原文件名": "original", "添加前缀": "prefix", "添加后缀": "suffix"}
+
 
 def is_image_file(p: Path) -> bool:
     return p.is_file() and p.suffix.lower() in SUPPORTED_EXTS
@@ -36,34 +43,6 @@ class ThumbList(QListWidget):
         self.imageSelected.emit(item.data(Qt.ItemDataRole.UserRole))
 
 
-class PreviewArea(QGraphicsView):
-    def __init__(self, parent=None):
-        super().__init__(parent)
-        self._scene = QGraphicsScene(self)
-        self.setScene(self._scene)
-        self.image_item: Optional[QGraphicsPixmapItem] = None
-        self.current_image: Optional[Image.Image] = None  # 用于导出保存
-
-    def load_image(self, img_path: str):
-        self._scene.clear()
-        pixmap = QPixmap(img_path)
-        if pixmap.isNull():
-            return
-        self.image_item = self._scene.addPixmap(pixmap)
-        self._scene.setSceneRect(QRectF(pixmap.rect()))
-        self.fitInView(self._scene.sceneRect(), Qt.AspectRatioMode.KeepAspectRatio)
-        self.current_image = Image.open(img_path).convert("RGBA")
-
-    def show_composite(self, pil_image: Image.Image):
-        self.current_image = pil_image
-        qimage = ImageQt.ImageQt(pil_image.convert("RGBA"))
-        pixmap = QPixmap.fromImage(QImage(qimage))
-        self._scene.clear()
-        self.image_item = self._scene.addPixmap(pixmap)
-        self._scene.setSceneRect(QRectF(pixmap.rect()))
-        self.fitInView(self._scene.sceneRect(), Qt.AspectRatioMode.KeepAspectRatio)
-
-
 class MainWindow(QMainWindow):
     def __init__(self):
         super().__init__()
@@ -71,7 +50,7 @@ class MainWindow(QMainWindow):
         self.resize(1300, 820)
 
         self.thumb_list = ThumbList(self)
-        self.preview = PreviewArea(self)
+        self.preview = WatermarkPreview(self)
         self.status = QStatusBar(self)
         self.setStatusBar(self.status)
 
@@ -95,7 +74,7 @@ class MainWindow(QMainWindow):
         self.format_combo = QComboBox()
         self.format_combo.addItems(["PNG", "JPEG"])
         self.naming_mode = QComboBox()
-        self.naming_mode.addItems(["保留原文件名", "添加前缀", "添加后缀"])
+        self.naming_mode.addItems(list(NAMING_MODES))
         self.prefix_input = QLineEdit("wm_")
         self.suffix_input = QLineEdit("_watermarked")
         self.export_btn = QPushButton("导出水印图片")
@@ -171,8 +150,13 @@ class MainWindow(QMainWindow):
         self.choose_output_btn.clicked.connect(self.choose_output_dir)
         self.export_btn.clicked.connect(self.export_image)
 
+        self.preview.positionChanged.connect(self.on_preview_dragged)
+
         self.watermark_img_path = None
         self.current_img_path = None
+        self.current_image: Optional[Image.Image] = None
+        # 与主程序格式相同的水印设置，预览和导出都交给同一个渲染引擎
+        self.watermark_settings: Optional[dict] = None
         self.update_status()
 
     # === 文件导入 ===
@@ -211,8 +195,24 @@ class MainWindow(QMainWindow):
 
     # === 预览 ===
     def show_preview(self, path: str):
+        try:
+            image = open_image(path)
+        except Exception as e:
+            QMessageBox.warning(self, "错误", f"无法打开图片: {e}")
+            return
+        previous, self.current_image = self.current_image, image
         self.current_img_path = path
-        self.preview.load_image(path)
+        self.preview.set_base_image(image, path)
+        if previous is not None:
+            close_image(previous)
+        if self.watermark_settings is not None:
+            self.preview.set_watermark(self.watermark_settings, path)
+
+    def on_preview_dragged(self, x: float, y: float):
+        if self.watermark_settings is None:
+            return
+        self.watermark_settings["position"] = (x, y)
+        self.preview.update_transform(self.watermark_settings)
 
     # === 控件操作 ===
     def choose_color(self):
@@ -244,19 +244,18 @@ class MainWindow(QMainWindow):
             QMessageBox.warning(self, "提示", "请输入水印文本")
             return
 
-        font_size = self.font_size_spin.value()
-        try:
-            font = ImageFont.truetype("arial.ttf", font_size)
-        except:
-            font = ImageFont.load_default()
-
-        base = Image.open(self.current_img_path).convert("RGBA")
-        overlay = Image.new("RGBA", base.size, (0, 0, 0, 0))
-        draw = ImageDraw.Draw(overlay)
         alpha = int(self.alpha_slider.value() * 2.55)
-        draw.text((40, 40), text, fill=self.color.getRgb()[:3] + (alpha,), font=font)
-        combined = Image.alpha_composite(base, overlay)
-        self.preview.show_composite(combined)
+        self.watermark_settings = dict(
+            DEFAULT_SETTINGS,
+            type="text",
+            text=text,
+            font_family="Arial",
+            font_size=self.font_size_spin.value(),
+            color=self.color.getRgb()[:3] + (alpha,),
+            position=(0.0, 0.0),
+            margin=40,
+        )
+        self.preview.set_watermark(self.watermark_settings, self.current_img_path)
 
     # === 应用图片水印 ===
     def apply_image(self):
@@ -264,21 +263,23 @@ class MainWindow(QMainWindow):
             QMessageBox.warning(self, "提示", "请先选择图片和水印文件")
             return
 
-        base = Image.open(self.current_img_path).convert("RGBA")
-        watermark = Image.open(self.watermark_img_path).convert("RGBA")
-        scale = 0.3
-        w = int(base.width * scale)
-        h = int(watermark.height * (w / watermark.width))
-        watermark = watermark.resize((w, h))
-        alpha_val = int(self.alpha_slider.value() * 2.55)
-        watermark.putalpha(alpha_val)
-        pos = (base.width - watermark.width - 20, base.height - watermark.height - 20)
-        base.paste(watermark, pos, watermark)
-        self.preview.show_composite(base)
+        # 水印宽度为原图（按 EXIF 方向转正后）宽度的 30%
+        with Image.open(self.watermark_img_path) as logo:
+            logo_width = logo.width
+        self.watermark_settings = dict(
+            DEFAULT_SETTINGS,
+            type="image",
+            image_path=self.watermark_img_path,
+            image_scale=0.3 * display_size(self.current_image)[0] / logo_width * 100,
+            transparency=self.alpha_slider.value(),
+            position=(1.0, 1.0),
+            margin=20,
+        )
+        self.preview.set_watermark(self.watermark_settings, self.current_img_path)
 
     # === 导出功能 ===
     def export_image(self):
-        if not self.preview.current_image:
+        if self.watermark_settings is None or self.current_image is None:
             QMessageBox.warning(self, "提示", "没有可导出的图像，请先应用水印")
             return
         if not self.output_dir:
@@ -291,23 +292,29 @@ class MainWindow(QMainWindow):
             return
 
         format_choice = self.format_combo.currentText().upper()
-        name_mode = self.naming_mode.currentText()
-        prefix = self.prefix_input.text()
-        suffix = self.suffix_input.text()
-
-        in_path = Path(self.current_img_path)
-        base_name = in_path.stem
-        ext = ".jpg" if format_choice == "JPEG" else ".png"
-
-        if name_mode == "添加前缀":
-            out_name = prefix + base_name + ext
-        elif name_mode == "添加后缀":
-            out_name = base_name + suffix + ext
-        else:
-            out_name = base_name + ext
-
-        out_path = Path(self.output_dir) / out_name
-        self.preview.current_image.convert("RGB").save(out_path, format_choice)
+        export_settings = {
+            "naming": NAMING_MODES[self.naming_mode.currentText()],
+            "prefix": self.prefix_input.text(),
+            "suffix": self.suffix_input.text(),
+            "format": "jpg" if format_choice == "JPEG" else "png",
+        }
+        # 与主程序相同的命名规则；已有同名文件时先确认，不再静默覆盖
+        plan = OutputPlan([(None, self.current_img_path, self.output_dir, None)], export_settings)
+        out_path = plan.outputs[0].output_path
+        if plan.existing:
+            reply = QMessageBox.question(self, "文件已存在", f"{out_path} 已存在，是否覆盖？")
+            if reply != QMessageBox.StandardButton.Yes:
+                return
+        # 与主程序导出相同的流程：工作副本 -> 渲染计划原地合成 -> 转正 -> 保存
+        work = working_copy(self.current_image, self.current_img_path)
+        plan = render_plans.for_image(self.watermark_settings, self.current_img_path)
+        image = plan.apply(work)
+        if format_choice != "JPEG":
+            image = to_display(image)
+        try:
+            save_image(image, out_path, format_choice)
+        finally:
+            close_image(work)
         QMessageBox.information(self, "导出成功", f"文件已保存到：\n{out_path}")
 
     def update_status(self):
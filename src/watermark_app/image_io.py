@@ -0,0 +1,538 @@
+import mmap
+
+from PIL import Image
+
+# 导入文件夹和监视文件夹时识别的图片扩展名
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff", ".gif")
+
+# 只有这些格式会出现大尺寸的未压缩扫描件
+MAPPABLE_FORMATS = {"TIFF", "BMP"}
+
+# Pillow 能直接映射（内部布局与文件布局一致）的模式及其每像素字节数。
+# 只保留 Image.frombuffer 不复制的模式（Image._MAPMODES），其余模式映射了也会整幅复制。
+# 最常见的 24 位 RGB 不在其中：Pillow 内部每像素 4 字节，与文件布局不同，只能解码
+_MAP_MODE_BYTES = {
+    mode: size
+    for mode, size in {
+        "L": 1,
+        "P": 1,
+        "I;16": 2,
+        "I;16L": 2,
+        "I;16B": 2,
+        "RGBX": 4,
+        "RGBA": 4,
+        "CMYK": 4,
+    }.items()
+    if mode in getattr(Image, "_MAPMODES", ())
+}
+
+# 可以在原模式下做局部合成的模式
+COMPOSITE_MODES = ("RGBA", "RGB", "RGBX", "L", "LA", "CMYK")
+
+# 只把水印区域转换为 RGBA 合成、再转回原模式的模式
+REGION_MODES = ("P", "1", "YCbCr")
+
+# 高位深灰度模式 -> 8 位数值对应的倍数，合成时按数值混合水印亮度
+DEEP_MODES = {"I;16": 257, "I;16L": 257, "I;16B": 257, "I": 257, "F": 1}
+
+# 保持原模式添加水印的全部模式，其余模式（如 PA、LAB）整幅转换为 RGB/RGBA，见 to_watermark_mode
+WATERMARK_MODES = COMPOSITE_MODES + REGION_MODES + tuple(DEEP_MODES)
+
+# PNG 可以直接保存的模式
+PNG_MODES = ("1", "L", "LA", "P", "RGB", "RGBA", "I;16", "I;16B")
+
+# EXIF 方向标签
+ORIENTATION_TAG = 0x0112
+
+# 水印文本占位符用到的 EXIF 标签
+EXIF_IFD_TAG = 0x8769
+DATETIME_ORIGINAL_TAG = 0x9003
+DATETIME_TAG = 0x0132
+ARTIST_TAG = 0x013B
+COPYRIGHT_TAG = 0x8298
+MODEL_TAG = 0x0110
+
+# EXIF 方向 -> 把存储的像素转为显示方向的变换
+_ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+
+def _raw_layout(img):
+    """
+    检查图片是否为可映射的未压缩布局。
+    多条带（strip）的 TIFF 只要各条带在文件中首尾相连，也视为一整块。
+    :param img: 尚未加载的 Image 对象
+    :return: (偏移, 行跨度, 方向)，不可映射时返回 None
+    """
+    if img.format not in MAPPABLE_FORMATS or img.mode not in _MAP_MODE_BYTES:
+        return None
+    if not img.tile:
+        return None
+
+    width, height = img.size
+    tiles = sorted(img.tile, key=lambda t: t[1][1])
+    first_offset = tiles[0][2]
+    stride = None
+    orientation = 1
+    next_row = 0
+
+    for decoder, extents, offset, args in tiles:
+        if isinstance(args, str):
+            args = (args, 0, 1)
+        if decoder != "raw" or args[0] != img.mode:
+            return None
+        x0, y0, x1, y1 = extents
+        if x0 != 0 or x1 != width or y0 != next_row:
+            return None
+
+        tile_stride = args[1] if len(args) > 1 and args[1] else width * _MAP_MODE_BYTES[img.mode]
+        tile_orientation = args[2] if len(args) > 2 else 1
+        if stride is None:
+            stride, orientation = tile_stride, tile_orientation
+        elif (tile_stride, tile_orientation) != (stride, orientation):
+            return None
+        if offset != first_offset + y0 * stride:
+            return None
+        next_row = y1
+
+    if next_row != height or (orientation < 0 and len(tiles) > 1):
+        return None
+    return first_offset, stride, orientation
+
+
+def _map_image(path, writable=False):
+    """
+    通过内存映射打开未压缩图片，像素直接引用文件映射，不做任何复制。
+    只有 _MAP_MODE_BYTES 中的模式可以映射，24 位 RGB、BGR 的 BMP 等返回 None。
+    映射在图像释放或调用 close_image() 时关闭，在此之前文件处于打开状态（Windows 上不能删除或改名）。
+    :param path: 图片路径
+    :param writable: True 时使用写时复制映射（只复制被修改的内存页，不会写回文件）
+    :return: Image 对象，无法映射时返回 None
+    """
+    with Image.open(path) as img:
+        layout = _raw_layout(img)
+        # 需要转正方向的图片不映射，由 open_image 解码后转正
+        if layout is None or exif_orientation(img) != 1:
+            return None
+        mode, size, palette = img.mode, img.size, img.palette
+        info = dict(img.info)
+
+    offset, stride, orientation = layout
+    length = stride * size[1]
+    access = mmap.ACCESS_COPY if writable else mmap.ACCESS_READ
+    with open(path, "rb") as f:
+        mapping = mmap.mmap(f.fileno(), 0, access=access)
+    if offset + length > len(mapping):
+        mapping.close()
+        return None
+
+    buffer = memoryview(mapping)[offset:offset + length]
+    image = Image.frombuffer(mode, size, buffer, "raw", mode, stride, orientation)
+    if mode == "P" and palette is not None:
+        image.putpalette(palette)
+    image.info.update(info)
+    # 写时复制映射可以原地修改，避免 Pillow 在第一次写入时复制整幅图像
+    image.readonly = 0 if writable else 1
+    image._file_mapping = mapping
+    return image
+
+
+def close_image(image):
+    """
+    释放图像，内存映射打开的图片同时关闭映射，不再占用文件。之后不能再使用该图像。
+    由它复制、转换得到的图像不受影响。
+    """
+    mapping = getattr(image, "_file_mapping", None)
+    image.close()
+    if mapping is not None:
+        try:
+            mapping.close()
+        except BufferError:
+            pass  # 仍有其他对象引用映射中的像素，映射随它们释放
+
+
+def open_image(path, writable=False):
+    """
+    打开图片。未压缩的 TIFF/BMP 通过内存映射零拷贝打开（灰度、调色板、16 位灰度、
+    RGBA/RGBX 和 CMYK；24 位 RGB 不能映射），其余图片按原模式解码。
+    映射打开的图片不再需要时用 close_image() 释放，及时解除对文件的占用。
+    EXIF 方向随 info["exif"] 保留、暂不转正（见 to_display）；
+    方向写在 TIFF 标签中的图片在这里直接转正，因为复制后标签会丢失。
+    :param path: 图片路径
+    :param writable: 是否需要可原地修改的图像
+    :return: Image 对象
+    """
+    image = _map_image(path, writable=writable)
+    if image is not None:
+        return image
+
+    with Image.open(path) as img:
+        img.load()
+        if "exif" not in img.info and exif_orientation(img) != 1:
+            from PIL import ImageOps
+
+            return ImageOps.exif_transpose(img)
+    return img
+
+
+def exif_orientation(image):
+    """
+    读取 EXIF 方向，只解析文件头中的 EXIF，不解码像素。
+    :return: 1–8，没有或无效时为 1
+    """
+    try:
+        orientation = image.getexif().get(ORIENTATION_TAG, 1)
+    except Exception:
+        return 1
+    return orientation if orientation in _ORIENTATION_TRANSPOSE else 1
+
+
+def display_size(image, orientation=None):
+    """
+    图片按 EXIF 方向转正后的尺寸。
+    :param orientation: 已读取的方向，None 表示从图片读取
+    """
+    if orientation is None:
+        orientation = exif_orientation(image)
+    if orientation >= 5:
+        return image.height, image.width
+    return image.size
+
+
+def read_metadata(path):
+    """
+    读取图片的元数据，只解析文件头，不解码像素。
+    :param path: 图片路径或文件对象
+    :return: {"artist", "copyright", "camera": 字符串或 None,
+              "date": 拍摄时间 datetime（没有 EXIF 时为 None）,
+              "width", "height": 按 EXIF 方向转正后的尺寸}
+    """
+    import datetime
+
+    with Image.open(path) as img:
+        try:
+            exif = img.getexif()
+            sub_ifd = exif.get_ifd(EXIF_IFD_TAG)
+        except Exception:
+            exif, sub_ifd = {}, {}
+        orientation = exif.get(ORIENTATION_TAG, 1)
+        width, height = display_size(img, orientation if orientation in _ORIENTATION_TRANSPOSE else 1)
+
+    def text(value):
+        if isinstance(value, bytes):
+            value = value.decode("utf-8", "replace")
+        value = str(value).strip("\x00 ") if value is not None else ""
+        return value or None
+
+    date = None
+    raw_date = text(sub_ifd.get(DATETIME_ORIGINAL_TAG) or exif.get(DATETIME_TAG))
+    if raw_date:
+        try:
+            date = datetime.datetime.strptime(raw_date[:19], "%Y:%m:%d %H:%M:%S")
+        except ValueError:
+            pass
+
+    return {
+        "artist": text(exif.get(ARTIST_TAG)),
+        "copyright": text(exif.get(COPYRIGHT_TAG)),
+        "camera": text(exif.get(MODEL_TAG)),
+        "date": date,
+        "width": width,
+        "height": height,
+    }
+
+
+def to_display(image):
+    """
+    按 EXIF 方向把像素转为显示方向（整幅变换）并把方向标签改为 1。
+    只在之后本来就要整幅处理（缩放、缩略图）或输出格式不读 EXIF 方向时调用；
+    方向正常的图片原样返回。
+    """
+    if exif_orientation(image) == 1:
+        return image
+    from PIL import ImageOps
+
+    return ImageOps.exif_transpose(image)
+
+
+def to_stored(overlay, dest, size, orientation):
+    """
+    把按显示方向摆放的水印图层换算到图片的存储方向，
+    这样可以直接合成到未转正的像素上，不需要整幅转正。
+    :param overlay: 显示方向的水印图层
+    :param dest: 显示方向中的左上角坐标
+    :param size: 图片的显示尺寸
+    :param orientation: EXIF 方向
+    :return: (存储方向的图层, 存储方向中的左上角坐标)
+    """
+    method = _ORIENTATION_TRANSPOSE.get(orientation)
+    if method is None:
+        return overlay, dest
+
+    # 存储方向 = 显示方向做逆变换，只有两个旋转互为逆变换，其余变换的逆是自身
+    T = Image.Transpose
+    inverse = {T.ROTATE_90: T.ROTATE_270, T.ROTATE_270: T.ROTATE_90}.get(method, method)
+    width, height = size
+    x, y = int(dest[0]), int(dest[1])
+    w, h = overlay.size
+    stored_dest = {
+        T.FLIP_LEFT_RIGHT: (width - x - w, y),
+        T.FLIP_TOP_BOTTOM: (x, height - y - h),
+        T.ROTATE_180: (width - x - w, height - y - h),
+        T.ROTATE_90: (y, width - x - w),
+        T.ROTATE_270: (height - y - h, x),
+        T.TRANSPOSE: (y, x),
+        T.TRANSVERSE: (height - y - h, width - x - w),
+    }[inverse]
+    return overlay.transpose(inverse), stored_dest
+
+
+def has_alpha(image):
+    """
+    图像是否带透明度。不能按通道名判断：LAB 的 "A" 是色度通道。
+    """
+    return image.mode in ("LA", "La", "PA", "RGBA", "RGBa") or "transparency" in image.info
+
+
+def to_watermark_mode(image):
+    """
+    把 WATERMARK_MODES 以外的模式整幅转换为 RGB，带透明度的转换为 RGBA。
+    LAB、HSV 等没有透明通道的模式直接转 RGBA 会得到全透明的图像。
+    """
+    if image.mode in WATERMARK_MODES:
+        return image
+    return image.convert("RGBA" if has_alpha(image) else "RGB")
+
+
+def working_copy(image, path):
+    """
+    为渲染准备一份可写的工作图像，这是每次渲染唯一的整幅分配，
+    调用方拥有返回的图像，之后的水印与缩放都可以原地进行。
+    内存映射的图片重新以写时复制方式映射，水印只会复制它覆盖到的内存页；
+    图像保持原模式，只有 WATERMARK_MODES 以外的模式转换为 RGB/RGBA。
+    :param image: 导入时打开的 Image 对象
+    :param path: 图片路径
+    :return: 可写的 Image 对象
+    """
+    if image.mode not in WATERMARK_MODES:
+        return to_watermark_mode(image)
+    if image.readonly:
+        mapped = _map_image(path, writable=True)
+        if mapped is not None:
+            return mapped
+    return image.copy()
+
+
+def make_thumbnail(image, size):
+    """
+    生成缩略图，大图先用整数倍 reduce() 快速缩小，不会整幅解码为 RGBA。
+    方向转正在缩小之后进行，只变换缩略图。
+    :param image: Image 对象
+    :param size: 最大边长
+    :return: 显示方向的 RGB/RGBA 缩略图
+    """
+    factor = max(1, min(image.width, image.height) // (size * 2))
+    if factor == 1:
+        thumb = image.copy()
+    elif image.mode in COMPOSITE_MODES:
+        thumb = image.reduce(factor)
+    else:
+        # reduce() 不支持调色板和 16 位模式，先用最近邻抽样缩小再转换
+        thumb = image.resize(
+            (image.width // factor, image.height // factor), Image.Resampling.NEAREST
+        )
+    thumb = to_8bit(thumb)
+    if thumb.mode not in ("RGB", "RGBA"):
+        thumb = thumb.convert("RGBA")
+    thumb.thumbnail((size, size), Image.Resampling.LANCZOS)
+    method = _ORIENTATION_TRANSPOSE.get(exif_orientation(image))
+    if method is not None:
+        thumb = thumb.transpose(method)
+    return thumb
+
+
+def srcset_targets(width, widths):
+    """
+    多尺寸导出实际生成的宽度，从大到小：比母版宽的尺寸不放大，全部都比母版宽时只有原宽度。
+    :param width: 母版宽度（显示方向）
+    :param widths: 目标宽度列表
+    """
+    return sorted({w for w in widths if 0 < w <= width}, reverse=True) or [width]
+
+
+def _resampling_mode(image):
+    """
+    缩放前的模式：Pillow 对 P 和 1 模式只做最近邻抽样（指定 LANCZOS 也一样），
+    调色板图像先转为 RGB/RGBA，1 位图像先转为 L。
+    """
+    if image.mode == "P":
+        return image.convert("RGBA" if has_alpha(image) else "RGB")
+    if image.mode == "1":
+        return image.convert("L")
+    return image
+
+
+def make_srcset(image, widths):
+    """
+    由一张母版生成多个宽度的版本（响应式 srcset）。
+    从大到小逐级生成，每一级由上一级缩小得到：整数倍的部分用 reduce() 快速完成，
+    剩下不到两倍的缩放再用 LANCZOS，因此多个尺寸的总代价接近一次缩放。
+    比母版宽的尺寸不放大；全部都比母版宽时只生成一份原尺寸。
+    :param image: 母版 Image 对象（不会被修改）
+    :param widths: 目标宽度列表
+    :return: (宽度, Image) 的生成器，从大到小
+    """
+    current = image
+    for width in srcset_targets(image.width, widths):
+        height = max(1, round(image.height * width / image.width))
+        factor = current.width // width
+        if current.size != (width, height):
+            current = _resampling_mode(current)
+        if factor >= 2 and current.mode in COMPOSITE_MODES:
+            current = current.reduce(factor)
+        if current.size != (width, height):
+            current = current.resize((width, height), Image.Resampling.LANCZOS)
+        yield width, current
+
+
+def resize_image(image, method, value):
+    """
+    按缩放设置调整图片大小，不需要缩放时直接返回传入的图像。
+    :param method: 缩放方式 "none"/"width"/"height"/"percentage"
+    :param value: 宽度、高度（像素）或百分比
+    """
+    if method == "none" or value <= 0:
+        return image
+
+    width, height = image.size
+    if method == "percentage":
+        new_width = int(width * value / 100)
+        new_height = int(height * value / 100)
+    elif method == "width":
+        # 按指定宽度缩放（保持比例）
+        ratio = value / width
+        new_width = value
+        new_height = int(height * ratio)
+    elif method == "height":
+        # 按指定高度缩放（保持比例）
+        ratio = value / height
+        new_width = int(width * ratio)
+        new_height = value
+    else:
+        return image
+
+    # 确保尺寸有效
+    new_width = max(10, new_width)
+    new_height = max(10, new_height)
+    return _resampling_mode(image).resize((new_width, new_height), Image.Resampling.LANCZOS)
+
+
+def to_8bit(image):
+    """
+    把高位深灰度图像按比例缩放为 L 模式。
+    Pillow 的 convert() 会把 255 以上的值直接截断为白色。
+    """
+    scale = DEEP_MODES.get(image.mode)
+    if scale is None:
+        return image
+    import numpy as np
+
+    values = np.asarray(image, dtype=np.float32) / scale
+    data = np.clip(np.rint(values), 0, 255).astype(np.uint8)
+    converted = Image.frombytes("L", image.size, data.tobytes())
+    converted.info = dict(image.info)
+    return converted
+
+
+def _flatten(image):
+    """把带透明通道的图像铺在白色背景上"""
+    if image.mode == "PA":
+        image = image.convert("RGBA")
+    background = Image.new(image.mode[:-1], image.size, "white")
+    background.paste(image, mask=image.getchannel("A"))
+    background.info = image.info
+    return background
+
+
+def convert_mode(image, mode):
+    """
+    把图像转换为指定的输出模式：高位深灰度按比例缩放到 8 位，去掉透明通道时铺白底。
+    :param mode: 目标模式，如 "RGB"、"L"
+    """
+    if image.mode == mode:
+        return image
+    if mode not in DEEP_MODES:
+        image = to_8bit(image)
+    if image.mode in ("RGBA", "LA", "PA") and "A" not in mode:
+        image = _flatten(image)
+    if image.mode == mode:
+        return image
+    cmyk = image.mode == "CMYK"
+    image = image.convert(mode)
+    if cmyk:
+        # CMYK 的 ICC 配置不能用于转换后的数据
+        image.info.pop("icc_profile", None)
+    return image
+
+
+def prepare_for_format(image, format, mode=None):
+    """
+    把图像转换为目标格式可以保存的模式，格式支持时保持原模式。
+    :param image: Image 对象
+    :param format: 输出格式，"JPG" 视为 "JPEG"
+    :param mode: 指定的输出模式，None 表示尽量保持原模式
+    :return: (Image 对象, Pillow 格式名)
+    """
+    format = format.upper()
+    if format == "JPG":
+        format = "JPEG"
+
+    if mode is not None:
+        image = convert_mode(image, mode)
+
+    if format == "JPEG":
+        # JPEG 不支持透明（铺在白色背景上），也不支持调色板、1 位和高位深
+        if image.mode in ("RGBA", "LA", "PA"):
+            image = _flatten(image)
+        if image.mode in DEEP_MODES or image.mode == "1":
+            image = convert_mode(image, "L")
+        elif image.mode not in ("RGB", "L", "CMYK"):
+            image = convert_mode(image, "RGB")
+    elif format == "PNG":
+        # PNG 支持 1、L、LA、P、RGB、RGBA 和 16 位灰度
+        if image.mode in ("I", "I;16L"):
+            # Pillow 13 起不再支持保存 32 位的 I 模式 PNG
+            image = image.convert("I;16")
+        elif image.mode == "F":
+            image = to_8bit(image)
+        elif image.mode in ("PA", "RGBa"):
+            image = convert_mode(image, "RGBA")
+        elif image.mode not in PNG_MODES:
+            # CMYK、RGBX、YCbCr、LAB 等
+            image = convert_mode(image, "RGB")
+    return image, format
+
+
+def save_image(image, fp, format, quality=90, optimize=True, mode=None):
+    """
+    按指定格式保存图像，原图的 ICC 配置和 EXIF（含方向）随之写入。
+    :param image: Image 对象
+    :param fp: 文件路径或可写的文件对象
+    :param format: 输出格式（PNG/JPEG/JPG 等）
+    :param quality: JPEG 质量
+    :param optimize: 是否启用编码优化（更小但更慢）
+    :param mode: 指定的输出模式，None 表示尽量保持原模式
+    """
+    image, format = prepare_for_format(image, format, mode)
+    params = {}
+    for key in ("icc_profile", "exif"):
+        if image.info.get(key):
+            params[key] = image.info[key]
+    image.save(fp, format=format, quality=quality, optimize=optimize, **params)
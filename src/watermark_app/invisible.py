@@ -0,0 +1,318 @@
+import argparse
+import functools
+import io
+import os
+import time
+import zlib
+from collections import namedtuple
+
+import numpy as np
+from PIL import Image
+
+from .image_io import (
+    DEEP_MODES,
+    display_size,
+    exif_orientation,
+    has_alpha,
+    to_8bit,
+    to_display,
+    to_stored,
+)
+from .watermark_core import MAX_INVISIBLE_ID
+
+# 隐形水印：把编号（32 位格式，可用 31 位，见 MAX_INVISIBLE_ID）以扩频方式嵌入亮度的 8×8 块 DCT 中频系数。
+# 每个 (块, 系数) 由密钥决定承载哪一位以及伪随机符号 ±1，嵌入时按 位值 × 符号 × 强度 修改系数；
+# 检测时把同一位的所有系数按符号相关求和，符号即该位的值。编号后附 16 位校验，
+# 校验不符或相关性太弱时视为没有水印。水印按显示方向嵌入和检测。
+
+DEFAULT_KEY = "watermark_app"
+DEFAULT_STRENGTH = 4.0  # 每个中频系数的修改量（8 位亮度），约 42 dB PSNR
+
+PAYLOAD_BITS = 32  # 嵌入格式的位数，可用的编号见 watermark_core.MAX_INVISIBLE_ID
+CHECK_BITS = 16
+TOTAL_BITS = PAYLOAD_BITS + CHECK_BITS
+
+# 检测结果的最低置信度（各位相关性的平均 z 值），没有水印的图片约为 1
+MIN_CONFIDENCE = 3.0
+
+# 少于这么多个 8×8 块的图片不嵌入也不检测
+MIN_BLOCKS = 64
+
+# 嵌入的中频系数 (u, v)：JPEG 量化较轻，又不在最显眼的低频
+_COEFFICIENTS = [(u, v) for u in range(8) for v in range(8) if 3 <= u + v <= 5]
+
+# 检测时块归一化的平滑项，纹理多的块权重降低
+_WHITENING_FLOOR = 4.0
+
+# 一次检测的结果：payload 为编号，confidence 为置信度
+Detection = namedtuple("Detection", ["payload", "confidence"])
+
+
+def _dct_basis():
+    """中频系数对应的 8×8 DCT 基图像，形状 (系数数, 64)"""
+    k = np.arange(8)
+    dct = np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / 16) * np.sqrt(2 / 8)
+    dct[0] /= np.sqrt(2)
+    return np.stack([np.outer(dct[u], dct[v]).ravel() for u, v in _COEFFICIENTS]).astype(
+        np.float32
+    )
+
+
+_BASIS = _dct_basis()
+
+
+@functools.lru_cache(maxsize=8)
+def _layout(blocks, key):
+    """
+    按密钥生成每个 (块, 系数) 的符号和承载的位，同一尺寸的图片只生成一次。
+    :return: (符号数组, 位序号数组)，形状均为 (块数, 系数数)，只读
+    """
+    rng = np.random.default_rng(zlib.crc32(key.encode("utf-8")))
+    shape = (blocks, len(_COEFFICIENTS))
+    chips = (rng.integers(0, 2, size=shape, dtype=np.int8) * 2 - 1).astype(np.int8)
+    bits = rng.integers(0, TOTAL_BITS, size=shape, dtype=np.uint8)
+    chips.flags.writeable = False
+    bits.flags.writeable = False
+    return chips, bits
+
+
+def _check(payload, key):
+    return zlib.crc32(payload.to_bytes(4, "big") + key.encode("utf-8")) & 0xFFFF
+
+
+def _payload_signs(payload, key):
+    """编号和校验组成的各位，1 -> +1，0 -> -1"""
+    value = (payload << CHECK_BITS) | _check(payload, key)
+    bits = (value >> np.arange(TOTAL_BITS - 1, -1, -1)) & 1
+    return bits.astype(np.float32) * 2 - 1
+
+
+def _blocks(size):
+    width, height = size
+    return height // 8, width // 8
+
+
+def embed(image, payload, key=None, strength=DEFAULT_STRENGTH):
+    """
+    把编号嵌入图片亮度。RGB 各通道加同样的亮度增量，不改变色度；
+    CMYK 修改 K 通道，高位深灰度按比例修改，其余模式先转为 RGB/RGBA。
+    带 EXIF 方向的图片按显示方向嵌入，之后转正或保留方向标签输出都能检测到。
+    :param image: Image 对象
+    :param payload: 编号（0 到 MAX_INVISIBLE_ID，即 2**31-1）
+    :param key: 密钥，None 表示默认密钥
+    :param strength: 嵌入强度
+    :return: 嵌入水印后的 Image 对象（可以直接修改的模式原地修改并返回原对象）
+    """
+    key = key or DEFAULT_KEY
+    if not 0 <= payload <= MAX_INVISIBLE_ID:
+        raise ValueError(f"隐形水印编号超出范围: {payload}")
+    if image.mode not in ("RGB", "RGBA", "RGBX", "L", "LA", "CMYK") and image.mode not in DEEP_MODES:
+        image = image.convert("RGBA" if has_alpha(image) else "RGB")
+
+    orientation = exif_orientation(image)
+    size = display_size(image, orientation)
+    rows, cols = _blocks(size)
+    if rows * cols < MIN_BLOCKS:
+        return image
+
+    chips, bits = _layout(rows * cols, key)
+    weights = strength * chips * _payload_signs(payload, key)[bits]
+    pattern = (weights @ _BASIS).reshape(rows, cols, 8, 8).transpose(0, 2, 1, 3)
+    full = np.zeros((size[1], size[0]), dtype=np.float32)
+    full[: rows * 8, : cols * 8] = pattern.reshape(rows * 8, cols * 8)
+    if orientation != 1:
+        # 显示方向的图案换算到存储方向
+        stored, _ = to_stored(Image.fromarray(full), (0, 0), size, orientation)
+        full = np.asarray(stored)
+
+    values = np.array(image)
+    if image.mode in DEEP_MODES:
+        limits = np.iinfo(values.dtype) if np.issubdtype(values.dtype, np.integer) else None
+        blended = values + full * DEEP_MODES[image.mode]
+        if limits is not None:
+            blended = np.clip(np.rint(blended), limits.min, limits.max)
+        values = blended.astype(values.dtype)
+    else:
+        if image.mode == "CMYK":
+            channels, full = [3], -full  # K 增加亮度降低
+        elif image.mode in ("L", "LA"):
+            channels = [0]
+        else:
+            channels = [0, 1, 2]
+        if values.ndim == 2:
+            values = np.clip(np.rint(values + full), 0, 255).astype(np.uint8)
+        else:
+            for channel in channels:
+                values[..., channel] = np.clip(np.rint(values[..., channel] + full), 0, 255)
+    image.frombytes(values.tobytes())
+    return image
+
+
+def _luminance(image):
+    """显示方向的 8 位亮度数组"""
+    image = to_8bit(to_display(image))
+    if image.mode != "L":
+        image = image.convert("L")
+    return np.asarray(image, dtype=np.float32)
+
+
+def detect(source, key=None):
+    """
+    检测图片中的隐形水印。
+    :param source: Image 对象、图片路径或图片字节
+    :param key: 密钥，None 表示默认密钥
+    :return: Detection，没有水印（或校验不符）时为 None
+    """
+    key = key or DEFAULT_KEY
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+    if isinstance(source, Image.Image):
+        luminance = _luminance(source)
+    else:
+        with Image.open(source) as image:
+            luminance = _luminance(image)
+
+    rows, cols = _blocks((luminance.shape[1], luminance.shape[0]))
+    if rows * cols < MIN_BLOCKS:
+        return None
+    blocks = (
+        luminance[: rows * 8, : cols * 8]
+        .reshape(rows, 8, cols, 8)
+        .transpose(0, 2, 1, 3)
+        .reshape(rows * cols, 64)
+    )
+    coefficients = blocks @ _BASIS.T
+    coefficients /= np.sqrt((coefficients**2).mean(axis=1, keepdims=True)) + _WHITENING_FLOOR
+
+    chips, bits = _layout(rows * cols, key)
+    samples = (coefficients * chips).ravel()
+    correlation = np.bincount(bits.ravel(), weights=samples, minlength=TOTAL_BITS)
+    counts = np.bincount(bits.ravel(), minlength=TOTAL_BITS)
+    confidence = float(
+        (np.abs(correlation) / np.sqrt(np.maximum(counts, 1))).mean() / (samples.std() + 1e-9)
+    )
+
+    value = 0
+    for bit in correlation > 0:
+        value = (value << 1) | int(bit)
+    payload, check = value >> CHECK_BITS, value & 0xFFFF
+    if check != _check(payload, key) or confidence < MIN_CONFIDENCE:
+        return None
+    return Detection(payload, confidence)
+
+
+def detect_many(sources, key=None, workers=None):
+    """
+    并行检测多张图片（解码和矩阵运算都会释放 GIL），按输入顺序返回。
+    无法读取的文件结果为 None。
+    :param sources: 图片路径、字节或 Image 对象组成的可迭代对象
+    :param key: 密钥
+    :param workers: 线程数，None 表示 CPU 数
+    :return: (输入, Detection 或 None) 的迭代器
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    def run(source):
+        try:
+            return source, detect(source, key)
+        except Exception as e:
+            print(f"检测失败: {source} - {str(e)}")
+            return source, None
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        yield from pool.map(run, sources)
+
+
+def benchmark(images, payload=1, key=None, qualities=(95, 90, 75, 60)):
+    """
+    嵌入、JPEG 重新编码后检测，统计各质量下的检出率和速度。
+    JPEG 与导出相同，通过 image_io.save_image 编码。
+    :param images: Image 对象列表
+    :param payload: 嵌入的编号
+    :param key: 密钥
+    :param qualities: 测试的 JPEG 质量
+    :return: {"embed_ms", "detect_ms", "psnr", quality: 检出率, ...}
+    """
+    from .image_io import save_image
+
+    results = {"embed_ms": 0.0, "detect_ms": 0.0, "psnr": 0.0}
+    hits = dict.fromkeys(qualities, 0)
+    for image in images:
+        original = _luminance(image)
+        start = time.perf_counter()
+        marked = embed(image.copy(), payload, key)
+        results["embed_ms"] += (time.perf_counter() - start) * 1000
+        error = np.mean((_luminance(marked) - original) ** 2)
+        results["psnr"] += float(10 * np.log10(255**2 / max(error, 1e-9)))
+
+        for quality in qualities:
+            buffer = io.BytesIO()
+            save_image(marked, buffer, "JPEG", quality=quality, optimize=False)
+            start = time.perf_counter()
+            detection = detect(buffer.getvalue(), key)
+            results["detect_ms"] += (time.perf_counter() - start) * 1000
+            if detection is not None and detection.payload == payload:
+                hits[quality] += 1
+
+    count = max(len(images), 1)
+    results["embed_ms"] /= count
+    results["detect_ms"] /= count * max(len(qualities), 1)
+    results["psnr"] /= count
+    results.update({quality: hit / count for quality, hit in hits.items()})
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m watermark_app detect", description="检测图片中的隐形水印"
+    )
+    parser.add_argument("paths", nargs="+", help="图片文件或文件夹")
+    parser.add_argument("--key", default=None, help="嵌入时使用的密钥")
+    parser.add_argument("--workers", type=int, default=None, help="检测线程数")
+    parser.add_argument(
+        "--benchmark",
+        action="store_true",
+        help="把编号嵌入这些图片并以不同 JPEG 质量重新编码后检测，报告检出率和速度",
+    )
+    args = parser.parse_args(argv)
+
+    from .image_io import IMAGE_EXTENSIONS
+
+    files = []
+    for path in args.paths:
+        if os.path.isdir(path):
+            files.extend(
+                os.path.join(path, name)
+                for name in sorted(os.listdir(path))
+                if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS
+            )
+        else:
+            files.append(path)
+
+    if args.benchmark:
+        images = []
+        for path in files:
+            with Image.open(path) as image:
+                image.load()
+                images.append(image)
+        results = benchmark(images, key=args.key)
+        print(
+            f"{len(images)} 张图片：嵌入 {results['embed_ms']:.1f} ms/张，"
+            f"检测 {results['detect_ms']:.1f} ms/张，PSNR {results['psnr']:.1f} dB"
+        )
+        for quality in (95, 90, 75, 60):
+            print(f"  JPEG 质量 {quality}: 检出率 {results[quality]:.0%}")
+        return 0
+
+    start = time.perf_counter()
+    found = 0
+    for path, detection in detect_many(files, args.key, args.workers):
+        if detection is None:
+            print(f"{path}\t-")
+        else:
+            found += 1
+            print(f"{path}\t{detection.payload}\t置信度 {detection.confidence:.1f}")
+    elapsed = time.perf_counter() - start
+    rate = len(files) / elapsed * 60 if elapsed > 0 else 0
+    print(f"检测 {len(files)} 张，发现 {found} 张带水印（{rate:.0f} 张/分钟）")
+    return 0
@@ -0,0 +1,209 @@
+import os
+from collections import namedtuple
+
+from .export_job import srcset_path
+
+# 重名处理方式
+COLLISION_POLICIES = ("number", "mirror")
+
+# 一个导出任务的输出
+PlannedOutput = namedtuple(
+    "PlannedOutput",
+    [
+        "task",  # 原始任务
+        "source",  # 原图路径
+        "output_path",  # 主输出路径（多尺寸导出时由它按文件名模式派生各宽度的文件）
+        "paths",  # 实际写入的全部文件
+        "renamed",  # 是否因重名改了文件名
+    ],
+)
+
+
+def output_name(source, naming, prefix="", suffix="", format="png"):
+    """
+    按命名规则生成输出文件名。
+    :param source: 原图路径
+    :param naming: "original"/"prefix"/"suffix"
+    :param format: 输出格式 "png"/"jpg"，原图扩展名不符时替换
+    """
+    original_name = os.path.basename(source)
+    name, ext = os.path.splitext(original_name)
+    if naming == "prefix":
+        new_name = f"{prefix}{name}{ext}"
+    elif naming == "suffix":
+        new_name = f"{name}{suffix}{ext}"
+    else:
+        new_name = original_name
+
+    format = format.lower()
+    if format == "jpg" and ext.lower() not in (".jpg", ".jpeg"):
+        new_name = os.path.splitext(new_name)[0] + ".jpg"
+    elif format == "png" and ext.lower() != ".png":
+        new_name = os.path.splitext(new_name)[0] + ".png"
+    return new_name
+
+
+def _key(path):
+    """比较路径时不区分大小写（Windows、macOS 和大多数网络共享都不区分）"""
+    return os.path.normcase(os.path.normpath(path)).casefold()
+
+
+def _common_folder(sources):
+    """全部原图所在文件夹的共同上级，不在同一个盘上时为 None"""
+    folders = {os.path.dirname(os.path.abspath(path)) for path in sources}
+    if not folders:
+        return None
+    try:
+        return os.path.commonpath(list(folders))
+    except ValueError:
+        return None
+
+
+class PathAllocator:
+    """
+    在内存中分配不重复的输出路径：已占用的路径放在集合里，不查询文件系统。
+    同一文件夹中的同名文件依次加 "-2"、"-3"，每个名称记住下一个编号，不必每次从头尝试。
+    """
+
+    def __init__(self, taken=()):
+        """
+        :param taken: 已占用的路径（如原图、之前的输出）
+        """
+        self.taken = {_key(path) for path in taken}
+        self._next_number = {}  # (文件夹, 文件名) -> 下一个编号
+
+    def reserve_existing(self, folder):
+        """
+        把文件夹中已有的文件视为已占用，只列一次目录。文件夹还不存在时什么也不做。
+        :return: 已有文件名（小写）的集合
+        """
+        try:
+            with os.scandir(folder) as entries:
+                names = {entry.name.casefold() for entry in entries}
+        except OSError:
+            return set()
+        self.taken.update(_key(os.path.join(folder, name)) for name in names)
+        return names
+
+    def allocate(self, folder, name, derive=None):
+        """
+        分配一个输出路径并占用它。
+        :param folder: 输出文件夹
+        :param name: 希望使用的文件名
+        :param derive: 由主路径得到实际写入的全部路径的函数，None 表示只写主路径
+        :return: (主路径, 全部路径, 是否改了名)
+        :raises ValueError: derive 给出的路径互相重复，改名也无法解决
+        """
+        base, ext = os.path.splitext(name)
+        counter = (_key(folder), name.casefold())
+        number = self._next_number.get(counter, 1)
+        while True:
+            candidate = name if number == 1 else f"{base}-{number}{ext}"
+            path = os.path.join(folder, candidate)
+            paths = derive(path) if derive is not None else [path]
+            keys = [_key(p) for p in paths]
+            if len(set(keys)) != len(keys):
+                raise ValueError(f"输出文件名互相重复: {paths}")
+            if not any(key in self.taken for key in keys):
+                self.taken.update(keys)
+                self._next_number[counter] = number + 1
+                return path, paths, number > 1
+            number += 1
+
+
+class OutputPlan:
+    """
+    导出前一次性算好的全部输出路径。
+    重名在内存中的集合里检测，已有文件只按输出文件夹各列一次目录，不逐个查询。
+    按任务顺序处理，结果是确定的：先出现的保留原名，之后重名的依次加 "-2"、"-3"；
+    mirror 方式先在输出文件夹中保留原图的子文件夹结构，剩下的重名（如 a.jpg 与 a.png）再编号。
+    输出路径不会与任何一张原图相同，原图不会被覆盖。
+    """
+
+    def __init__(self, entries, export_settings, policy="number"):
+        """
+        :param entries: [(任务, 原图路径, 导出目录, 多尺寸宽度列表或 None), ...]，按导出顺序
+        :param export_settings: 导出设置（naming、prefix、suffix、format、srcset_pattern）
+        :param policy: 重名处理方式，见 COLLISION_POLICIES
+        """
+        self.export_settings = export_settings
+        self.policy = policy
+        self.outputs = []
+        self.existing = []  # 导出前已经存在、将被覆盖的文件
+
+        root = _common_folder(source for _, source, _, _ in entries) if policy == "mirror" else None
+        allocator = PathAllocator(source for _, source, _, _ in entries)
+        listed = {}  # 输出文件夹 -> 其中已有文件名的集合
+        for task, source, export_dir, widths in entries:
+            folder = export_dir
+            if root is not None:
+                relative = os.path.relpath(os.path.dirname(os.path.abspath(source)), root)
+                folder = os.path.normpath(os.path.join(export_dir, relative))
+            output = self._place(task, source, folder, widths, allocator)
+            self.outputs.append(output)
+
+            if folder not in listed:
+                listed[folder] = self._list(folder)
+            self.existing.extend(
+                path for path in output.paths if os.path.basename(path).casefold() in listed[folder]
+            )
+
+    def _place(self, task, source, folder, widths, allocator):
+        """
+        为一个任务选择不与已占用路径重复的输出路径，并占用它的全部文件。
+        :raises ValueError: 多尺寸文件名模式使不同宽度得到同一个文件名
+        """
+        s = self.export_settings
+        name = output_name(source, s["naming"], s.get("prefix", ""), s.get("suffix", ""), s["format"])
+        derive = None
+        if widths:
+            pattern = s["srcset_pattern"]
+
+            def derive(path):
+                return [srcset_path(path, pattern, width) for width in widths]
+
+        try:
+            output_path, paths, renamed = allocator.allocate(folder, name, derive)
+        except ValueError:
+            raise ValueError(f"多尺寸文件名模式必须包含 {{width}}: {s['srcset_pattern']}") from None
+        return PlannedOutput(task, source, output_path, paths, renamed)
+
+    @staticmethod
+    def _list(folder):
+        try:
+            with os.scandir(folder) as entries:
+                return {entry.name.casefold() for entry in entries}
+        except OSError:
+            return set()  # 文件夹还不存在
+
+    @property
+    def renamed(self):
+        """因重名改了文件名的输出"""
+        return [output for output in self.outputs if output.renamed]
+
+    def file_count(self):
+        """将写入的文件总数"""
+        return sum(len(output.paths) for output in self.outputs)
+
+    def report(self, limit=20):
+        """
+        试运行报告：输出的文件数、改名和将被覆盖的文件。
+        :param limit: 每类最多列出的条数
+        :return: 多行文本
+        """
+        lines = [f"将导出 {len(self.outputs)} 张图片，写入 {self.file_count()} 个文件"]
+        renamed = self.renamed
+        if renamed:
+            lines.append(f"\n重名，已自动改名 {len(renamed)} 个：")
+            lines.extend(
+                f"  {output.source} -> {os.path.basename(output.output_path)}"
+                for output in renamed[:limit]
+            )
+            if len(renamed) > limit:
+                lines.append(f"  …… 另有 {len(renamed) - limit} 个")
+        if self.existing:
+            lines.append(f"\n已存在，将被覆盖 {len(self.existing)} 个：")
+            lines.extend(f"  {path}" for path in self.existing[:limit])
+            if len(self.existing) > limit:
+                lines.append(f"  …… 另有 {len(self.existing) - limit} 个")
+        return "\n".join(lines)
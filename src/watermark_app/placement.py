@@ -0,0 +1,67 @@
+import numpy as np
+
+from .image_io import display_size, make_thumbnail
+
+# 计算细节分布时缩略图的最大边长
+DETAIL_MAP_SIZE = 256
+
+# 自动位置的候选相对位置：四角优先，其次四边中点，最后中心；细节相同时取靠前的
+CANDIDATE_POSITIONS = (
+    (1.0, 1.0),
+    (0.0, 1.0),
+    (1.0, 0.0),
+    (0.0, 0.0),
+    (0.5, 1.0),
+    (0.5, 0.0),
+    (0.0, 0.5),
+    (1.0, 0.5),
+    (0.5, 0.5),
+)
+
+
+class DetailMap:
+    """
+    图片的细节分布。
+    在缩小的亮度图上计算梯度幅值并建立积分图（二维前缀和），
+    之后任意矩形内的细节总量只需要查 4 个值，与矩形大小无关。
+    """
+
+    def __init__(self, image, max_size=DETAIL_MAP_SIZE):
+        """
+        :param image: Image 对象（按 EXIF 方向转正后计算，与水印定位一致）
+        :param max_size: 缩略图最大边长
+        """
+        thumb = make_thumbnail(image, max_size).convert("L")
+        luminance = np.asarray(thumb, dtype=np.float32)
+        gradient = np.zeros_like(luminance)
+        gradient[:, 1:] += np.abs(np.diff(luminance, axis=1))
+        gradient[1:, :] += np.abs(np.diff(luminance, axis=0))
+
+        # 多一行一列 0，矩形和不需要判断边界
+        self.integral = np.zeros((thumb.height + 1, thumb.width + 1), dtype=np.float64)
+        np.cumsum(np.cumsum(gradient, axis=0), axis=1, out=self.integral[1:, 1:])
+        self.size = display_size(image)
+        self.scale = (thumb.width / self.size[0], thumb.height / self.size[1])
+
+    def scores(self, boxes):
+        """
+        计算每个矩形内的平均细节量。
+        :param boxes: [(左, 上, 右, 下), ...]，原图（显示方向）坐标，可以超出图片
+        :return: NumPy 数组，完全在图片之外的矩形为 inf
+        """
+        boxes = np.asarray(boxes, dtype=np.float64)
+        rows, cols = self.integral.shape
+        left = np.clip(np.floor(boxes[:, 0] * self.scale[0]), 0, cols - 1).astype(np.intp)
+        top = np.clip(np.floor(boxes[:, 1] * self.scale[1]), 0, rows - 1).astype(np.intp)
+        right = np.clip(np.ceil(boxes[:, 2] * self.scale[0]), 0, cols - 1).astype(np.intp)
+        bottom = np.clip(np.ceil(boxes[:, 3] * self.scale[1]), 0, rows - 1).astype(np.intp)
+
+        integral = self.integral
+        total = (
+            integral[bottom, right]
+            - integral[top, right]
+            - integral[bottom, left]
+            + integral[top, left]
+        )
+        area = (right - left) * (bottom - top)
+        return np.where(area > 0, total / np.maximum(area, 1), np.inf)
@@ -0,0 +1,156 @@
+from PyQt6.QtCore import Qt, QRectF, pyqtSignal
+from PyQt6.QtGui import QPixmap
+from PyQt6.QtWidgets import QGraphicsScene, QGraphicsView
+from PIL import ImageQt
+
+from .image_io import display_size, make_thumbnail
+from .text_template import expand_settings
+from .watermark_core import Watermarker, render_plans
+
+
+class WatermarkPreview(QGraphicsView):
+    """
+    水印预览。
+    原图缩小后作为一个缓存的底图项，水印作为独立的图形项叠加在上面；
+    位置、旋转和透明度都是图形项的变换属性，拖动和旋转不做任何 PIL 处理，
+    完整的合成只在导出时进行。
+    """
+
+    # 拖动水印时发出新的相对位置 (x, y)，0-1范围
+    positionChanged = pyqtSignal(float, float)
+
+    # 预览底图的最大边长
+    MAX_PREVIEW_SIZE = 2048
+
+    def __init__(self, parent=None, plans=render_plans):
+        """
+        :param plans: 生成水印精灵所用的渲染计划缓存
+        """
+        super().__init__(parent)
+        self.plans = plans
+        self._scene = QGraphicsScene(self)
+        self.setScene(self._scene)
+        self.setHorizontalScrollBarPolicy(Qt.ScrollBarPolicy.ScrollBarAlwaysOff)
+        self.setVerticalScrollBarPolicy(Qt.ScrollBarPolicy.ScrollBarAlwaysOff)
+
+        self.base_item = None
+        self.overlay_item = None
+        self.watermarker = None  # 生成当前水印精灵的渲染器
+        self._base_key = None
+        self._sprite_key = None
+        self._image_size = None
+        self._scale = 1.0  # 预览像素 / 原图像素
+        self._dragging = False
+
+    # === 底图 ===
+    def set_base_image(self, image, key):
+        """
+        设置底图。同一 key 的底图只生成一次像素图。
+        :param image: PIL 原图
+        :param key: 底图的缓存键（如图片路径）
+        """
+        if key == self._base_key:
+            return
+        # 预览按 EXIF 方向转正后的尺寸定位水印
+        preview = make_thumbnail(image, self.MAX_PREVIEW_SIZE)
+        pixmap = QPixmap.fromImage(ImageQt.ImageQt(preview))
+        self._image_size = display_size(image)
+        self._scale = preview.width / self._image_size[0]
+        self._base_key = key
+
+        if self.base_item is None:
+            self.base_item = self._scene.addPixmap(pixmap)
+            self.base_item.setTransformationMode(Qt.TransformationMode.SmoothTransformation)
+        else:
+            self.base_item.setPixmap(pixmap)
+        self._scene.setSceneRect(QRectF(pixmap.rect()))
+        self.fitInView(self._scene.sceneRect(), Qt.AspectRatioMode.KeepAspectRatio)
+
+    def clear_image(self):
+        """清空预览"""
+        self._scene.clear()
+        self.base_item = None
+        self.overlay_item = None
+        self._base_key = None
+        self._sprite_key = None
+        self._image_size = None
+
+    # === 水印 ===
+    def set_watermark(self, settings, path=None, sequence=1):
+        """
+        按水印设置更新叠加项。只有影响水印外观的设置变化时才重新生成精灵，
+        位置、旋转和透明度的变化只更新图形项的变换。
+        :param settings: 水印设置
+        :param path: 预览图片的路径，用于展开水印文本中的占位符
+        :param sequence: 预览图片的序号
+        """
+        if self._image_size is None:
+            return
+        sprite_settings = Watermarker.sprite_settings(expand_settings(settings, path, sequence))
+        sprite_settings.pop("position")
+        sprite_key = repr(sorted(sprite_settings.items()))
+        if sprite_key != self._sprite_key:
+            self._sprite_key = sprite_key
+            self.watermarker = self.plans.get(sprite_settings)
+            self._update_sprite()
+        self.update_transform(settings)
+
+    def _update_sprite(self):
+        overlay = self.watermarker.overlay
+        if overlay is None:
+            if self.overlay_item is not None:
+                self.overlay_item.hide()
+            return
+        pixmap = QPixmap.fromImage(ImageQt.ImageQt(overlay))
+        if self.overlay_item is None:
+            self.overlay_item = self._scene.addPixmap(pixmap)
+            self.overlay_item.setZValue(1)
+            self.overlay_item.setTransformationMode(Qt.TransformationMode.SmoothTransformation)
+        else:
+            self.overlay_item.setPixmap(pixmap)
+        self.overlay_item.setTransformOriginPoint(overlay.width / 2, overlay.height / 2)
+        self.overlay_item.show()
+
+    def update_transform(self, settings):
+        """只更新水印项的位置、旋转和透明度"""
+        if self.overlay_item is None or self.watermarker is None:
+            return
+        if self.watermarker.overlay is None:
+            return
+        rotation = settings["rotation"]
+        cx, cy = self.watermarker.center_for(
+            self._image_size, settings["position"], rotation
+        )
+        width, height = self.watermarker.overlay.size
+        self.overlay_item.setScale(self._scale)
+        # PIL 的正角度为逆时针，Qt 为顺时针
+        self.overlay_item.setRotation(-rotation)
+        self.overlay_item.setOpacity(Watermarker.opacity_of(settings))
+        self.overlay_item.setPos(cx * self._scale - width / 2, cy * self._scale - height / 2)
+
+    # === 拖动 ===
+    def _relative_position(self, event):
+        point = self.mapToScene(event.position().toPoint())
+        x = point.x() / self._scale / self._image_size[0]
+        y = point.y() / self._scale / self._image_size[1]
+        return max(0.0, min(1.0, x)), max(0.0, min(1.0, y))
+
+    def mousePressEvent(self, event):
+        if self._image_size is not None and event.button() == Qt.MouseButton.LeftButton:
+            self._dragging = True
+            self.positionChanged.emit(*self._relative_position(event))
+        super().mousePressEvent(event)
+
+    def mouseMoveEvent(self, event):
+        if self._dragging:
+            self.positionChanged.emit(*self._relative_position(event))
+        super().mouseMoveEvent(event)
+
+    def mouseReleaseEvent(self, event):
+        self._dragging = False
+        super().mouseReleaseEvent(event)
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        if self.base_item is not None:
+            self.fitInView(self._scene.sceneRect(), Qt.AspectRatioMode.KeepAspectRatio)
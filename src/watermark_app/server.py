@@ -0,0 +1,246 @@
+import argparse
+import io
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from .image_io import save_image, to_display
+from .storage import TEMPLATE_DB, load_templates
+from .watermark_core import RenderPlanCache
+
+# 单个请求允许的最大图片字节数
+MAX_BODY_BYTES = 200 * 1024 * 1024
+
+CONTENT_TYPES = {"PNG": "image/png", "JPEG": "image/jpeg"}
+
+# 请求中 format 参数的取值 -> Pillow 格式名
+FORMATS = {"png": "PNG", "jpg": "JPEG", "jpeg": "JPEG"}
+
+
+class BadParameter(ValueError):
+    """请求参数无效"""
+
+    def __init__(self, name, message):
+        super().__init__(message)
+        self.name = name
+
+
+def parse_options(query):
+    """
+    在读取图片之前校验请求参数。
+    :param query: parse_qs 的结果
+    :return: (输出格式 "PNG"/"JPEG"，None 表示与原图相同, JPEG 质量)
+    :raises BadParameter: 参数无效
+    """
+    format = query.get("format", [None])[0]
+    if format is not None:
+        if format.lower() not in FORMATS:
+            raise BadParameter("format", f"format 只能是 png 或 jpeg: {format}")
+        format = FORMATS[format.lower()]
+
+    value = query.get("quality", ["90"])[0]
+    try:
+        quality = int(value)
+    except ValueError:
+        quality = None
+    if quality is None or not 1 <= quality <= 100:
+        raise BadParameter("quality", f"quality 必须是 1 到 100 的整数: {value}")
+    return format, quality
+
+
+class WatermarkService:
+    """
+    常驻的水印服务：每个模板的字体和水印图片在启动时预先加载，
+    渲染在固定大小的线程池中进行，并限制同时处理的请求数。
+    """
+
+    def __init__(self, templates, workers=4, max_concurrency=16):
+        """
+        :param templates: {模板名: 水印设置}
+        :param workers: 渲染线程数
+        :param max_concurrency: 同时处理（含排队）的请求上限，超出时立即拒绝
+        """
+        self.templates = dict(templates)
+        # 水印文本含占位符的模板按请求展开，展开结果相同的请求共享同一个计划
+        self.plans = RenderPlanCache()
+        self.watermarkers = {name: self.plans.get(s) for name, s in templates.items()}
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="watermark")
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+
+    def try_acquire(self):
+        """占用一个请求名额，已满时返回 False"""
+        return self._slots.acquire(blocking=False)
+
+    def release(self):
+        self._slots.release()
+
+    def render(self, data, template, format=None, quality=90, filename=None):
+        """
+        在渲染线程池中为图片字节添加水印。
+        :param data: 原图字节
+        :param template: 模板名
+        :param format: 输出格式 "PNG"/"JPEG"，None 表示与原图相同（原图不是 JPEG 时输出 PNG）
+        :param quality: JPEG 质量
+        :param filename: 原图文件名，用于展开水印文本中的 {name} 等占位符
+        :return: (带水印的图片字节, Pillow 格式名)
+        """
+        return self.pool.submit(self._render, template, data, format, quality, filename).result()
+
+    def _render(self, template, data, format, quality, filename):
+        watermarker = self.plans.for_image(self.templates[template], filename, data=data)
+        image = watermarker.apply(data)
+        format = format or image.format
+        if format not in CONTENT_TYPES:
+            format = "PNG"
+        if format != "JPEG":
+            # PNG 不一定读取 EXIF 方向，输出前转正
+            image = to_display(image)
+        out = io.BytesIO()
+        save_image(image, out, format, quality=quality, optimize=False)
+        return out.getvalue(), format
+
+    def close(self):
+        self.pool.shutdown(wait=False)
+
+
+class WatermarkRequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /watermark?template=名称[&format=png|jpeg][&quality=90][&filename=原文件名]
+        请求体为原图字节，响应体为带水印的图片字节。
+        filename 用于展开水印文本中的文件名占位符，EXIF 占位符从请求体读取。
+    GET /templates
+        返回可用模板名列表。
+    """
+
+    protocol_version = "HTTP/1.1"  # 支持 keep-alive
+    timeout = 30  # 空闲连接的超时秒数
+
+    @property
+    def service(self):
+        return self.server.service
+
+    def do_GET(self):
+        if urlparse(self.path).path != "/templates":
+            self.send_error(404, "Not Found")
+            return
+        body = json.dumps(sorted(self.service.watermarkers), ensure_ascii=False).encode("utf-8")
+        self._send(200, body, "application/json; charset=utf-8")
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/watermark":
+            self.send_error(404, "Not Found")
+            return
+
+        query = parse_qs(url.query)
+        template = query.get("template", [""])[0]
+        if template not in self.service.watermarkers:
+            self._discard_body()
+            self.send_error(404, "Unknown template", f"模板不存在: {template}")
+            return
+        try:
+            format, quality = parse_options(query)
+        except BadParameter as e:
+            self._discard_body()
+            self.send_error(400, f"Bad parameter: {e.name}", str(e))
+            return
+
+        # 请求体长度未知时无法跳过它，回复后关闭连接，免得请求体被当作下一个请求解析
+        length = self.headers.get("Content-Length")
+        if length is None:
+            self.close_connection = True
+            self.send_error(411, "Length Required")
+            return
+        try:
+            length = int(length)
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.close_connection = True
+            self.send_error(400, "Bad Content-Length")
+            return
+        if length > MAX_BODY_BYTES:
+            self.close_connection = True
+            self.send_error(413, "Payload Too Large")
+            return
+
+        if not self.service.try_acquire():
+            self._discard_body(length)
+            self.send_error(503, "Too many concurrent requests")
+            return
+        try:
+            data = self.rfile.read(length)
+            try:
+                body, format = self.service.render(
+                    data, template, format, quality, query.get("filename", [None])[0]
+                )
+            except Exception as e:
+                self.send_error(400, "Bad image", f"无法处理图片: {str(e)}")
+                return
+            self._send(200, body, CONTENT_TYPES[format])
+        finally:
+            self.service.release()
+
+    def _discard_body(self, length=None):
+        if length is None:
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+            except ValueError:
+                length = -1
+        if not 0 <= length <= MAX_BODY_BYTES:
+            self.close_connection = True
+            return
+        self.rfile.read(length)
+
+    def _send(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def create_server(host="127.0.0.1", port=8765, templates=None, workers=4, max_concurrency=16):
+    """
+    创建水印 HTTP 服务（尚未开始监听循环）。
+    :param templates: {模板名: 水印设置}，None 表示读取主程序保存的模板
+    :return: ThreadingHTTPServer 对象，其 service 属性为 WatermarkService
+    """
+    if templates is None:
+        templates = load_templates()
+    server = ThreadingHTTPServer((host, port), WatermarkRequestHandler)
+    server.daemon_threads = True
+    server.service = WatermarkService(templates, workers, max_concurrency)
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m watermark_app serve", description="本地水印 HTTP 服务"
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--templates", default=TEMPLATE_DB, help="模板库路径")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 4, help="渲染线程数")
+    parser.add_argument("--max-concurrency", type=int, default=16, help="同时处理的请求上限")
+    args = parser.parse_args(argv)
+
+    server = create_server(
+        args.host,
+        args.port,
+        load_templates(args.templates),
+        args.workers,
+        args.max_concurrency,
+    )
+    names = ", ".join(sorted(server.service.watermarkers)) or "（无）"
+    print(f"水印服务已启动: http://{args.host}:{args.port}  模板: {names}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.service.close()
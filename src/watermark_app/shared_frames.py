@@ -0,0 +1,185 @@
+import threading
+from collections import namedtuple
+from multiprocessing import shared_memory
+
+from PIL import Image
+
+from .export_job import render_export
+from .image_io import _MAP_MODE_BYTES
+
+# 放入共享内存时改用的模式：RGB 在 Pillow 内部本来就是每像素 4 字节，
+# 按 RGBX 存放可以直接映射，合成、缩放和保存都支持 RGBX
+_SHARED_MODES = {"RGB": "RGBX"}
+
+# 共享内存中的一帧，只含名称和描述信息，传给子进程时不复制像素
+FrameRef = namedtuple(
+    "FrameRef",
+    [
+        "name",  # 共享内存块名称
+        "mode",  # 帧在共享内存中的模式
+        "size",  # (宽, 高)
+        "nbytes",  # 像素字节数
+        "info",  # 原图的 info（EXIF、ICC 等）
+        "palette",  # 调色板 (模式, 字节)，没有时为 None
+    ],
+)
+
+
+class FramePool:
+    """
+    主进程一侧的共享内存帧池。
+    每帧占用一块共享内存，块的大小取目前最大的一帧，用完后回收给下一帧，
+    批量导出时只在出现更大的图片时才重新分配；比当前块小的旧块归还时释放。
+    子进程通过 FrameRef 映射同一块内存，像素既不经过 pickle 也不经过管道。
+    """
+
+    def __init__(self):
+        self.block_size = 0
+        self._free = []  # 可以复用的 SharedMemory
+        self._used = {}  # 名称 -> 正在使用的 SharedMemory
+        self._lock = threading.Lock()
+
+    def put(self, image):
+        """
+        把图像的像素复制进一块共享内存。
+        :param image: Image 对象（不会被修改）
+        :return: FrameRef，用完后交给 release()
+        """
+        mode = _SHARED_MODES.get(image.mode, image.mode)
+        if mode in _MAP_MODE_BYTES:
+            data = None
+            nbytes = image.width * image.height * _MAP_MODE_BYTES[mode]
+        else:
+            # 不能直接映射的模式（LA、I、F 等）按原始字节存放，子进程读取时复制一次
+            data = image.tobytes()
+            nbytes = len(data)
+
+        shm = self._acquire(nbytes)
+        if data is None:
+            frame = _frame_image(shm, mode, image.size, nbytes)
+            frame.paste(image)
+            del frame
+        else:
+            shm.buf[:nbytes] = data
+
+        palette = None
+        if image.mode == "P" and image.palette is not None:
+            palette = (image.palette.mode, image.palette.tobytes())
+        return FrameRef(shm.name, mode, image.size, nbytes, dict(image.info), palette)
+
+    def release(self, ref):
+        """归还一帧，块的大小仍是最大帧时留给下一帧复用"""
+        with self._lock:
+            shm = self._used.pop(ref.name, None)
+            if shm is None:
+                return
+            if shm.size >= self.block_size:
+                self._free.append(shm)
+                return
+        _destroy(shm)
+
+    def close(self):
+        """释放全部共享内存，仍在使用的帧也一并释放"""
+        with self._lock:
+            blocks = self._free + list(self._used.values())
+            self._free, self._used = [], {}
+        for shm in blocks:
+            _destroy(shm)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _acquire(self, nbytes):
+        with self._lock:
+            stale = []
+            if nbytes > self.block_size:
+                # 出现更大的帧：之后的块都按它分配，空闲的小块不再复用
+                self.block_size = nbytes
+                stale, self._free = self._free, []
+            shm = self._free.pop() if self._free else None
+        for old in stale:
+            _destroy(old)
+        if shm is None:
+            shm = shared_memory.SharedMemory(create=True, size=self.block_size)
+        with self._lock:
+            self._used[shm.name] = shm
+        return shm
+
+
+def _destroy(shm):
+    shm.close()
+    shm.unlink()
+
+
+def _frame_image(shm, mode, size, nbytes):
+    """
+    把共享内存映射为可以原地修改的图像。
+    :return: Image 对象，可直接映射的模式不复制像素
+    """
+    image = Image.frombuffer(mode, size, shm.buf[:nbytes], "raw", mode, 0, 1)
+    # 与写时复制映射相同，避免 Pillow 在第一次写入时复制整幅图像
+    image.readonly = 0
+    return image
+
+
+def attach(ref):
+    """
+    在子进程中打开一帧对应的共享内存。
+    共享内存由主进程的 FramePool 负责释放，子进程不登记到资源跟踪器。
+    :return: SharedMemory，用完后 close()
+    """
+    try:
+        return shared_memory.SharedMemory(ref.name, track=False)
+    except TypeError:
+        # Python 3.13 之前没有 track 参数；进程池的子进程与主进程共用同一个资源跟踪器，
+        # 重复登记不会导致共享内存被提前删除
+        return shared_memory.SharedMemory(ref.name)
+
+
+def frame_image(shm, ref):
+    """
+    子进程中的帧图像，直接引用共享内存；释放图像之后才能关闭 shm。
+    :param shm: attach() 返回的 SharedMemory
+    :param ref: FrameRef
+    """
+    image = _frame_image(shm, ref.mode, ref.size, ref.nbytes)
+    if ref.palette is not None:
+        image.putpalette(ref.palette[1], ref.palette[0])
+    image.info.update(ref.info)
+    return image
+
+
+# 子进程中的渲染计划缓存，每个进程按需创建一次
+_plans = None
+
+
+def _worker_plans():
+    global _plans
+    if _plans is None:
+        from .storage import PLAN_DIR
+        from .watermark_core import RenderPlanCache
+
+        _plans = RenderPlanCache(PLAN_DIR)
+    return _plans
+
+
+def render_frame(ref, spec):
+    """
+    进程池中执行的导出任务：在共享内存中的帧上原地添加水印，缩放后直接保存。
+    结果写入输出文件，返回给主进程的只有异常信息。
+    :param ref: FrameRef，帧在主进程中已是原图的独立副本
+    :param spec: ExportSpec
+    """
+    shm = attach(ref)
+    error = None
+    try:
+        render_export(frame_image(shm, ref), spec, _worker_plans())
+    except Exception as e:
+        # 异常的回溯仍引用着帧图像，只保留信息，让共享内存可以关闭
+        error = str(e) or type(e).__name__
+    shm.close()
+    if error is not None:
+        raise RuntimeError(error)
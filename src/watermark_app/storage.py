@@ -0,0 +1,294 @@
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+# 设置与模板的存储目录
+APP_DIR = os.path.expanduser("~/.watermark_app")
+SETTINGS_FILE = os.path.join(APP_DIR, "last_settings.json")
+TEMPLATE_DB = os.path.join(APP_DIR, "templates.db")
+LEGACY_TEMPLATE_FILE = os.path.join(APP_DIR, "templates.json")
+PLAN_DIR = os.path.join(APP_DIR, "plans")  # 模板的渲染计划缓存
+WATCH_DB = os.path.join(APP_DIR, "watch.db")  # 监视文件夹的处理记录
+
+
+def atomic_write_json(path, data):
+    """
+    原子地写入 JSON：先写同目录下的临时文件并落盘，再用 rename 替换，
+    任何时刻崩溃都不会留下写了一半的文件。
+    :param path: 目标文件路径
+    :param data: 可序列化为 JSON 的数据
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", suffix=".json", dir=directory)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def load_json(path, default=None):
+    """读取 JSON 文件，文件不存在时返回 default"""
+    if not os.path.exists(path):
+        return default
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+class DebouncedWriter:
+    """
+    防抖的 JSON 写入器：频繁的修改只记录最新内容，停止修改 delay 秒后才写盘一次。
+    写入在后台线程中原子地进行；退出前调用 flush() 立即写入。
+    """
+
+    def __init__(self, path, delay=1.0):
+        self.path = path
+        self.delay = delay
+        self._pending = None
+        self._timer = None
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()  # 保证写盘按提交顺序进行
+
+    def submit(self, data):
+        """
+        提交最新内容。调用方应传入快照（之后不会再被修改的对象）。
+        :param data: 可序列化为 JSON 的数据
+        """
+        with self._lock:
+            self._pending = data
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = threading.Timer(self.delay, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self):
+        """立即写入尚未保存的内容"""
+        with self._write_lock:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                data, self._pending = self._pending, None
+            if data is not None:
+                atomic_write_json(self.path, data)
+
+
+class TemplateStore:
+    """
+    基于 SQLite 的水印模板库，每个模板一行，保存和删除只更新对应的行。
+    首次创建时会自动导入旧版的 templates.json。
+    """
+
+    def __init__(self, path=TEMPLATE_DB, legacy_file=LEGACY_TEMPLATE_FILE):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        is_new = not os.path.exists(path)
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._conn:
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS templates (
+                    name TEXT PRIMARY KEY,
+                    watermark_settings TEXT NOT NULL,
+                    created_at TEXT,
+                    export_settings TEXT
+                )
+                """
+            )
+            # 旧版模板库没有 export_settings 列
+            columns = [row[1] for row in self._conn.execute("PRAGMA table_info(templates)")]
+            if "export_settings" not in columns:
+                self._conn.execute("ALTER TABLE templates ADD COLUMN export_settings TEXT")
+        if is_new and legacy_file:
+            self._import_legacy(legacy_file)
+
+    def _import_legacy(self, legacy_file):
+        try:
+            loaded = load_json(legacy_file, [])
+        except (OSError, ValueError) as e:
+            print(f"导入旧模板失败: {str(e)}")
+            return
+        for temp in loaded:
+            if isinstance(temp, dict) and "name" in temp and "watermark_settings" in temp:
+                self.save(temp)
+
+    def list(self):
+        """
+        按创建顺序返回全部模板。
+        :return: [{"name", "watermark_settings", "created_at"[, "export_settings"]}, ...]
+        """
+        rows = self._conn.execute(
+            "SELECT name, watermark_settings, created_at, export_settings"
+            " FROM templates ORDER BY rowid"
+        )
+        return [self._template(*row) for row in rows]
+
+    @staticmethod
+    def _template(name, settings, created_at, export_settings):
+        template = {
+            "name": name,
+            "watermark_settings": json.loads(settings),
+            "created_at": created_at,
+        }
+        if export_settings is not None:
+            template["export_settings"] = json.loads(export_settings)
+        return template
+
+    def get(self, name):
+        """按名称读取单个模板，不存在时返回 None"""
+        row = self._conn.execute(
+            "SELECT name, watermark_settings, created_at, export_settings"
+            " FROM templates WHERE name = ?",
+            (name,),
+        ).fetchone()
+        if row is None:
+            return None
+        return self._template(*row)
+
+    def save(self, template):
+        """
+        新增或更新一个模板（只写这一行）。
+        :param template: {"name", "watermark_settings", "created_at"[, "export_settings"]}，
+            export_settings 为模板自带的缩放设置 {"resize_method", "resize_value"}
+        """
+        export_settings = template.get("export_settings")
+        if export_settings is not None:
+            export_settings = json.dumps(export_settings, ensure_ascii=False)
+        with self._conn:
+            self._conn.execute(
+                """
+                INSERT INTO templates (name, watermark_settings, created_at, export_settings)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET
+                    watermark_settings = excluded.watermark_settings,
+                    created_at = excluded.created_at,
+                    export_settings = excluded.export_settings
+                """,
+                (
+                    template["name"],
+                    json.dumps(template["watermark_settings"], ensure_ascii=False),
+                    template.get("created_at"),
+                    export_settings,
+                ),
+            )
+
+    def delete(self, name):
+        """删除一个模板"""
+        with self._conn:
+            self._conn.execute("DELETE FROM templates WHERE name = ?", (name,))
+
+    def close(self):
+        self._conn.close()
+
+
+def load_templates(template_db=TEMPLATE_DB):
+    """
+    读取主程序保存的水印模板。
+    :param template_db: 模板库路径
+    :return: {模板名: 水印设置}
+    """
+    store = TemplateStore(template_db)
+    try:
+        loaded = store.list()
+    finally:
+        store.close()
+    return {temp["name"]: _watermark_settings(temp) for temp in loaded}
+
+
+def load_template(name, template_db=TEMPLATE_DB):
+    """
+    只读取一个模板的水印设置（按名称查询，不读取整个模板库）。
+    :param name: 模板名
+    :param template_db: 模板库路径
+    :return: 水印设置，模板不存在时为 None
+    """
+    store = TemplateStore(template_db)
+    try:
+        template = store.get(name)
+    finally:
+        store.close()
+    return None if template is None else _watermark_settings(template)
+
+
+def _watermark_settings(template):
+    settings = dict(template["watermark_settings"])
+    # JSON 中的元组会变成列表
+    for key in ("color", "position"):
+        if isinstance(settings.get(key), list):
+            settings[key] = tuple(settings[key])
+    return settings
+
+
+class ProcessedLedger:
+    """
+    已处理文件的记录（SQLite），按 (路径, 大小, 修改时间) 判断文件是否处理过，
+    程序重启后不会重复处理；文件被替换（大小或修改时间变化）后会重新处理。
+    可以在任意线程中使用。
+    """
+
+    def __init__(self, path=WATCH_DB):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._conn:
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS processed (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    output TEXT,
+                    processed_at REAL
+                )
+                """
+            )
+
+    def is_processed(self, path, size, mtime_ns):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size, mtime_ns FROM processed WHERE path = ?", (path,)
+            ).fetchone()
+        return row is not None and tuple(row) == (size, mtime_ns)
+
+    def outputs(self):
+        """
+        全部已记录的输出文件。
+        :return: {原文件路径: 输出路径}
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT path, output FROM processed WHERE output IS NOT NULL"
+            ).fetchall()
+        return dict(rows)
+
+    def mark(self, path, size, mtime_ns, output=None):
+        """记录一个已处理的文件"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                """
+                INSERT INTO processed (path, size, mtime_ns, output, processed_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(path) DO UPDATE SET
+                    size = excluded.size,
+                    mtime_ns = excluded.mtime_ns,
+                    output = excluded.output,
+                    processed_at = excluded.processed_at
+                """,
+                (path, size, mtime_ns, output, time.time()),
+            )
+
+    def close(self):
+        self._conn.close()
@@ -0,0 +1,194 @@
+import re
+import threading
+from collections import OrderedDict, namedtuple
+
+from PIL import Image
+
+# 文本对齐方式
+ALIGNMENTS = ("left", "center", "right")
+
+# 一行文字排版的结果：
+# mask 为只覆盖墨迹范围的 "L" 蒙版（空行为 None），
+# bbox 为墨迹相对行原点（左上）的 (左, 上, 右, 下)，advance 为行的步进宽度
+LineRun = namedtuple("LineRun", ["mask", "bbox", "advance"])
+
+# 整段文本排版的结果：mask 为所有行合成的 "L" 蒙版（没有墨迹时为 None），
+# bbox 为墨迹相对第一行原点的 (左, 上, 右, 下)
+TextBlock = namedtuple("TextBlock", ["mask", "bbox"])
+
+# 换行时的切分单位：中日韩文字逐字切分，连续空白和其余文字（单词）整体切分
+_CJK = "⺀-鿿가-힯豈-﫿＀-￯"
+_TOKEN_RE = re.compile(f"[{_CJK}]|\\s+|[^\\s{_CJK}]+")
+
+# 不能出现在行首的标点，换行时跟随前一个字
+_NO_LINE_START = set("，。、！？；：）》」』】〉,.!?;:)]}%")
+
+
+class GlyphRunCache:
+    """
+    字形行缓存。
+    每行文字按 (字体, 文本) 只测量和光栅化一次，得到墨迹范围、步进宽度和 "L" 蒙版；
+    换行用到的单词宽度按 (字体, 单词) 缓存。字体对象由 load_font 缓存，同一字体和字号是同一个对象。
+    多行文本、重复渲染以及只有部分行不同的逐图文本都复用已经光栅化的行。
+    返回的蒙版共享，调用方不能修改。
+    """
+
+    def __init__(self, max_runs=512, max_widths=4096):
+        self.max_runs = max_runs
+        self.max_widths = max_widths
+        self._runs = OrderedDict()
+        self._widths = OrderedDict()
+        self._lock = threading.Lock()
+
+    def run(self, font, text):
+        """
+        :param font: 字体对象
+        :param text: 一行文本（不含换行符）
+        :return: LineRun
+        """
+        key = (font, text)
+        with self._lock:
+            cached = self._runs.get(key)
+            if cached is not None:
+                self._runs.move_to_end(key)
+                return cached
+
+        from PIL import ImageDraw
+
+        left, top, right, bottom = font.getbbox(text) if text else (0, 0, 0, 0)
+        mask = None
+        if right > left and bottom > top:
+            mask = Image.new("L", (right - left, bottom - top), 0)
+            ImageDraw.Draw(mask).text((-left, -top), text, font=font, fill=255)
+        run = LineRun(mask, (left, top, right, bottom), self.width(font, text))
+
+        with self._lock:
+            self._runs[key] = run
+            while len(self._runs) > self.max_runs:
+                self._runs.popitem(last=False)
+        return run
+
+    def width(self, font, text):
+        """文本的步进宽度（像素）"""
+        key = (font, text)
+        with self._lock:
+            cached = self._widths.get(key)
+            if cached is not None:
+                self._widths.move_to_end(key)
+                return cached
+
+        width = font.getlength(text) if text else 0.0
+
+        with self._lock:
+            self._widths[key] = width
+            while len(self._widths) > self.max_widths:
+                self._widths.popitem(last=False)
+        return width
+
+    def clear(self):
+        with self._lock:
+            self._runs.clear()
+            self._widths.clear()
+
+
+# 进程内共享的字形行缓存
+glyph_runs = GlyphRunCache()
+
+
+def line_height(font):
+    """字体的自然行高（上伸部加下伸部）"""
+    if hasattr(font, "getmetrics"):
+        ascent, descent = font.getmetrics()
+        return ascent + descent
+    return font.getbbox("Ag")[3]
+
+
+def wrap_text(text, font, max_width=0, runs=glyph_runs):
+    """
+    按换行符分段，并把超过最大宽度的段落折行。
+    按单词（中日韩文字按字）贪心折行，单词宽度逐个累加，
+    单个单词超过最大宽度时按字符断开；行首不出现闭合标点。
+    :param text: 文本
+    :param font: 字体对象
+    :param max_width: 最大行宽（像素），0 表示只按换行符分行
+    :param runs: 字形行缓存
+    :return: 行列表
+    """
+    lines = []
+    for paragraph in text.split("\n"):
+        if not max_width or runs.width(font, paragraph) <= max_width:
+            lines.append(paragraph)
+            continue
+
+        line, line_width = "", 0.0
+        for token in _TOKEN_RE.findall(paragraph):
+            token_width = runs.width(font, token)
+            if token.isspace():
+                # 行首的空白丢弃，行尾的空白在断行时去掉
+                if line:
+                    line, line_width = line + token, line_width + token_width
+                continue
+            if line_width + token_width <= max_width or (line and token in _NO_LINE_START):
+                line, line_width = line + token, line_width + token_width
+                continue
+            if line:
+                lines.append(line.rstrip())
+                line, line_width = "", 0.0
+            if token_width <= max_width:
+                line, line_width = token, token_width
+                continue
+            # 单个单词放不下一行：按字符断开
+            for char in token:
+                char_width = runs.width(font, char)
+                if line and line_width + char_width > max_width:
+                    lines.append(line)
+                    line, line_width = "", 0.0
+                line, line_width = line + char, line_width + char_width
+        lines.append(line.rstrip())
+    return lines
+
+
+def layout_text(text, font, align="left", line_spacing=1.0, max_width=0, runs=glyph_runs):
+    """
+    多行文本排版：折行、按行距排列并按对齐方式摆放各行，合成一张蒙版。
+    单行左对齐的结果与直接绘制整行文本相同。
+    :param text: 文本，可以包含换行符
+    :param font: 字体对象
+    :param align: 对齐方式 "left"/"center"/"right"
+    :param line_spacing: 行距，自然行高的倍数
+    :param max_width: 最大行宽（像素），0 表示不自动折行
+    :param runs: 字形行缓存
+    :return: TextBlock
+    """
+    lines = wrap_text(text, font, max_width, runs)
+    line_runs = [runs.run(font, line) for line in lines]
+    block_width = max(run.advance for run in line_runs)
+    pitch = round(line_height(font) * line_spacing)
+
+    placed = []
+    for index, run in enumerate(line_runs):
+        if run.mask is None:
+            continue
+        if align == "center":
+            x = round((block_width - run.advance) / 2)
+        elif align == "right":
+            x = round(block_width - run.advance)
+        else:
+            x = 0
+        left, top, right, bottom = run.bbox
+        placed.append((run.mask, (x + left, index * pitch + top, x + right, index * pitch + bottom)))
+
+    if not placed:
+        return TextBlock(None, (0, 0, 0, 0))
+    if len(placed) == 1:
+        return TextBlock(*placed[0])
+
+    left = min(box[0] for _, box in placed)
+    top = min(box[1] for _, box in placed)
+    right = max(box[2] for _, box in placed)
+    bottom = max(box[3] for _, box in placed)
+    mask = Image.new("L", (right - left, bottom - top), 0)
+    for line_mask, box in placed:
+        # 以行蒙版为透明度叠加，行距很小时相邻行的墨迹不会互相覆盖
+        mask.paste(255, (box[0] - left, box[1] - top), line_mask)
+    return TextBlock(mask, (left, top, right, bottom))
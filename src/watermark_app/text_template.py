@@ -0,0 +1,156 @@
+import datetime
+import functools
+import io
+import os
+import string
+
+from .image_io import read_metadata
+
+# 水印文本中可以使用的占位符，例如 "© {artist} {date:%Y}"、"{name} #{seq:03d}"
+TEMPLATE_FIELDS = {
+    "name": "文件名（不含扩展名）",
+    "filename": "文件名",
+    "ext": "扩展名（不含点）",
+    "folder": "所在文件夹名",
+    "seq": "序号，从 1 开始",
+    "date": "拍摄时间（EXIF），没有时为文件修改时间",
+    "now": "当前时间",
+    "artist": "作者（EXIF）",
+    "copyright": "版权（EXIF）",
+    "camera": "相机型号（EXIF）",
+    "width": "宽度（像素）",
+    "height": "高度（像素）",
+}
+
+# 需要读取图片文件头的占位符
+_METADATA_FIELDS = {"artist", "copyright", "camera", "date", "width", "height"}
+
+
+class _Formatter(string.Formatter):
+    """缺失的值展开为空字符串"""
+
+    def format_field(self, value, format_spec):
+        if value is None:
+            return ""
+        return super().format_field(value, format_spec)
+
+
+_formatter = _Formatter()
+
+
+@functools.lru_cache(maxsize=256)
+def template_fields(text):
+    """
+    文本中用到的占位符名称。
+    :param text: 水印文本
+    :return: frozenset，不是模板（没有占位符或花括号不成对）时为空
+    """
+    try:
+        names = {
+            field.split(".")[0].split("[")[0]
+            for _, field, _, _ in _formatter.parse(text)
+            if field
+        }
+    except ValueError:
+        return frozenset()
+    return frozenset(name for name in names if name in TEMPLATE_FIELDS)
+
+
+class ImageFields:
+    """
+    一张图片的占位符取值，按需计算：
+    只用到文件名和序号时不打开文件，用到 EXIF 时才读取一次文件头。
+    """
+
+    def __init__(self, path=None, sequence=1, data=None):
+        """
+        :param path: 图片路径或文件名，None 表示没有对应文件（文件名相关的占位符为空）
+        :param sequence: 序号
+        :param data: 图片字节，给出时从中读取元数据（如 HTTP 服务收到的图片）
+        """
+        self.path = path
+        self.sequence = sequence
+        self.data = data
+        self._metadata = None
+
+    def metadata(self):
+        if self._metadata is None:
+            self._metadata = {}
+            source = io.BytesIO(self.data) if self.data is not None else self.path
+            if source is not None:
+                try:
+                    self._metadata = read_metadata(source)
+                except Exception as e:
+                    print(f"读取图片元数据失败: {self.path} - {str(e)}")
+        return self._metadata
+
+    def __getitem__(self, name):
+        if name not in TEMPLATE_FIELDS:
+            raise KeyError(name)
+        if name == "seq":
+            return self.sequence
+        if name == "now":
+            return datetime.datetime.now()
+        if name in _METADATA_FIELDS:
+            value = self.metadata().get(name)
+            if name == "date" and value is None and self.path and os.path.exists(self.path):
+                value = datetime.datetime.fromtimestamp(os.path.getmtime(self.path))
+            return value
+        if not self.path:
+            return None
+        stem, ext = os.path.splitext(os.path.basename(self.path))
+        if name == "name":
+            return stem
+        if name == "filename":
+            return stem + ext
+        if name == "ext":
+            return ext.lstrip(".")
+        return os.path.basename(os.path.dirname(self.path)) or None
+
+
+def expand_text(text, path=None, sequence=1, data=None):
+    """
+    展开水印文本中的占位符。未知的占位符原样保留，格式错误时返回原文本。
+    :param text: 水印文本
+    :param path: 图片路径
+    :param sequence: 序号
+    :param data: 图片字节，给出时从中读取元数据
+    :return: 展开后的文本
+    """
+    if not template_fields(text):
+        return text
+    fields = ImageFields(path, sequence, data)
+    try:
+        return "".join(
+            literal + (_expand_field(fields, field, conversion, spec) if field is not None else "")
+            for literal, field, spec, conversion in _formatter.parse(text)
+        )
+    except (ValueError, TypeError, KeyError, IndexError) as e:
+        print(f"水印文本格式错误: {text} - {str(e)}")
+        return text
+
+
+def _expand_field(fields, field, conversion, spec):
+    name = field.split(".")[0].split("[")[0]
+    if name not in TEMPLATE_FIELDS:
+        # 不是占位符（如普通文本中的花括号内容），原样保留
+        suffix = f"!{conversion}" if conversion else ""
+        suffix += f":{spec}" if spec else ""
+        return "{" + field + suffix + "}"
+    value, _ = _formatter.get_field(field, (), fields)
+    if conversion:
+        value = _formatter.convert_field(value, conversion)
+    return _formatter.format_field(value, _formatter.vformat(spec, (), fields))
+
+
+def expand_settings(settings, path=None, sequence=1, data=None):
+    """
+    为一张图片展开文本水印设置中的占位符。
+    :return: 文本不含占位符时返回原设置对象，否则返回替换了文本的副本
+    """
+    if settings.get("type", "text") != "text":
+        return settings
+    text = settings.get("text", "")
+    if not isinstance(text, str) or not template_fields(text):
+        return settings
+    return dict(settings, text=expand_text(text, path, sequence, data))
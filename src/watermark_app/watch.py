@@ -0,0 +1,271 @@
+import argparse
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from .image_io import IMAGE_EXTENSIONS, close_image, open_image, save_image, to_display
+from .output_plan import PathAllocator
+from .storage import PLAN_DIR, TEMPLATE_DB, WATCH_DB, ProcessedLedger, load_template
+from .watermark_core import RenderPlanCache, render_plans
+
+
+class HotFolderWatcher:
+    """
+    监视文件夹：持续为放入输入文件夹的图片添加水印并写入输出文件夹。
+    用 os.scandir 轮询（每轮只读目录项和 stat，不打开文件），
+    文件大小和修改时间在 settle 秒内不再变化才处理，避免读到仍在复制的文件；
+    处理在固定大小的线程池中进行，排队的文件数有上限；
+    已处理的文件记录在 ProcessedLedger 中，重启后不会重复处理。
+    监视多个文件夹时每个输入文件夹对应输出文件夹中的一个子文件夹；
+    输出重名（如 a.png 与 a.bmp）时依次编号，同一个原文件重新处理时沿用原来的输出路径。
+    """
+
+    def __init__(
+        self,
+        folders,
+        output_dir,
+        settings,
+        ledger,
+        format=None,
+        quality=90,
+        workers=2,
+        settle=2.0,
+        interval=1.0,
+        plans=render_plans,
+    ):
+        """
+        :param folders: 输入文件夹列表
+        :param output_dir: 输出文件夹，不能是输入文件夹之一
+        :param settings: 水印设置（如模板的水印设置），文本中的占位符按文件展开
+        :param ledger: ProcessedLedger 对象
+        :param format: 输出格式 "png"/"jpg"，None 表示与原图相同
+        :param quality: JPEG 质量
+        :param workers: 处理线程数
+        :param settle: 文件保持不变多少秒后才处理
+        :param interval: 轮询间隔秒数
+        :param plans: 渲染计划缓存
+        """
+        self.folders = [os.path.abspath(f) for f in folders]
+        self.output_dir = os.path.abspath(output_dir)
+        if self.output_dir in self.folders:
+            raise ValueError("输出文件夹不能是输入文件夹")
+        # 输入文件夹 -> 输出文件夹，多个输入文件夹时按文件夹名分开（同名的依次编号）
+        self._targets = {}
+        if len(self.folders) == 1:
+            self._targets[self.folders[0]] = self.output_dir
+        else:
+            names = PathAllocator()
+            for folder in self.folders:
+                name = os.path.basename(folder) or "root"
+                self._targets[folder] = names.allocate(self.output_dir, name)[0]
+        self.settings = settings
+        self.plans = plans
+        self.ledger = ledger
+        self.format = format
+        self.quality = quality
+        self.workers = workers
+        self.settle = settle
+        self.interval = interval
+        self.processed_count = 0
+        self.failed_count = 0
+        self.sequence = 0  # 已提交处理的文件数，作为 {seq} 占位符
+        self._candidates = {}  # 路径 -> ((路径, 大小, 修改时间), 首次看到该状态的时间)
+        self._done = set()  # 已处理的 (路径, 大小, 修改时间)
+        self._failed = set()  # 处理失败的 (路径, 大小, 修改时间)，文件变化前不再重试
+        self._inflight = set()  # 正在处理的路径
+        # 输出路径在内存中分配；之前记录的输出和输出文件夹中已有的文件（之前的导出、手动复制的文件）
+        # 都视为已占用，不会被覆盖；只有同一个原文件重新处理时覆盖它自己的输出
+        self._outputs = ledger.outputs()  # 原文件路径 -> 输出路径
+        self._names = PathAllocator(self._outputs.values())
+        for folder in set(self._targets.values()):
+            self._names.reserve_existing(folder)
+        self._names_lock = threading.Lock()
+
+    def scan(self):
+        """
+        扫描一轮输入文件夹。
+        :return: 已稳定、尚未处理的 [(路径, 大小, 修改时间), ...]
+        """
+        now = time.monotonic()
+        ready = []
+        seen = set()
+        for folder in self.folders:
+            try:
+                entries = list(os.scandir(folder))
+            except OSError as e:
+                print(f"无法读取文件夹 {folder}: {str(e)}")
+                continue
+            for entry in entries:
+                name = entry.name
+                if name.startswith(".") or os.path.splitext(name)[1].lower() not in IMAGE_EXTENSIONS:
+                    continue
+                try:
+                    if not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                except OSError:
+                    continue  # 扫描期间被删除
+                key = (entry.path, stat.st_size, stat.st_mtime_ns)
+                seen.add(entry.path)
+                if key in self._done or key in self._failed or entry.path in self._inflight:
+                    continue
+
+                previous = self._candidates.get(entry.path)
+                if previous is None or previous[0] != key:
+                    # 新文件或仍在变化的文件：只在状态变化时查询处理记录
+                    if self.ledger.is_processed(*key):
+                        self._done.add(key)
+                        self._candidates.pop(entry.path, None)
+                    else:
+                        self._candidates[entry.path] = (key, now)
+                elif now - previous[1] >= self.settle:
+                    ready.append(key)
+
+        # 忘记已经消失的文件
+        for path in [p for p in self._candidates if p not in seen]:
+            del self._candidates[path]
+        return ready
+
+    def output_path(self, path):
+        """
+        输出文件路径：输入文件夹对应的输出文件夹中的同名文件，扩展名随输出格式。
+        未指定格式时 JPEG 仍输出 JPEG，其余格式输出 PNG；与其他文件的输出重名时加编号。
+        """
+        with self._names_lock:
+            output_path = self._outputs.get(path)
+            if output_path is not None:
+                return output_path
+            name, ext = os.path.splitext(os.path.basename(path))
+            if self.format == "jpg":
+                ext = ".jpg"
+            elif self.format == "png" or ext.lower() not in (".jpg", ".jpeg"):
+                ext = ".png"
+            folder = self._targets.get(os.path.dirname(path), self.output_dir)
+            output_path = self._names.allocate(folder, name + ext)[0]
+            self._outputs[path] = output_path
+            return output_path
+
+    def process(self, path, sequence=1):
+        """
+        为一个文件添加水印并写入输出文件夹。
+        先写入临时文件再替换，中途退出不会留下半个文件，重复处理结果相同。
+        :param sequence: 文件序号，用于 {seq} 占位符
+        :return: 输出文件路径
+        """
+        output_path = self.output_path(path)
+        format = "jpg" if output_path.lower().endswith((".jpg", ".jpeg")) else "png"
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+        watermarker = self.plans.for_image(self.settings, path, sequence)
+        source = open_image(path, writable=True)
+        tmp_path = output_path + ".part"
+        try:
+            image = watermarker.apply(source)
+            if format != "jpg":
+                # PNG 不一定读取 EXIF 方向，输出前转正
+                image = to_display(image)
+            save_image(image, tmp_path, format, quality=self.quality)
+            os.replace(tmp_path, output_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        finally:
+            # 关闭内存映射，处理完的原图可以立即被移走或删除
+            close_image(source)
+        return output_path
+
+    def run(self, stop_event=None):
+        """
+        持续监视，直到 stop_event 被设置。
+        :param stop_event: threading.Event，None 表示一直运行（Ctrl+C 退出）
+        """
+        stop_event = stop_event or threading.Event()
+        os.makedirs(self.output_dir, exist_ok=True)
+        # 线程池前排队的文件数上限，避免一次把整个文件夹都提交进去
+        max_pending = self.workers * 2
+        pending = {}  # future -> (路径, 大小, 修改时间)
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="watch") as pool:
+            try:
+                while not stop_event.is_set():
+                    for key in self.scan():
+                        if len(pending) >= max_pending:
+                            break
+                        self._inflight.add(key[0])
+                        self.sequence += 1
+                        pending[pool.submit(self.process, key[0], self.sequence)] = key
+
+                    if pending:
+                        done, _ = wait(pending, timeout=self.interval, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            self._finish(pending.pop(future), future)
+                    else:
+                        stop_event.wait(self.interval)
+            finally:
+                # 等待已提交的文件处理完，并记录结果
+                for future, key in pending.items():
+                    self._finish(key, future)
+
+    def _finish(self, key, future):
+        path = key[0]
+        self._inflight.discard(path)
+        self._candidates.pop(path, None)
+        try:
+            output_path = future.result()
+        except Exception as e:
+            self._failed.add(key)
+            self.failed_count += 1
+            print(f"处理失败: {path} - {str(e)}")
+            return
+        self.ledger.mark(*key, output=output_path)
+        self._done.add(key)
+        self.processed_count += 1
+        print(f"已处理: {path} -> {output_path}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m watermark_app watch", description="监视文件夹并自动添加水印"
+    )
+    parser.add_argument("folders", nargs="+", help="输入文件夹")
+    parser.add_argument("--output", required=True, help="输出文件夹")
+    parser.add_argument("--template", required=True, help="使用的模板名")
+    parser.add_argument("--templates", default=TEMPLATE_DB, help="模板库路径")
+    parser.add_argument("--format", choices=("png", "jpg"), help="输出格式，默认与原图相同")
+    parser.add_argument("--quality", type=int, default=90, help="JPEG 质量")
+    parser.add_argument("--workers", type=int, default=2, help="处理线程数")
+    parser.add_argument("--settle", type=float, default=2.0, help="文件保持不变多少秒后处理")
+    parser.add_argument("--interval", type=float, default=1.0, help="轮询间隔秒数")
+    parser.add_argument("--db", default=WATCH_DB, help="处理记录数据库路径")
+    args = parser.parse_args(argv)
+
+    settings = load_template(args.template, args.templates)
+    if settings is None:
+        parser.error(f"模板不存在: {args.template}")
+
+    ledger = ProcessedLedger(args.db)
+    # 保存的模板的计划写入磁盘，重启后无需重新编译
+    plans = RenderPlanCache(PLAN_DIR)
+    plans.get(settings, persist=True)
+    watcher = HotFolderWatcher(
+        args.folders,
+        args.output,
+        settings,
+        ledger,
+        format=args.format,
+        quality=args.quality,
+        workers=args.workers,
+        settle=args.settle,
+        interval=args.interval,
+        plans=plans,
+    )
+    print(f"正在监视: {', '.join(watcher.folders)} -> {watcher.output_dir}")
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        ledger.close()
+        print(f"已处理 {watcher.processed_count} 个文件，失败 {watcher.failed_count} 个")
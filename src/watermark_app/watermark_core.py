@@ -1,8 +1,33 @@
-from PIL import Image, ImageDraw, ImageFont
+import copy
+import functools
+import glob
+import hashlib
+import io
+import json
+import math
+import os
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+from .image_io import (
+    COMPOSITE_MODES,
+    DEEP_MODES,
+    REGION_MODES,
+    display_size,
+    exif_orientation,
+    open_image,
+    to_8bit,
+    to_stored,
+    to_watermark_mode,
+)
+from .text_layout import layout_text
+from .text_template import expand_settings
 
 def apply_text_watermark(image_path, text, font_path=None, font_size=32, color=(255, 255, 255), alpha=128):
     """
-    在图片上添加文本水印。
+    在图片上添加文本水印（右下角，距边缘 20 像素）。
     :param image_path: 原始图片路径
     :param text: 水印文本
     :param font_path: 字体路径（None 表示使用默认字体）
@@ -11,42 +36,1003 @@ def apply_text_watermark(image_path, text, font_path=None, font_size=32, color=(
     :param alpha: 透明度 (0–255)
     :return: 带水印的 Image 对象
     """
-    base = Image.open(image_path).convert("RGBA")
-    txt_layer = Image.new("RGBA", base.size, (255, 255, 255, 0))
-    draw = ImageDraw.Draw(txt_layer)
-
-    font = ImageFont.truetype(font_path, font_size) if font_path else ImageFont.load_default()
-    text_w, text_h = draw.textsize(text, font=font)
-    pos = (base.size[0] - text_w - 20, base.size[1] - text_h - 20)  # 右下角
-
-    r, g, b = color
-    draw.text(pos, text, fill=(r, g, b, alpha), font=font)
-
-    combined = Image.alpha_composite(base, txt_layer)
-    return combined.convert("RGB")
+    watermarker = Watermarker(
+        {
+            "type": "text",
+            "text": text,
+            "font_family": font_path or "",
+            "font_size": font_size,
+            "color": tuple(color[:3]) + (alpha,),
+            "position": (1.0, 1.0),
+            "margin": 20,
+        }
+    )
+    return watermarker.apply(image_path).convert("RGB")
 
 def apply_image_watermark(image_path, watermark_path, scale=0.3, alpha=128):
     """
-    在图片上添加图片水印。
+    在图片上添加图片水印（右下角，距边缘 20 像素）。
     :param image_path: 原图路径
     :param watermark_path: 水印图片路径（必须为 PNG）
-    :param scale: 缩放比例
+    :param scale: 水印宽度相对原图宽度的比例
     :param alpha: 透明度 (0–255)
     :return: 带水印的 Image 对象
     """
-    base = Image.open(image_path).convert("RGBA")
-    wm = Image.open(watermark_path).convert("RGBA")
+    base = load_image(image_path)
+    with Image.open(watermark_path) as logo:
+        logo_width = logo.width
+    watermarker = Watermarker(
+        {
+            "type": "image",
+            "image_path": watermark_path,
+            # 水印按显示方向摆放，比例也按转正后的宽度计算
+            "image_scale": scale * display_size(base)[0] / logo_width * 100,
+            "transparency": alpha / 255 * 100,
+            "position": (1.0, 1.0),
+            "margin": 20,
+        }
+    )
+    return watermarker.apply(base).convert("RGB")
+
+def composite_region(base, overlay, dest):
+    """
+    将水印图层合成到底图上，只读写水印覆盖的区域，底图保持原有模式。
+    不能直接合成的模式只把水印区域转换后合成再转回。
+    :param base: 可写的底图（image_io.WATERMARK_MODES 中的模式）
+    :param overlay: RGBA 水印图层
+    :param dest: 水印左上角坐标，可以超出底图边界
+    :return: 合成后的底图（与 base 为同一对象）
+    """
+    x, y = int(dest[0]), int(dest[1])
+    left, top = max(0, x), max(0, y)
+    right = min(base.width, x + overlay.width)
+    bottom = min(base.height, y + overlay.height)
+    if right <= left or bottom <= top:
+        return base
+
+    box = (left, top, right, bottom)
+    if (left - x, top - y, right - x, bottom - y) != (0, 0, overlay.width, overlay.height):
+        overlay = overlay.crop((left - x, top - y, right - x, bottom - y))
+
+    if base.mode == "RGBA":
+        base.alpha_composite(overlay, dest=(left, top))
+    elif base.mode == "LA":
+        region = base.crop(box).convert("RGBA")
+        region.alpha_composite(overlay)
+        base.paste(region.convert("LA"), box)
+    elif base.mode in DEEP_MODES:
+        _composite_deep(base, overlay, box)
+    elif base.mode in REGION_MODES:
+        _composite_converted(base, overlay, box)
+    else:
+        # 不透明底图：按水印 Alpha 混合即等价于 alpha_composite
+        base.paste(overlay.convert(base.mode), box, overlay.getchannel("A"))
+    return base
+
+
+# 有水印覆盖（Alpha > 0）的像素为 255，用于不能按比例混合的模式
+_COVERED = [0] + [255] * 255
+
+
+def _composite_deep(base, overlay, box):
+    """高位深灰度：按数值把水印亮度混合到区域中，保持原位深"""
+    import numpy as np
+
+    region = base.crop(box)
+    raw = np.asarray(region)
+    values = raw.astype(np.float32)
+    alpha = np.asarray(overlay.getchannel("A"), dtype=np.float32) / 255.0
+    luminance = np.asarray(overlay.convert("L"), dtype=np.float32) * DEEP_MODES[base.mode]
+    blended = values + (luminance - values) * alpha
+    if np.issubdtype(raw.dtype, np.integer):
+        limits = np.iinfo(raw.dtype)
+        blended = np.clip(np.rint(blended), limits.min, limits.max)
+    region.frombytes(blended.astype(raw.dtype).tobytes())
+    base.paste(region, box)
+
+
+def _composite_converted(base, overlay, box):
+    """调色板、1 位和 YCbCr：区域转为 RGBA 合成后转回原模式"""
+    region = base.crop(box)
+    composited = region.convert("RGBA")
+    composited.alpha_composite(overlay)
+    mask = None
+    if base.mode == "P":
+        # 映射回原调色板，只替换被水印覆盖的像素（保留透明色索引）
+        composited = composited.convert("RGB").quantize(palette=base, dither=Image.Dither.NONE)
+        mask = overlay.getchannel("A").point(_COVERED)
+    elif base.mode == "1":
+        composited = composited.convert("L").convert("1", dither=Image.Dither.NONE)
+        mask = overlay.getchannel("A").point(_COVERED)
+    else:
+        composited = composited.convert(base.mode)
+    base.paste(composited, box, mask)
+
+
+class LogoCache:
+    """
+    图片水印缓存。
+    每个水印文件按 (路径, 修改时间) 只解码一次，并预先生成逐级减半的金字塔；
+    实际请求过的 (尺寸, 透明度, 旋转角度) 组合会被记住，重复渲染直接复用。
+    返回的图像在缓存间共享，调用方不能修改。
+    """
+
+    # 金字塔最小一级的短边长度
+    MIN_LEVEL_SIZE = 16
+
+    def __init__(self, max_variants=64):
+        self.max_variants = max_variants
+        self._pyramids = {}  # (路径, 修改时间) -> [原尺寸, 1/2, 1/4, ...]
+        self._variants = OrderedDict()  # 变体键 -> Image，按最近使用排序
+        self._lock = threading.RLock()
+
+    def _pyramid(self, path):
+        key = (os.path.abspath(path), os.path.getmtime(path))
+        levels = self._pyramids.get(key)
+        if levels is None:
+            # 文件被修改过时丢弃旧的金字塔和变体
+            self._invalidate(path)
+            with Image.open(path) as logo:
+                logo = logo.convert("RGBA") if logo.mode != "RGBA" else logo.copy()
+            levels = [logo]
+            while min(levels[-1].size) >= self.MIN_LEVEL_SIZE * 2:
+                levels.append(levels[-1].reduce(2))
+            self._pyramids[key] = levels
+        return key, levels
+
+    def get(self, path, scale=1.0, opacity=1.0, rotation=0):
+        """
+        获取缩放、调整透明度并旋转后的水印图像。
+        :param path: 水印图片路径
+        :param scale: 相对原图的缩放比例
+        :param opacity: 不透明度 (0–1)，与水印自身的 Alpha 相乘
+        :param rotation: 逆时针旋转角度
+        :return: RGBA 模式的 Image 对象（共享，不可修改）
+        """
+        with self._lock:
+            return self._get(path, scale, opacity, rotation)
+
+    def _get(self, path, scale, opacity, rotation):
+        key, levels = self._pyramid(path)
+        original = levels[0]
+        size = (
+            max(10, int(original.width * scale)),
+            max(10, int(original.height * scale)),
+        )
+        variant_key = key + (size, round(opacity, 3), rotation % 360)
+        cached = self._variants.get(variant_key)
+        if cached is not None:
+            self._variants.move_to_end(variant_key)
+            return cached
+
+        if opacity < 1 or rotation % 360:
+            # 先取（或生成）同尺寸的不透明、未旋转版本，再在小图上调整
+            logo = self._get(path, scale, 1.0, 0)
+            if opacity < 1:
+                logo = logo.copy()
+                alpha = logo.getchannel("A").point(
+                    [int(a * max(0.0, opacity)) for a in range(256)]
+                )
+                logo.putalpha(alpha)
+            if rotation % 360:
+                logo = logo.rotate(
+                    rotation, expand=True, resample=Image.Resampling.BICUBIC
+                )
+        else:
+            # 从不小于目标尺寸的最小一级缩放，缩放量越小越快
+            source = original
+            for level in levels[1:]:
+                if level.width < size[0] or level.height < size[1]:
+                    break
+                source = level
+            if source.size == size:
+                logo = source
+            else:
+                logo = source.resize(size, Image.Resampling.LANCZOS)
+
+        self._variants[variant_key] = logo
+        while len(self._variants) > self.max_variants:
+            self._variants.popitem(last=False)
+        return logo
+
+    def invalidate(self, path=None):
+        """清除指定水印（或全部水印）的缓存"""
+        with self._lock:
+            self._invalidate(path)
+
+    def _invalidate(self, path):
+        if path is None:
+            self._pyramids.clear()
+            self._variants.clear()
+            return
+        path = os.path.abspath(path)
+        for key in [k for k in self._pyramids if k[0] == path]:
+            del self._pyramids[key]
+        for key in [k for k in self._variants if k[0] == path]:
+            del self._variants[key]
+
+
+# 进程内共享的图片水印缓存
+logo_cache = LogoCache()
+
+
+# 自适应颜色：统计区域缩小到的短边长度、改用黑字的平均亮度、需要描边的亮度标准差
+ADAPTIVE_SAMPLE_SIZE = 32
+ADAPTIVE_DARK_ABOVE = 140
+ADAPTIVE_BUSY_STDDEV = 48
+
+# 隐形水印编号的上限。嵌入格式有 32 位，但界面的 QSpinBox 只能表示 31 位，
+# 统一限制为 31 位，模板中保存的编号在界面中不会被截断
+MAX_INVISIBLE_ID = 2**31 - 1
+
+# 默认水印设置，与主程序 watermark_settings 的格式一致
+DEFAULT_SETTINGS = {
+    "type": "text",  # "text" 或 "image"
+    "text": "水印",
+    "font_family": "SimHei",
+    "font_size": 36,
+    "font_bold": False,
+    "font_italic": False,
+    "color": (255, 255, 255, 128),  # RGBA
+    "transparency": 50,  # 0-100
+    "shadow": False,
+    "stroke": False,
+    "stroke_color": (0, 0, 0),  # 描边颜色 (R, G, B)
+    "image_path": "",
+    "image_scale": 100,  # 百分比
+    "position": (0.5, 0.5),  # 相对位置 (x, y) 0-1范围
+    "auto_position": False,  # 每张图片自动选择细节最少的位置（四角、四边中点或中心）
+    "adaptive_color": False,  # 文本水印按每张图片水印下方的亮度自动选择黑/白色和描边
+    "invisible_id": 0,  # 隐形水印编号（1 到 MAX_INVISIBLE_ID），0 表示不嵌入
+    "invisible_key": "",  # 隐形水印密钥，空表示默认密钥
+    "rotation": 0,  # 角度
+    "text_align": "left",  # 多行文本对齐方式 "left"/"center"/"right"
+    "line_spacing": 1.0,  # 行距，自然行高的倍数
+    "max_width": 0,  # 文本最大行宽（像素），超出时自动折行，0 表示不折行
+    "margin": 0,  # 水印与图片边缘保留的像素数
+}
+
+WINDOWS_FONT_DIR = "C:/Windows/Fonts/"  # Windows系统默认字体目录
+
+# 中文常见字体映射表
+FONT_FILE_MAP = {
+    "SimHei": "simhei.ttf",  # 黑体（常规）
+    "Microsoft YaHei": "msyh.ttc",  # 微软雅黑
+    "SimSun": "simsun.ttc",  # 宋体
+    "KaiTi": "simkai.ttf",  # 楷体
+    "Arial": "arial.ttf",  # Arial
+    "Arial Bold": "arialbd.ttf",  # Arial粗体
+    "Times New Roman": "times.ttf",  # Times New Roman
+}
+
+
+@functools.lru_cache(maxsize=32)
+def load_font(font_family, font_size, bold=False, italic=False):
+    """
+    按字体名加载字体：先查映射表，再搜索字体目录，最后使用默认字体。
+    结果会被缓存，同一字体只加载一次。
+    :param font_family: 字体名或字体文件路径
+    :param font_size: 字号
+    :param bold: 是否粗体
+    :param italic: 是否斜体
+    :return: (字体对象, 是否退回到了 Pillow 默认字体)
+    """
+    from PIL import ImageFont
+
+    # 没有指定字体：直接使用 Pillow 默认字体，空关键字会匹配字体目录中的任意文件
+    if not font_family:
+        return ImageFont.load_default(), True
+
+    # 0. 直接给出字体文件路径
+    if os.path.isfile(font_family):
+        try:
+            return ImageFont.truetype(font_family, font_size, encoding="utf-8"), False
+        except Exception as e:
+            print(f"❌ 加载字体文件失败：{str(e)}，尝试搜索方式加载")
+
+    # 1. 优先使用映射表加载字体
+    if font_family in FONT_FILE_MAP:
+        font_path = os.path.join(WINDOWS_FONT_DIR, FONT_FILE_MAP[font_family])
+        if os.path.exists(font_path):
+            try:
+                if font_path.endswith(".ttc"):
+                    # TTF集合文件（.ttc）的样式索引
+                    index = 3 if bold and italic else 1 if bold else 2 if italic else 0
+                    return ImageFont.truetype(
+                        font_path, font_size, index=index, encoding="utf-8"
+                    ), False
+                bold_file = FONT_FILE_MAP.get(f"{font_family} Bold")
+                if bold and bold_file:
+                    bold_path = os.path.join(WINDOWS_FONT_DIR, bold_file)
+                    if os.path.exists(bold_path):
+                        font_path = bold_path
+                return ImageFont.truetype(font_path, font_size, encoding="utf-8"), False
+            except Exception as e:
+                print(f"❌ 加载映射字体失败：{str(e)}，尝试搜索方式加载")
+
+    # 2. 若映射表未命中，搜索字体目录
+    search_keyword = font_family
+    if bold and italic:
+        search_keyword += " Bold Italic"
+    elif bold:
+        search_keyword += " Bold"
+    elif italic:
+        search_keyword += " Italic"
+
+    for ext in [".ttf", ".ttc", ".otf"]:
+        matched_files = glob.glob(
+            os.path.join(WINDOWS_FONT_DIR, f"*{search_keyword}*{ext}")
+        ) or glob.glob(os.path.join(WINDOWS_FONT_DIR, f"*{search_keyword.lower()}*{ext}"))
+        if matched_files:
+            try:
+                return ImageFont.truetype(matched_files[0], font_size, encoding="utf-8"), False
+            except Exception as e:
+                print(f"❌ 加载搜索到的字体失败：{str(e)}")
+            break
+
+    # 3. 兜底方案：系统默认中文字体，最后是 Pillow 默认字体
+    try:
+        return ImageFont.truetype("simhei.ttf", font_size, encoding="utf-8"), False
+    except Exception:
+        return ImageFont.load_default(), True
+
+
+def render_text_overlay(
+    text,
+    font,
+    color,
+    shadow=False,
+    stroke=False,
+    rotation=0,
+    align="left",
+    line_spacing=1.0,
+    max_width=0,
+    stroke_color=(0, 0, 0),
+):
+    """
+    把文本渲染成只有文本大小的水印图层（含阴影、描边和旋转）。
+    文本先排版成一张蒙版（多行、对齐、折行），阴影、描边和文字都用这张蒙版填色，不再重复绘制文本。
+    :param text: 水印文本，可以包含换行符
+    :param font: 字体对象
+    :param color: 文字颜色 (R, G, B, A)
+    :param shadow: 是否添加阴影
+    :param stroke: 是否添加描边
+    :param rotation: 逆时针旋转角度
+    :param align: 多行文本的对齐方式 "left"/"center"/"right"
+    :param line_spacing: 行距，自然行高的倍数
+    :param max_width: 最大行宽（像素），0 表示不自动折行
+    :param stroke_color: 描边颜色 (R, G, B)，透明度与文字相同
+    :return: (RGBA 图层, 文本宽高, 图层左上角相对文本定位点的偏移)
+    """
+    block = layout_text(text, font, align, line_spacing, max_width)
+    left, top, right, bottom = block.bbox
+    text_width = right - left
+    text_height = bottom - top
+
+    # 阴影和描边各需要2像素边距
+    margin = 2
+    layer = Image.new(
+        "RGBA", (text_width + margin * 2, text_height + margin * 2), (0, 0, 0, 0)
+    )
+
+    if block.mask is not None:
+        if shadow:
+            shadow_color = (0, 0, 0, int(color[3] * 0.5))
+            layer.paste(shadow_color, (margin + 2, margin + 2), block.mask)
+
+        if stroke:
+            stroke_width = 2
+            for dx in [-stroke_width, 0, stroke_width]:
+                for dy in [-stroke_width, 0, stroke_width]:
+                    if dx != 0 or dy != 0:
+                        layer.paste(
+                            tuple(stroke_color[:3]) + (color[3],),
+                            (margin + dx, margin + dy),
+                            block.mask,
+                        )
+
+        layer.paste(tuple(color), (margin, margin), block.mask)
+
+    overlay = layer, (text_width, text_height), (left - margin, top - margin)
+    return rotate_overlay(overlay, rotation)
+
+
+def rotate_overlay(overlay, rotation):
+    """
+    以水印中心为基准旋转文本图层，一次仿射变换得到紧贴的外接矩形，并修正偏移。
+    :param overlay: render_text_overlay 返回的 (图层, 文本宽高, 偏移)
+    :param rotation: 逆时针旋转角度
+    :return: 同样格式的三元组
+    """
+    if not rotation % 360:
+        return overlay
+    layer, text_size, (offset_x, offset_y) = overlay
+    rotated = layer.rotate(rotation, expand=True, resample=Image.Resampling.BICUBIC)
+    offset_x -= (rotated.width - layer.width) / 2
+    offset_y -= (rotated.height - layer.height) / 2
+    return rotated, text_size, (offset_x, offset_y)
+
+
+class TextOverlayCache:
+    """
+    文本水印图层缓存。
+    未旋转的图层按 (文本, 字体, 颜色, 特效, 排版) 缓存，旋转结果按 (图层键, 角度) 缓存：
+    改变角度只需要对已绘制的图层做一次旋转，不再重新绘制文本；
+    同样的设置重复渲染（批量导出）直接复用。返回的图层共享，调用方不能修改。
+    """
+
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(
+        self,
+        text,
+        font_spec,
+        color,
+        shadow=False,
+        stroke=False,
+        rotation=0,
+        align="left",
+        line_spacing=1.0,
+        max_width=0,
+        stroke_color=(0, 0, 0),
+    ):
+        """
+        :param text: 水印文本
+        :param font_spec: (字体名, 字号, 粗体, 斜体)，传给 load_font
+        :param color: 文字颜色 (R, G, B, A)
+        :param shadow: 是否添加阴影
+        :param stroke: 是否添加描边
+        :param rotation: 逆时针旋转角度
+        :param align: 多行文本的对齐方式
+        :param line_spacing: 行距倍数
+        :param max_width: 最大行宽（像素），0 表示不自动折行
+        :param stroke_color: 描边颜色 (R, G, B)
+        :return: (图层, 文本宽高, 偏移)，与 render_text_overlay 相同
+        """
+        layout = (align, float(line_spacing), int(max_width), tuple(stroke_color[:3]))
+        key = (text, tuple(font_spec), tuple(color), bool(shadow), bool(stroke)) + layout
+        angle = rotation % 360
+        with self._lock:
+            cached = self._lookup(key + (angle,))
+            if cached is not None:
+                return cached
+            upright = self._lookup(key + (0,))
+
+        if upright is None:
+            font, _ = load_font(*font_spec)
+            upright = render_text_overlay(text, font, color, shadow, stroke, 0, *layout)
+            with self._lock:
+                self._store(key + (0,), upright)
+        if not angle:
+            return upright
+
+        rotated = rotate_overlay(upright, angle)
+        with self._lock:
+            self._store(key + (angle,), rotated)
+        return rotated
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def _store(self, key, entry):
+        self._entries[key] = entry
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# 进程内共享的文本水印图层缓存
+text_overlay_cache = TextOverlayCache()
+
+
+def place_overlay(image_size, box_size, position, offset=(0, 0), clamp_size=None, margin=0):
+    """
+    根据相对位置计算水印图层左上角坐标。
+    :param image_size: 底图尺寸
+    :param box_size: 参与定位的水印尺寸
+    :param position: 相对位置 (x, y)，0-1范围
+    :param offset: 图层左上角相对定位点的偏移
+    :param clamp_size: 给出时把该尺寸的图层限制在底图范围内
+    :param margin: 与底图边缘保留的像素数，位置 0 和 1 分别对应左上和右下边距处
+    :return: (x, y)
+    """
+    x = margin + (image_size[0] - box_size[0] - margin * 2) * position[0] + offset[0]
+    y = margin + (image_size[1] - box_size[1] - margin * 2) * position[1] + offset[1]
+    if clamp_size is not None:
+        x = max(0, min(int(x), image_size[0] - clamp_size[0]))
+        y = max(0, min(int(y), image_size[1] - clamp_size[1]))
+    return x, y
+
+
+def load_image(source):
+    """
+    把 Image 对象、图片路径或图片字节统一为可写的 Image 对象。
+    :param source: Image 对象、路径（str/PathLike）或 bytes
+    :return: Image 对象（传入 Image 时原样返回）
+    """
+    if isinstance(source, Image.Image):
+        return source
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        image = Image.open(io.BytesIO(source))
+        image.load()
+        return image
+    return open_image(os.fspath(source), writable=True)
+
+
+class Watermarker:
+    """
+    可复用的水印渲染器。
+    构造时按设置一次性准备好字体、文本图层或图片水印，
+    之后每张图片只需要一次局部合成，适合批量和多线程处理。
+    """
+
+    def __init__(self, settings=None, logo_cache=logo_cache):
+        """
+        :param settings: 水印设置，格式与主程序的 watermark_settings 相同，缺省项取默认值
+        :param logo_cache: 图片水印缓存
+        """
+        self.settings = dict(DEFAULT_SETTINGS, **(settings or {}))
+        self.font = None
+        self.font_fallback = False  # 是否退回到了 Pillow 默认字体
+        self.overlay = None  # 准备好的 RGBA 水印图层，没有有效水印时为 None
+        self._box_size = None
+        self._offset = (0, 0)
+        self._clamp = False
+
+        s = self.settings
+        if s["type"] == "text":
+            self.font, self.font_fallback = load_font(*self._font_spec())
+            self.overlay, self._box_size, self._offset = self._text_overlay(
+                s["color"], s["stroke"], s["stroke_color"]
+            )
+        else:
+            path = s.get("image_path", "")
+            if path and os.path.exists(path):
+                self.overlay = logo_cache.get(
+                    path, s["image_scale"] / 100.0, s["transparency"] / 100.0, s["rotation"]
+                )
+                self._box_size = self.overlay.size
+                self._clamp = True
+
+    def _font_spec(self):
+        s = self.settings
+        return s["font_family"], s["font_size"], s["font_bold"], s["font_italic"]
+
+    def _text_overlay(self, color, stroke, stroke_color):
+        """按设置的文本、字体和排版取（或绘制）文本图层，颜色和描边可以替换"""
+        s = self.settings
+        text = s["text"] if isinstance(s["text"], str) else str(s["text"], encoding="utf-8")
+        return text_overlay_cache.get(
+            text,
+            self._font_spec(),
+            color,
+            s["shadow"],
+            stroke,
+            s["rotation"],
+            s["text_align"],
+            s["line_spacing"],
+            s["max_width"],
+            stroke_color,
+        )
+
+    def adaptive_style(self, image, position=None):
+        """
+        按水印下方区域的亮度统计选择对比色：
+        亮背景用黑字、暗背景用白字，背景起伏大（标准差高）时加反色描边。
+        只统计水印覆盖的区域，大区域先整数倍缩小，不读取整幅图片。
+        :param image: 底图
+        :param position: 相对位置，None 表示使用设置中的位置
+        :return: 替换的设置 {"color", "stroke", "stroke_color"}，没有可统计的区域时为空
+        """
+        if self.overlay is None:
+            return {}
+        orientation = exif_orientation(image)
+        size = display_size(image, orientation)
+        overlay, dest = to_stored(self.overlay, self.position_for(size, position), size, orientation)
+        left, top = max(0, int(dest[0])), max(0, int(dest[1]))
+        right = min(image.width, int(dest[0]) + overlay.width)
+        bottom = min(image.height, int(dest[1]) + overlay.height)
+        if right <= left or bottom <= top:
+            return {}
+        from PIL import ImageStat
+
+        region = image.crop((left, top, right, bottom))
+        factor = min(region.size) // ADAPTIVE_SAMPLE_SIZE
+        if factor > 1 and region.mode in COMPOSITE_MODES:
+            region = region.reduce(factor)
+        region = to_8bit(region)
+        if region.mode != "L":
+            region = region.convert("L")
+        stat = ImageStat.Stat(region)
+        mean, stddev = stat.mean[0], stat.stddev[0]
+
+        dark = mean > ADAPTIVE_DARK_ABOVE
+        return {
+            "color": ((0, 0, 0) if dark else (255, 255, 255)) + (self.settings["color"][3],),
+            "stroke": self.settings["stroke"] or stddev > ADAPTIVE_BUSY_STDDEV,
+            "stroke_color": (255, 255, 255) if dark else (0, 0, 0),
+        }
+
+    @staticmethod
+    def sprite_settings(settings):
+        """
+        去掉旋转和透明度的设置，用于生成交互预览的水印精灵。
+        这两项以及位置在预览中作为图形项的变换属性处理，改变时不需要重新渲染。
+        """
+        sprite = dict(DEFAULT_SETTINGS, **settings)
+        sprite["rotation"] = 0
+        sprite["transparency"] = 100
+        sprite["color"] = tuple(sprite["color"][:3]) + (255,)
+        return sprite
+
+    @staticmethod
+    def opacity_of(settings):
+        """设置对应的水印不透明度 (0–1)"""
+        if settings.get("type", "text") == "text":
+            return settings["color"][3] / 255.0
+        return settings["transparency"] / 100.0
+
+    def position_for(self, image_size, position=None):
+        """
+        计算水印在指定尺寸图片上的左上角坐标。
+        :param position: 相对位置，None 表示使用设置中的位置
+        """
+        return place_overlay(
+            image_size,
+            self._box_size,
+            position or self.settings["position"],
+            self._offset,
+            self.overlay.size if self._clamp else None,
+            self.settings["margin"],
+        )
+
+    def center_for(self, image_size, position=None, rotation=0):
+        """
+        计算水印中心在图片上的坐标，供预览把未旋转的精灵绕中心旋转后摆放。
+        :param position: 相对位置，None 表示使用设置中的位置
+        :param rotation: 预览中额外施加的旋转角度
+        :return: (x, y)
+        """
+        width, height = self.overlay.size
+        if not self._clamp:
+            # 文本水印以文本为基准定位，中心与旋转无关
+            x, y = self.position_for(image_size, position)
+            return x + width / 2, y + height / 2
+
+        # 图片水印以旋转后的外接矩形定位，并限制在图片范围内
+        rad = math.radians(rotation)
+        box = (
+            abs(width * math.cos(rad)) + abs(height * math.sin(rad)),
+            abs(width * math.sin(rad)) + abs(height * math.cos(rad)),
+        )
+        x, y = place_overlay(
+            image_size,
+            box,
+            position or self.settings["position"],
+            clamp_size=box,
+            margin=self.settings["margin"],
+        )
+        return x + box[0] / 2, y + box[1] / 2
+
+    def auto_position(self, image, detail=None):
+        """
+        在候选位置中选出水印覆盖区域细节最少的位置，避免压在人脸或密集的细节上。
+        :param image: Image 对象
+        :param detail: 已计算的 placement.DetailMap，None 表示现在计算
+        :return: 相对位置 (x, y)；没有有效水印时返回设置中的位置
+        """
+        if self.overlay is None:
+            return self.settings["position"]
+        from .placement import CANDIDATE_POSITIONS, DetailMap
+
+        detail = detail or DetailMap(image)
+        width, height = self.overlay.size
+        boxes = []
+        for position in CANDIDATE_POSITIONS:
+            x, y = self.position_for(detail.size, position)
+            boxes.append((x, y, x + width, y + height))
+        return CANDIDATE_POSITIONS[int(detail.scores(boxes).argmin())]
+
+    def save_plan(self, path):
+        """
+        把准备好的水印图层和定位信息保存为 PNG（定位信息写在文本块中），
+        之后可以用 load_plan 直接恢复，不再加载字体或重新绘制。
+        没有有效水印时不保存。
+        :param path: 目标 .png 路径
+        """
+        if self.overlay is None:
+            return
+        meta = {
+            "settings": self.settings,
+            "box_size": list(self._box_size),
+            "offset": list(self._offset),
+            "clamp": self._clamp,
+            "font_fallback": self.font_fallback,
+        }
+        from PIL import PngImagePlugin
+
+        info = PngImagePlugin.PngInfo()
+        info.add_text(PLAN_META_KEY, json.dumps(meta, ensure_ascii=False))
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            self.overlay.save(tmp_path, "PNG", pnginfo=info)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    @classmethod
+    def load_plan(cls, path):
+        """
+        从 save_plan 保存的文件恢复渲染器。
+        :param path: .png 路径
+        :return: Watermarker 对象（font 为 None，渲染不需要字体）
+        """
+        with Image.open(path) as plan:
+            meta = json.loads(plan.text[PLAN_META_KEY])
+            overlay = plan.convert("RGBA")
+        settings = dict(DEFAULT_SETTINGS, **meta["settings"])
+        # JSON 中的元组会变成列表
+        for key in ("color", "position", "stroke_color"):
+            if isinstance(settings.get(key), list):
+                settings[key] = tuple(settings[key])
+
+        watermarker = cls.__new__(cls)
+        watermarker.settings = settings
+        watermarker.font = None
+        watermarker.font_fallback = meta["font_fallback"]
+        watermarker.overlay = overlay
+        watermarker._box_size = tuple(meta["box_size"])
+        watermarker._offset = tuple(meta["offset"])
+        watermarker._clamp = meta["clamp"]
+        return watermarker
+
+    def with_position(self, position):
+        """
+        同一个水印图层放在另一个位置的渲染器，图层共享，不重新绘制。
+        :param position: 相对位置 (x, y)
+        :return: Watermarker 对象，位置相同时返回自身
+        """
+        position = tuple(position)
+        if position == tuple(self.settings["position"]):
+            return self
+        plan = copy.copy(self)
+        plan.settings = dict(self.settings, position=position)
+        return plan
+
+    def embed_invisible(self, image):
+        """
+        按设置嵌入隐形水印编号，没有设置编号时原样返回。
+        必须在最终尺寸上进行：之后再缩放会破坏隐形水印。
+        :param image: Image 对象（原地修改）
+        :return: Image 对象
+        """
+        if not self.settings["invisible_id"]:
+            return image
+        from .invisible import embed
+
+        return embed(image, int(self.settings["invisible_id"]), self.settings["invisible_key"])
+
+    def apply(self, image, invisible=True):
+        """
+        为一张图片添加水印。
+        带 EXIF 方向的图片不转正：水印按显示方向定位后换算到存储方向再合成，
+        输出保留原方向标签。开启自动位置或自适应颜色时每张图片单独选择位置或颜色。
+        :param image: Image 对象、图片路径或图片字节
+        :param invisible: 是否同时嵌入隐形水印；之后还要缩放时传 False，缩放后再调用 embed_invisible
+        :return: 带水印的 Image 对象（传入 Image 对象时原地修改并返回它）
+        """
+        image = load_image(image)
+        image = to_watermark_mode(image)
+        if self.overlay is None:
+            return self.embed_invisible(image) if invisible else image
+
+        position = self.auto_position(image) if self.settings["auto_position"] else None
+        overlay = self.overlay
+        if self.settings["adaptive_color"] and self.settings["type"] == "text":
+            style = self.adaptive_style(image, position)
+            if style:
+                # 只换颜色和描边，图层尺寸和定位不变
+                overlay, _, _ = self._text_overlay(
+                    style["color"], style["stroke"], style["stroke_color"]
+                )
+
+        orientation = exif_orientation(image)
+        size = display_size(image, orientation)
+        overlay, dest = to_stored(overlay, self.position_for(size, position), size, orientation)
+        image = composite_region(image, overlay, dest)
+        return self.embed_invisible(image) if invisible else image
+
+    def apply_many(self, images):
+        """
+        逐张添加水印的生成器，同一时间只持有一张图片。
+        :param images: Image 对象、路径或字节组成的可迭代对象
+        """
+        for image in images:
+            yield self.apply(image)
+
+    def map_parallel(self, images, workers=None, executor=None):
+        """
+        在线程池中并行添加水印，按输入顺序返回结果。
+        Pillow 的解码、合成和编码会释放 GIL，共享的水印图层只读。
+        :param images: Image 对象、路径或字节组成的可迭代对象
+        :param workers: 线程数，None 表示由线程池决定
+        :param executor: 已有的 concurrent.futures 执行器，给出时忽略 workers
+        :return: 带水印 Image 对象的迭代器
+        """
+        if executor is not None:
+            return executor.map(self.apply, images)
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        def run():
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                yield from pool.map(self.apply, images)
+
+        return run()
+
+
+# 渲染计划文件中保存定位信息的 PNG 文本块名
+PLAN_META_KEY = "watermark-plan"
+
+
+def settings_key(settings):
+    """
+    水印设置的指纹，设置相同（缺省项按默认值补齐）的模板得到相同的指纹。
+    位置不参与指纹：定位在 apply() 中进行，只有位置不同的设置共享同一个水印图层。
+    图片水印包含水印文件的修改时间，文件更新后指纹随之改变。
+    :return: 十六进制字符串
+    """
+    s = dict(DEFAULT_SETTINGS, **settings)
+    del s["position"]
+    if s["type"] != "text":
+        path = s.get("image_path", "")
+        s["image_mtime"] = os.path.getmtime(path) if path and os.path.exists(path) else None
+    data = json.dumps(s, sort_keys=True, ensure_ascii=False, default=list)
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
+class RenderPlanCache:
+    """
+    渲染计划缓存：每组水印设置（如一个模板）编译为一个 Watermarker，
+    其中已解析好字体并绘制好带描边、阴影和旋转的水印图层。
+    切换模板或批量导出时直接复用，不再做任何准备工作。
+    给出 cache_dir 时，保存的模板的计划（get(..., persist=True)）还会写入磁盘，重启后无需重新编译；
+    预览和编辑中的设置只缓存在内存中。磁盘上最多保留 max_files 个计划，超出时删除最久未用的。
+    水印文本含占位符时用 for_image 按图片展开，展开结果相同的图片共享同一个计划。
+    返回的 Watermarker 在调用方之间共享。
+    """
+
+    def __init__(self, cache_dir=None, max_entries=32, max_variants=256, max_files=64):
+        """
+        :param cache_dir: 计划文件目录，None 表示只缓存在内存中
+        :param max_entries: 内存中保留的计划数
+        :param max_variants: 内存中保留的逐图展开文本的计划数
+        :param max_files: 磁盘上保留的计划文件数
+        """
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_variants = max_variants
+        self.max_files = max_files
+        self._plans = OrderedDict()  # 指纹 -> Watermarker，按最近使用排序
+        self._variants = OrderedDict()  # 展开文本后的指纹 -> Watermarker
+        self._lock = threading.Lock()
+
+    def get(self, settings, persist=False):
+        """
+        获取水印设置对应的渲染计划，没有时编译一个。
+        :param settings: 水印设置
+        :param persist: 是否把计划写入磁盘（只用于保存的模板）
+        :return: Watermarker 对象（共享），位置取 settings 中的位置
+        """
+        key = settings_key(settings)
+        with self._lock:
+            plan = self._plans.get(key)
+            if plan is not None:
+                self._plans.move_to_end(key)
+        if plan is None:
+            plan = self._load(key)
+            if plan is None:
+                plan = Watermarker(settings)
+            with self._lock:
+                self._plans[key] = plan
+                while len(self._plans) > self.max_entries:
+                    self._plans.popitem(last=False)
+        if persist:
+            self._save(key, plan)
+        return plan.with_position(settings.get("position", DEFAULT_SETTINGS["position"]))
+
+    def for_image(self, settings, path=None, sequence=1, data=None):
+        """
+        获取一张图片的渲染计划：水印文本中的占位符（如 {name}、{date:%Y}）按这张图片展开。
+        文本不含占位符时与 get 相同；展开后的计划只缓存在内存中，
+        展开结果相同的图片共享同一个计划和水印图层，不会每张图片重新绘制。
+        :param settings: 水印设置
+        :param path: 图片路径
+        :param sequence: 图片序号，从 1 开始
+        :param data: 图片字节，给出时从中读取 EXIF
+        :return: Watermarker 对象（共享）
+        """
+        expanded = expand_settings(settings, path, sequence, data)
+        if expanded is settings:
+            return self.get(settings)
+
+        key = settings_key(expanded)
+        with self._lock:
+            plan = self._variants.get(key)
+            if plan is not None:
+                self._variants.move_to_end(key)
+                return plan.with_position(expanded.get("position", DEFAULT_SETTINGS["position"]))
+
+        plan = Watermarker(expanded)
+        with self._lock:
+            self._variants[key] = plan
+            while len(self._variants) > self.max_variants:
+                self._variants.popitem(last=False)
+        return plan.with_position(expanded.get("position", DEFAULT_SETTINGS["position"]))
+
+    def _plan_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.png")
+
+    def _load(self, key):
+        if self.cache_dir is None:
+            return None
+        path = self._plan_path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            plan = Watermarker.load_plan(path)
+            # 修改时间记录最近一次使用，淘汰时按它排序
+            os.utime(path)
+            return plan
+        except Exception as e:
+            print(f"读取渲染计划失败: {str(e)}")
+            return None
+
+    def _save(self, key, plan):
+        if self.cache_dir is None:
+            return
+        path = self._plan_path(key)
+        try:
+            if os.path.exists(path):
+                os.utime(path)
+                return
+            os.makedirs(self.cache_dir, exist_ok=True)
+            plan.save_plan(path)
+            self._evict()
+        except OSError as e:
+            print(f"保存渲染计划失败: {str(e)}")
 
-    # 缩放水印
-    w = int(base.width * scale)
-    h = int(wm.height * w / wm.width)
-    wm = wm.resize((w, h))
+    def _evict(self):
+        """磁盘上的计划超过 max_files 个时删除最久未用的"""
+        files = []
+        with os.scandir(self.cache_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith(".png") and entry.is_file():
+                    files.append((entry.stat().st_mtime, entry.path))
+        files.sort()
+        for _, path in files[: max(0, len(files) - self.max_files)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
 
-    # 调整透明度
-    wm.putalpha(alpha)
+    def clear(self):
+        """清空内存中的计划（磁盘上的计划文件保留）"""
+        with self._lock:
+            self._plans.clear()
+            self._variants.clear()
 
-    # 右下角
-    pos = (base.width - w - 20, base.height - h - 20)
-    base.alpha_composite(wm, dest=pos)
 
-    return base.convert("RGB")
+# 进程内共享的渲染计划缓存（只在内存中）
+render_plans = RenderPlanCache()
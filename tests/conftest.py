@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 与 main.py 相同，从 src 目录导入 watermark_app
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
@@ -0,0 +1,61 @@
+import io
+
+import pytest
+from PIL import Image
+
+from watermark_app import image_io, invisible
+from watermark_app.watermark_core import MAX_INVISIBLE_ID, Watermarker
+
+PAYLOAD = 0xC0FFEE
+
+SIZE = (512, 384)
+
+
+@pytest.fixture(scope="module")
+def source():
+    """带纹理的测试图：渐变叠加噪声，接近照片的中频能量"""
+    gradient = Image.linear_gradient("L").resize(SIZE)
+    noise = Image.effect_noise(SIZE, 40)
+    return Image.merge(
+        "RGB",
+        (Image.blend(gradient, noise, 0.5), noise, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT)),
+    )
+
+
+def _jpeg(image, quality):
+    buffer = io.BytesIO()
+    image_io.save_image(image, buffer, "JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+@pytest.mark.parametrize("quality", [95, 90, 75, 60])
+def test_payload_survives_jpeg(source, quality):
+    marked = invisible.embed(source.copy(), PAYLOAD)
+
+    detection = invisible.detect(_jpeg(marked, quality))
+
+    assert detection is not None
+    assert detection.payload == PAYLOAD
+
+
+@pytest.mark.parametrize("quality", [95, 60])
+def test_watermarker_embeds_with_key(source, quality):
+    watermarker = Watermarker({"text": "", "invisible_id": PAYLOAD, "invisible_key": "secret"})
+    data = _jpeg(watermarker.apply(source.copy()), quality)
+
+    assert invisible.detect(data, key="secret").payload == PAYLOAD
+    assert invisible.detect(data) is None
+
+
+@pytest.mark.parametrize("quality", [None, 95, 60])
+def test_unmarked_image(source, quality):
+    image = source if quality is None else _jpeg(source, quality)
+    assert invisible.detect(image) is None
+
+
+def test_largest_id(source):
+    marked = invisible.embed(source.copy(), MAX_INVISIBLE_ID)
+    assert invisible.detect(_jpeg(marked, 90)).payload == MAX_INVISIBLE_ID
+
+    with pytest.raises(ValueError):
+        invisible.embed(source.copy(), MAX_INVISIBLE_ID + 1)
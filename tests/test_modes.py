@@ -0,0 +1,90 @@
+import io
+
+import pytest
+from PIL import Image, ImageChops
+
+from watermark_app import image_io
+from watermark_app.watermark_core import Watermarker
+
+MODES = ["1", "L", "LA", "P", "PA", "RGB", "RGBA", "RGBX", "CMYK", "YCbCr", "LAB", "I", "I;16", "I;16B", "F"]
+
+# 各输出格式保存后可能读回的模式
+VALID_MODES = {"PNG": set(image_io.PNG_MODES), "JPEG": {"L", "RGB", "CMYK"}}
+
+# JPEG 按 8x8 块（色度按 16x16）编码，水印附近的像素也会变化
+BLOCK = 16
+
+SIZE = (320, 240)
+
+
+def _source(mode):
+    """生成指定模式的测试图：偏暗的渐变，白色水印落在上面一定会改变像素"""
+    gray = Image.linear_gradient("L").resize(SIZE).point(lambda v: v // 3)
+    if mode == "LAB":
+        neutral = Image.new("L", SIZE, 128)
+        return Image.merge("LAB", (gray, neutral, neutral))
+    if mode in image_io.DEEP_MODES and mode != "F":
+        return gray.convert("I").point(lambda v: v * 257).convert(mode)
+    if mode in ("1", "L", "LA", "F"):
+        return gray.convert(mode)
+    rgb = Image.merge("RGB", (gray, gray.transpose(Image.Transpose.FLIP_LEFT_RIGHT), gray))
+    if mode == "PA":
+        return rgb.convert("P").convert("PA")
+    return rgb.convert(mode)
+
+
+def _save(image, format):
+    buffer = io.BytesIO()
+    image_io.save_image(image, buffer, format)
+    buffer.seek(0)
+    saved = Image.open(buffer)
+    saved.load()
+    return saved
+
+
+def _comparable(image):
+    return image_io.to_8bit(image).convert("RGB")
+
+
+@pytest.mark.parametrize("format", ["PNG", "JPEG"])
+@pytest.mark.parametrize("mode", MODES)
+def test_watermark_every_mode(mode, format):
+    source = _source(mode)
+    assert source.mode == mode
+    watermarker = Watermarker({"text": "MARK", "font_size": 64, "color": (255, 255, 255, 255)})
+    x, y = watermarker.position_for(SIZE)
+    width, height = watermarker.overlay.size
+    region = (int(x), int(y), int(x) + width, int(y) + height)
+
+    plain = _save(source.copy(), format)
+    marked = _save(watermarker.apply(source.copy()), format)
+
+    assert marked.mode in VALID_MODES[format]
+    assert marked.size == SIZE
+    changed = ImageChops.difference(_comparable(plain), _comparable(marked)).getbbox()
+    assert changed is not None, "水印区域的像素没有变化"
+    margin = BLOCK if format == "JPEG" else 0
+    assert changed[0] >= region[0] - margin and changed[1] >= region[1] - margin
+    assert changed[2] <= region[2] + margin and changed[3] <= region[3] + margin
+
+
+def _stripes(mode):
+    """一像素宽的黑白竖条纹，最近邻缩小只会留下纯黑或纯白"""
+    image = Image.new("L", SIZE)
+    image.putdata([255 * (x % 2) for _ in range(SIZE[1]) for x in range(SIZE[0])])
+    return image.convert(mode)
+
+
+@pytest.mark.parametrize("mode", ["P", "1"])
+def test_resize_resamples_palette_and_bilevel(mode):
+    source = _stripes(mode)
+    assert len(source.convert("L").getcolors()) == 2
+
+    resized = image_io.resize_image(source, "percentage", 50)
+    (_, srcset), = image_io.make_srcset(source, [SIZE[0] // 2])
+
+    for image in (resized, srcset):
+        assert image.size == (SIZE[0] // 2, SIZE[1] // 2)
+        values = {value for _, value in image.convert("L").getcolors()}
+        # LANCZOS 把相邻的黑白条纹混合为灰色
+        assert values - {0, 255}
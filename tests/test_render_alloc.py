@@ -0,0 +1,103 @@
+import pytest
+from PIL import Image
+
+from watermark_app import image_io
+from watermark_app.watermark_core import Watermarker
+
+SIZE = (800, 600)
+
+
+@pytest.fixture
+def full_frames(monkeypatch):
+    """
+    记录之后新建的整幅图像（与原图同样大小）的模式。
+    Pillow 的 copy、convert、resize 等都经由 Image._new 创建结果，Image.new 单独记录。
+    返回的函数开始记录，在打开原图之后调用，原图本身不计入。
+    """
+    frames = []
+
+    def start():
+        original_new, original_image_new = Image.Image._new, Image.new
+
+        def _new(self, im):
+            image = original_new(self, im)
+            if image.size == SIZE:
+                frames.append(image.mode)
+            return image
+
+        def new(mode, size, *args, **kwargs):
+            image = original_image_new(mode, size, *args, **kwargs)
+            if tuple(size) == SIZE:
+                frames.append(mode)
+            return image
+
+        monkeypatch.setattr(Image.Image, "_new", _new)
+        monkeypatch.setattr(Image, "new", new)
+        return frames
+
+    return start
+
+
+def _open_source(tmp_path, ext, mode):
+    image = Image.radial_gradient("L").resize(SIZE)
+    if mode != "L":
+        image = image.convert(mode)
+    path = str(tmp_path / f"source.{ext}")
+    image.save(path)
+    image = image_io.open_image(path)
+    image.load()
+    return image, path
+
+
+@pytest.mark.parametrize("ext", ["png", "jpg", "bmp", "tif"])
+@pytest.mark.parametrize("resize", [("none", 0), ("width", 400), ("percentage", 50)])
+def test_one_full_frame_per_render(tmp_path, full_frames, ext, resize):
+    image, path = _open_source(tmp_path, ext, "RGB")
+    watermarker = Watermarker({"text": "alloc", "font_size": 48})
+
+    frames = full_frames()
+    work = image_io.working_copy(image, path)
+    result = image_io.resize_image(watermarker.apply(work), *resize)
+
+    # working_copy 是唯一的整幅分配，水印原地合成，缩放只产生缩小后的图像
+    assert frames == [work.mode]
+    assert result.size == (SIZE if resize[0] == "none" else (400, 300))
+
+
+@pytest.mark.parametrize("mode, ext", [("L", "png"), ("RGBA", "png"), ("I;16", "tif")])
+def test_watermark_in_place(tmp_path, full_frames, mode, ext):
+    image, path = _open_source(tmp_path, ext, mode)
+    watermarker = Watermarker({"text": "alloc", "font_size": 48})
+
+    frames = full_frames()
+    work = image_io.working_copy(image, path)
+    result = watermarker.apply(work)
+
+    assert result is work
+    assert len(frames) == 1
+
+
+# 能以这些模式写出未压缩 TIFF 的模式（Pillow 把 RGBX 写成 RGB）
+@pytest.mark.parametrize("mode", ["L", "P", "I;16", "I;16B", "RGBA", "CMYK"])
+def test_mapped_modes_share_file_pages(tmp_path, mode):
+    path = str(tmp_path / "source.tif")
+    Image.new(mode, SIZE).save(path)
+    image = image_io.open_image(path)
+    assert image.readonly
+
+    # 直接改写文件末尾的像素，映射的图像立即看到变化，说明像素没有被复制
+    pixel = image_io._MAP_MODE_BYTES[mode]
+    with open(path, "r+b") as f:
+        f.seek(-pixel, 2)
+        f.write(b"\x01" * pixel)
+    assert image.getpixel((SIZE[0] - 1, SIZE[1] - 1)) not in (0, (0,) * pixel)
+
+    mapping = image._file_mapping
+    image_io.close_image(image)
+    assert mapping.closed
+
+
+def test_rgb_is_decoded(tmp_path):
+    path = str(tmp_path / "source.tif")
+    Image.new("RGB", SIZE).save(path)
+    assert not image_io.open_image(path).readonly